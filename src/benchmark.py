@@ -0,0 +1,258 @@
+"""
+Benchmarks of the hot paths of the pipeline: encoding of chord sequences,
+extraction of recurring patterns, harmonic similarity (single pairs and the
+whole intra map), and construction of the similarity graph. Each stage is
+run on the setup bundles and on synthetic corpora of increasing size, and
+its wall time, throughput and peak memory are saved in a JSON file, so that
+results can be compared across commits (see the --compare option).
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+
+from harmonic_lib import ngram_hsim
+from lharp_api import encode_chord_sequences, extract_recurring_pattern
+from lharp_api import harmonic_similarity_intra
+
+SETUP_DIR = "../setup"
+TRANSPOSED_PATH = os.path.join(SETUP_DIR, "sonar_transposed_chords.joblib")
+ENCODING_PATH = os.path.join(SETUP_DIR, "sonar_encoding_bundle.joblib")
+
+BENCHMARK_FORMAT_VERSION = 1
+STAGES = ["encode", "extract", "ngram_hsim", "similarity", "graph"]
+# Synthetic corpora, as (number of tracks, length of each sequence)
+SYNTHETIC_SIZES = [(100, 100), (200, 200), (400, 200)]
+
+
+def measure(fn, *args, repeat=3, memory=True):
+    """
+    Measure the execution of fn(*args): the best wall time over `repeat`
+    runs, and the peak memory allocated during an additional run traced by
+    `tracemalloc` (which is not timed, as tracing slows down allocations).
+
+    Returns: the output of the function, the wall time (seconds), and the
+        peak memory (bytes, or None if `memory` is not set).
+    """
+    wall_time = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn(*args)
+        wall_time = min(wall_time, time.perf_counter() - start)
+
+    peak_bytes = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn(*args)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return output, wall_time, peak_bytes
+
+
+def synthetic_chords(encdec, n_tracks: int, length: int, repetition=0.5,
+                     motif_length=(3, 8), seed=0):
+    """
+    Generate a synthetic corpus of normalised chord sequences, drawing the
+    chord labels from the vocabulary of the encoder. Each sequence is built
+    from motifs, which are repeated with probability `repetition`, so that
+    recurring patterns of various lengths are found in the tracks.
+
+    Returns: a dictionary with a list of chord labels for each track.
+    """
+    rng = random.Random(seed)
+    labels = sorted(encdec.chord_to_hash)
+    corpus = {}
+    for i in range(n_tracks):
+        sequence, motifs = [], []
+        while len(sequence) < length:
+            if motifs and rng.random() < repetition:
+                sequence.extend(rng.choice(motifs))
+            else:  # a new motif for this track
+                motif = rng.choices(labels, k=rng.randint(*motif_length))
+                motifs.append(motif)
+                sequence.extend(motif)
+        corpus[f"synth_{i}"] = sequence[:length]
+    return corpus
+
+
+def _pairwise_hsim(chords_recpat: dict, max_pairs: int):
+    track_ids = list(chords_recpat)
+    pairs = 0
+    for i, track_a in enumerate(track_ids):
+        for track_b in track_ids[i + 1:]:
+            ngram_hsim(chords_recpat[track_a], chords_recpat[track_b])
+            pairs += 1
+            if pairs >= max_pairs:
+                return pairs
+    return pairs
+
+
+def _similarity_graph(hsim_map: dict):
+    # Imported here, as plotting dependencies are not needed otherwise
+    from visualisation import compute_similarity_graph
+    return compute_similarity_graph(hsim_map)
+
+
+def benchmark_corpus(name: str, chord_norm: dict, encdec, stages=STAGES,
+                     min_order=3, max_pairs=100000, repeat=3, memory=True):
+    """
+    Run the benchmarks of the given stages on a corpus of normalised chord
+    sequences, where each stage takes the outputs of the previous ones.
+
+    Returns: a list of results, one for each stage, with the wall time, the
+        peak memory, and the throughput (items per second) of the stage.
+    """
+    results = []
+    num_chords = sum(len(chords) for chords in chord_norm.values())
+    num_pairs = len(chord_norm) * (len(chord_norm) - 1) // 2
+
+    def record(stage, wall_time, peak_bytes, num_items, unit):
+        results.append({"corpus": name, "stage": stage,
+                        "tracks": len(chord_norm), "chords": num_chords,
+                        "wall_s": wall_time, "peak_bytes": peak_bytes,
+                        "items": num_items, "unit": unit,
+                        "throughput": num_items / wall_time if wall_time else None})
+        print(f"{name:<16}{stage:<12}{wall_time:>10.4f}s "
+              f"{results[-1]['throughput'] or 0:>14.1f} {unit}/s")
+
+    chord_enc, wall_time, peak = measure(
+        encode_chord_sequences, chord_norm, encdec, True,
+        repeat=repeat, memory=memory)
+    if "encode" in stages:
+        record("encode", wall_time, peak, num_chords, "chords")
+
+    chords_recpat, wall_time, peak = measure(
+        extract_recurring_pattern, chord_enc, min_order,
+        repeat=repeat, memory=memory)
+    if "extract" in stages:
+        record("extract", wall_time, peak, num_chords, "chords")
+
+    if "ngram_hsim" in stages:
+        pairs, wall_time, peak = measure(_pairwise_hsim, chords_recpat,
+            max_pairs, repeat=repeat, memory=memory)
+        record("ngram_hsim", wall_time, peak, pairs, "pairs")
+
+    if "similarity" in stages or "graph" in stages:
+        hsim_map, wall_time, peak = measure(harmonic_similarity_intra,
+            chords_recpat, encdec, repeat=1, memory=memory)
+        if "similarity" in stages:
+            record("similarity", wall_time, peak, num_pairs, "pairs")
+
+    if "graph" in stages:
+        try:
+            _, wall_time, peak = measure(_similarity_graph, hsim_map,
+                                         repeat=repeat, memory=memory)
+        except ImportError as e:  # plotting dependencies are optional
+            print(f"{name:<16}{'graph':<12} skipped: {e}")
+        else:
+            num_edges = sum(len(row) for row in hsim_map.values())
+            record("graph", wall_time, peak, num_edges, "edges")
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: list, baseline: list):
+    """
+    Print the speedup of each benchmark with respect to a baseline, where
+    benchmarks are matched by corpus and stage.
+    """
+    baseline = {(b["corpus"], b["stage"]): b for b in baseline}
+    print(f"{'corpus':<16}{'stage':<12}{'speedup':>10}{'memory':>10}")
+    for result in results:
+        base = baseline.get((result["corpus"], result["stage"]))
+        if base is None:
+            continue
+        speedup = base["wall_s"] / result["wall_s"]
+        memory = result["peak_bytes"] / base["peak_bytes"] \
+            if result["peak_bytes"] and base["peak_bytes"] else float("nan")
+        print(f"{result['corpus']:<16}{result['stage']:<12}"
+              f"{speedup:>9.2f}x{memory:>9.2f}x")
+
+
+def main():
+    """
+    Main function to parse the arguments and call the main process.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the harmonic similarity pipeline.')
+
+    parser.add_argument('out_path', action='store', type=str,
+                        help='Path of the JSON file with the results.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help='Stages to benchmark.')
+    parser.add_argument('--setup_tracks', action='store', type=int, default=500,
+                        help='Number of tracks of the setup corpus to use '
+                             '(0 to skip the setup corpus).')
+    parser.add_argument('--sizes', nargs='+', type=str,
+                        default=[f"{n}x{l}" for n, l in SYNTHETIC_SIZES],
+                        help='Synthetic corpora, as TRACKSxLENGTH.')
+    parser.add_argument('--repeat', action='store', type=int, default=3,
+                        help='Number of runs, the best time is kept.')
+    parser.add_argument('--max_pairs', action='store', type=int, default=100000,
+                        help='Number of pairs for the ngram_hsim benchmark.')
+    parser.add_argument('--no_memory', action='store_true', default=False,
+                        help='Whether to skip the measurement of peak memory.')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='Seed for the generation of synthetic corpora.')
+    parser.add_argument('--compare', action='store', type=str,
+                        help='Results of a previous run to compare with.')
+
+    args = parser.parse_args()
+    options = dict(stages=args.stages, max_pairs=args.max_pairs,
+                   repeat=args.repeat, memory=not args.no_memory)
+
+    encdec = joblib.load(ENCODING_PATH)["encoder_decoder"]
+    results = []
+    if args.setup_tracks > 0:
+        transposed = joblib.load(TRANSPOSED_PATH)
+        setup_ids = list(transposed)[:args.setup_tracks]
+        results += benchmark_corpus("setup", {track_id: transposed[track_id]
+            for track_id in setup_ids}, encdec, **options)
+
+    for size in args.sizes:
+        n_tracks, length = (int(n) for n in size.split("x"))
+        chord_norm = synthetic_chords(encdec, n_tracks, length, seed=args.seed)
+        results += benchmark_corpus(f"synth_{size}", chord_norm, encdec,
+                                    **options)
+
+    report = {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+        "results": results,
+    }
+    with open(args.out_path, "w") as out_file:
+        json.dump(report, out_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as base_file:
+            compare_results(results, json.load(base_file)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""
+A columnar on-disk format for the data bundles of the pipeline (chords,
+encodings, n-grams and harmonic similarity maps), as an alternative to the
+pickled dictionaries in setup/. A columnar bundle is a directory of .npy
+files holding ragged arrays (values plus offsets) and string tables, which
+are opened with memory mapping: tracks can be accessed at random without
+loading the whole bundle, and pages are shared among processes.
+"""
+import os
+import json
+import argparse
+from collections.abc import Mapping
+
+import joblib
+import numpy as np
+
+COLUMNAR_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+
+def is_columnar(bundle_path: str):
+    """
+    Whether the given path points to a columnar bundle.
+    """
+    return os.path.isfile(os.path.join(bundle_path, MANIFEST_FILE))
+
+
+def _offsets_from_lengths(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class BundleWriter:
+    """
+    Writes the arrays of a columnar bundle to a directory, together with a
+    manifest describing the kind of bundle and its attributes.
+    """
+
+    def __init__(self, bundle_path: str, kind: str, **attributes):
+        self.bundle_path = bundle_path
+        self.manifest = {"version": COLUMNAR_FORMAT_VERSION,
+                         "kind": kind, **attributes}
+        os.makedirs(bundle_path, exist_ok=True)
+
+    def array(self, name: str, values):
+        np.save(os.path.join(self.bundle_path, name + ".npy"), values)
+
+    def strings(self, name: str, strings):
+        """
+        Write a table of strings, as UTF-8 bytes plus offsets.
+        """
+        encoded = [string.encode("utf-8") for string in strings]
+        self.array(name + ".offsets", _offsets_from_lengths(
+            [len(string) for string in encoded]))
+        self.array(name + ".values",
+                   np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def ragged(self, name: str, sequences, dtype, width=1):
+        """
+        Write a list of sequences as a single array of values plus offsets.
+        Each element of a sequence is a row of `width` values.
+        """
+        sequences = list(sequences)
+        self.array(name + ".offsets", _offsets_from_lengths(
+            [len(sequence) for sequence in sequences]))
+        values = np.zeros((0, width) if width > 1 else 0, dtype=dtype)
+        if len(sequences) > 0:
+            values = np.concatenate([np.asarray(sequence, dtype=dtype)
+                .reshape((-1, width) if width > 1 else -1)
+                for sequence in sequences] + [values])
+        self.array(name + ".values", values)
+
+    def nested(self, name: str, sequences_of_sequences, dtype):
+        """
+        Write a list of lists of sequences (e.g. a bag of patterns per track),
+        as a ragged array of sequences plus the offsets of each list.
+        """
+        sequences_of_sequences = list(sequences_of_sequences)
+        self.array(name + ".groups", _offsets_from_lengths(
+            [len(sequences) for sequences in sequences_of_sequences]))
+        self.ragged(name, (sequence for sequences in sequences_of_sequences
+                           for sequence in sequences), dtype)
+
+    def close(self):
+        with open(os.path.join(self.bundle_path, MANIFEST_FILE), "w") as mf:
+            json.dump(self.manifest, mf)
+
+
+class StringTable:
+    """
+    A read-only table of strings, backed by memory-mapped arrays.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.values[self.offsets[i]:self.offsets[i+1]]).decode("utf-8")
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+
+class RaggedArray:
+    """
+    A read-only list of sequences, backed by memory-mapped arrays. Sequences
+    are returned as views, so no data is copied until it is accessed.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+
+class NestedRaggedArray:
+    """
+    A read-only list of lists of sequences, backed by memory-mapped arrays.
+    """
+
+    def __init__(self, sequences: RaggedArray, groups):
+        self.sequences = sequences
+        self.groups = groups
+
+    def __len__(self):
+        return len(self.groups) - 1
+
+    def __getitem__(self, i):
+        return [self.sequences[j] for j in range(self.groups[i], self.groups[i+1])]
+
+
+class ColumnarBundle:
+    """
+    Opens a columnar bundle, whose arrays are memory-mapped when accessed.
+    """
+
+    def __init__(self, bundle_path: str, mmap_mode="r"):
+        if not is_columnar(bundle_path):
+            raise ValueError("Not a columnar bundle: %s" % bundle_path)
+        with open(os.path.join(bundle_path, MANIFEST_FILE), "r") as mf:
+            self.manifest = json.load(mf)
+        if self.manifest["version"] != COLUMNAR_FORMAT_VERSION:
+            raise ValueError("Unsupported bundle format: %s" % bundle_path)
+        self.bundle_path = bundle_path
+        self.mmap_mode = mmap_mode
+
+    @property
+    def kind(self):
+        return self.manifest["kind"]
+
+    def array(self, name: str):
+        return np.load(os.path.join(self.bundle_path, name + ".npy"),
+                       mmap_mode=self.mmap_mode)
+
+    def strings(self, name: str):
+        return StringTable(self.array(name + ".values"),
+                           self.array(name + ".offsets"))
+
+    def ragged(self, name: str):
+        return RaggedArray(self.array(name + ".values"),
+                           self.array(name + ".offsets"))
+
+    def nested(self, name: str):
+        return NestedRaggedArray(self.ragged(name), self.array(name + ".groups"))
+
+
+class TrackMapping(Mapping):
+    """
+    A read-only dictionary-like view of per-track data in a columnar bundle,
+    indexed by track id; values are only read when accessed.
+    """
+
+    def __init__(self, track_ids: StringTable, get_item):
+        self._track_ids = track_ids.tolist()
+        self._positions = {track_id: i for i, track_id
+                           in enumerate(self._track_ids)}
+        self._get_item = get_item
+
+    def __getitem__(self, track_id):
+        return self._get_item(self._positions[track_id])
+
+    def __iter__(self):
+        return iter(self._track_ids)
+
+    def __len__(self):
+        return len(self._track_ids)
+
+
+# Converters from the pickled bundles
+
+
+def _labels_to_ids(sequences, label_ids: dict):
+    return [[label_ids.setdefault(label, len(label_ids)) for label in sequence]
+            for sequence in sequences]
+
+
+def convert_databundle(databundle, bundle_path: str):
+    """
+    Convert a chord data bundle (e.g. setup/sonar_databundle.joblib), which
+    holds the (chord, time) annotations of each track in 'preproc', and
+    optionally the (key, time) annotations in 'keys' and the encoded chords
+    in 'encoded'. Labels are stored as ids into a string table.
+
+    Args:
+        databundle (str or dict): the data bundle, or the path to its file.
+        bundle_path (str): the directory of the columnar bundle.
+    """
+    if isinstance(databundle, str):
+        databundle = joblib.load(databundle)
+    track_ids = list(databundle['preproc'].keys())
+    writer = BundleWriter(bundle_path, "databundle",
+        has_keys='keys' in databundle, has_encoded='encoded' in databundle)
+    writer.strings("track_ids", track_ids)
+
+    label_ids = {}
+    chords = [databundle['preproc'][track_id] for track_id in track_ids]
+    writer.ragged("chords", _labels_to_ids(([c for c, _ in track]
+        for track in chords), label_ids), np.int32)
+    writer.ragged("chord_times", ([t for _, t in track] for track in chords),
+                  np.float64)
+    if 'keys' in databundle:
+        keys = [databundle['keys'].get(track_id, []) for track_id in track_ids]
+        writer.ragged("keys", _labels_to_ids(([k for k, _ in track]
+            for track in keys), label_ids), np.int32)
+        writer.ragged("key_times", ([t for _, t in track] for track in keys),
+                      np.float64)
+    writer.strings("labels", list(label_ids.keys()))
+    if 'encoded' in databundle:
+        writer.ragged("encoded", (databundle['encoded'].get(track_id, [])
+                                  for track_id in track_ids), np.int32)
+    writer.close()
+
+
+def convert_encoding_bundle(encoding_bundle, bundle_path: str):
+    """
+    Convert an encoding bundle (e.g. setup/sonar_encoding_bundle.joblib), with
+    the encoded chords of each track in 'encoded'. The vocabulary of the
+    encoder-decoder is also saved, if it supports it.
+    """
+    if isinstance(encoding_bundle, str):
+        encoding_bundle = joblib.load(encoding_bundle)
+    track_ids = list(encoding_bundle['encoded'].keys())
+    writer = BundleWriter(bundle_path, "encoding_bundle")
+    writer.strings("track_ids", track_ids)
+    writer.ragged("encoded", (encoding_bundle['encoded'][track_id]
+                              for track_id in track_ids), np.int32)
+    encdec = encoding_bundle.get('encoder_decoder')
+    if hasattr(encdec, "save_vocabulary"):
+        encdec.save_vocabulary(os.path.join(bundle_path, "vocabulary.json"))
+        writer.manifest["vocabulary"] = "vocabulary.json"
+    writer.close()
+
+
+def convert_ngrams(ngrams_bag, bundle_path: str):
+    """
+    Convert the bag of recurring patterns of each track, either as a single
+    dictionary, or as a list of single-record dictionaries (as saved by
+    `ngrams_lib.process_ngrams`).
+    """
+    if isinstance(ngrams_bag, str):
+        ngrams_bag = joblib.load(ngrams_bag)
+    if not isinstance(ngrams_bag, dict):
+        ngrams_bag = {track_id: bag for track_dict in ngrams_bag
+                      for track_id, bag in track_dict.items()}
+    track_ids = list(ngrams_bag.keys())
+    writer = BundleWriter(bundle_path, "ngrams")
+    writer.strings("track_ids", track_ids)
+    writer.nested("patterns", (ngrams_bag[track_id] for track_id in track_ids),
+                  np.int32)
+    writer.close()
+
+
+def convert_ngrams_index(ngrams_index, bundle_path: str):
+    """
+    Convert the (position, length) of the n-grams of each track, as in
+    setup/sonar_ngrams_index.joblib.
+    """
+    if isinstance(ngrams_index, str):
+        ngrams_index = joblib.load(ngrams_index)
+    track_ids = list(ngrams_index.keys())
+    writer = BundleWriter(bundle_path, "ngrams_index")
+    writer.strings("track_ids", track_ids)
+    writer.ragged("positions", (ngrams_index[track_id] for track_id in track_ids),
+                  np.int32, width=2)
+    writer.close()
+
+
+def convert_hsim_map(hsim_map, bundle_path: str):
+    """
+    Convert a harmonic similarity map, as a sparse matrix in CSR format: for
+    each track (row), the other tracks (columns) with a non-null similarity,
+    their similarity, and the longest recurring patterns they share. Patterns
+    made of chord labels (decoded) are stored as ids into a string table.
+    """
+    if isinstance(hsim_map, str):
+        hsim_map = joblib.load(hsim_map)
+    hsim_map = hsim_map.get('hsim_map', hsim_map)
+    track_ids = list(hsim_map.keys())
+    positions = {track_id: i for i, track_id in enumerate(track_ids)}
+    # Tracks only appearing as columns are also indexed
+    for row in hsim_map.values():
+        for track_id in row:
+            if track_id not in positions:
+                positions[track_id] = len(track_ids)
+                track_ids.append(track_id)
+
+    cols, scores, patterns = [], [], []
+    for track_id in hsim_map:
+        for other_id, (score, longest_rps) in hsim_map[track_id].items():
+            cols.append(positions[other_id])
+            scores.append(score)
+            patterns.append(longest_rps)
+    decoded = any(isinstance(item, str) for rps in patterns
+                  for rp in rps for item in rp)
+    label_ids = {}
+    if decoded:  # patterns hold chord labels rather than tokens
+        patterns = [_labels_to_ids(rps, label_ids) for rps in patterns]
+
+    writer = BundleWriter(bundle_path, "hsim_map", decoded=decoded)
+    writer.strings("track_ids", track_ids)
+    writer.array("row_offsets", _offsets_from_lengths(
+        [len(hsim_map[track_id]) if track_id in hsim_map else 0
+         for track_id in track_ids]))
+    writer.array("cols", np.array(cols, dtype=np.int32))
+    writer.array("scores", np.array(scores, dtype=np.float64))
+    writer.nested("patterns", patterns, np.int32)
+    writer.strings("labels", list(label_ids.keys()))
+    writer.close()
+
+
+# Loaders, replacing those of the pickled bundles
+
+
+def open_chord_columnar(bundle_path: str):
+    """
+    Open the chord annotations of a columnar data bundle, as `open_chord`.
+
+    Returns: a read-only mapping from each track id to its list of (chord,
+        time) tuples, which are only read when accessed.
+    """
+    bundle = ColumnarBundle(bundle_path)
+    labels = bundle.strings("labels").tolist()
+    chords, chord_times = bundle.ragged("chords"), bundle.ragged("chord_times")
+
+    return TrackMapping(bundle.strings("track_ids"), lambda i: list(zip(
+        [labels[j] for j in chords[i]], chord_times[i].tolist())))
+
+
+def open_keys_columnar(bundle_path: str):
+    """
+    Open the key annotations of a columnar data bundle, as (key, time) tuples.
+    """
+    bundle = ColumnarBundle(bundle_path)
+    labels = bundle.strings("labels").tolist()
+    keys, key_times = bundle.ragged("keys"), bundle.ragged("key_times")
+
+    return TrackMapping(bundle.strings("track_ids"), lambda i: list(zip(
+        [labels[j] for j in keys[i]], key_times[i].tolist())))
+
+
+def open_encoded_columnar(bundle_path: str):
+    """
+    Open the encoded chords of a columnar data/encoding bundle, as
+    `open_encoded`: each track id is mapped to an int32 array view.
+    """
+    bundle = ColumnarBundle(bundle_path)
+    return TrackMapping(bundle.strings("track_ids"), bundle.ragged("encoded").__getitem__)
+
+
+def open_ngram_columnar(bundle_path: str):
+    """
+    Open the recurring patterns of a columnar n-grams bundle, as `open_ngram`:
+    each track id is mapped to its list of pattern tuples.
+    """
+    bundle = ColumnarBundle(bundle_path)
+    patterns = bundle.nested("patterns")
+
+    return TrackMapping(bundle.strings("track_ids"), lambda i: [
+        tuple(pattern.tolist()) for pattern in patterns[i]])
+
+
+def open_ngrams_index_columnar(bundle_path: str):
+    """
+    Open the n-gram positions of a columnar bundle, as (position, length).
+    """
+    bundle = ColumnarBundle(bundle_path)
+    positions = bundle.ragged("positions")
+
+    return TrackMapping(bundle.strings("track_ids"), lambda i: [
+        tuple(position) for position in positions[i].tolist()])
+
+
+def open_hsim_map_columnar(bundle_path: str):
+    """
+    Open a columnar harmonic similarity map, as `open_hsim_map`.
+
+    Returns: a dictionary with the 'hsim_map', a read-only mapping where
+        hsim_map[a] gives the dictionary of tracks similar to a, with their
+        similarity and longest shared patterns (rows are read on access).
+    """
+    bundle = ColumnarBundle(bundle_path)
+    track_ids = bundle.strings("track_ids")
+    track_names = track_ids.tolist()
+    labels = bundle.strings("labels").tolist()
+    row_offsets, cols = bundle.array("row_offsets"), bundle.array("cols")
+    scores, patterns = bundle.array("scores"), bundle.nested("patterns")
+    decoded = bundle.manifest["decoded"]
+
+    def get_row(i):
+        row = {}
+        for e in range(row_offsets[i], row_offsets[i+1]):
+            longest_rps = [pattern.tolist() for pattern in patterns[e]]
+            longest_rps = [[labels[j] for j in rp] for rp in longest_rps] \
+                if decoded else [tuple(rp) for rp in longest_rps]
+            row[track_names[cols[e]]] = float(scores[e]), longest_rps
+        return row
+
+    return {'hsim_map': TrackMapping(track_ids, get_row)}
+
+
+CONVERTERS = {
+    "databundle": convert_databundle,
+    "encoding_bundle": convert_encoding_bundle,
+    "ngrams": convert_ngrams,
+    "ngrams_index": convert_ngrams_index,
+    "hsim_map": convert_hsim_map,
+}
+
+
+def main():
+    """
+    Main function to parse the arguments and call the main process.
+    """
+    parser = argparse.ArgumentParser(
+        description='Conversion of pickled data bundles to columnar bundles.')
+
+    parser.add_argument('kind', choices=list(CONVERTERS.keys()),
+                        help='The kind of data bundle to convert.')
+    parser.add_argument('joblib_path', action='store', type=str,
+                        help='Path to the pickled data bundle to convert.')
+    parser.add_argument('bundle_path', action='store', type=str,
+                        help='Directory of the columnar bundle to create.')
+
+    args = parser.parse_args()
+    CONVERTERS[args.kind](args.joblib_path, args.bundle_path)
+    print(f"Columnar bundle written in {args.bundle_path}")
+
+
+if __name__ == "__main__":
+    main()
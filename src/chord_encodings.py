@@ -3,29 +3,241 @@ Collects a number of encoding functions to convert chord symbols into vector
 representation that can be passed to music models.
 """
 
+import json
+from bisect import insort
+from collections import namedtuple
 from copy import Error
 
+import numpy as np
 import ChordalPy
 from note_seq import chord_symbols_lib as cslib
 from note_seq import encoder_decoder
 from note_seq import constants
 
 from chord_lib import chord_symbol_quality, chord_symbol_root, strip_chord_bass
+from chord_lib import CHORD_SIMPLIFICATIONS, natural_to_hsteps, split_chord_figure
 
 
 NOTES_PER_OCTAVE = constants.NOTES_PER_OCTAVE
 NO_CHORD = "N"  # this is different than N.C. in note_seq.constants
+VOCABULARY_FORMAT_VERSION = 1
 
 # Mapping from pitch class index to name.
 _PITCH_CLASS_MAPPING = ['C', 'C#', 'D', 'Eb', 'E', 'F',
                         'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+# Mapping from chord quality index (as in note_seq) to shorthand.
+_QUALITY_MAPPING = ['maj', 'min', 'aug', 'dim', 'other']
 
 
 class ChordEncodingError(Exception):
   pass
 
 
-class TriadChordOneHotEncoding(encoder_decoder.OneHotEncoding):
+def update_report(report: dict, label, simplified, rule, count=1):
+    """
+    Record `count` occurrences of a label that could not be encoded as it is
+    in a fail-soft report, which maps each label to its simplification (None
+    if it was dropped), the rule that was applied, and the occurrences of the
+    label; counts are summed across calls (e.g. across tracks).
+    """
+    if report is not None:
+        entry = report.setdefault(
+            label, {"simplified": simplified, "rule": rule, "count": 0})
+        entry["count"] += count
+
+
+def merge_reports(report: dict, other: dict):
+    """
+    Add the entries of a fail-soft report (e.g. one built in a worker
+    process) to another report, summing the counts of the shared labels.
+    """
+    for label, entry in other.items():
+        update_report(report, label, entry["simplified"], entry["rule"],
+                      entry["count"])
+
+
+class EncodedCorpus(namedtuple("EncodedCorpus",
+                                ["track_ids", "tokens", "offsets"])):
+    """
+    A corpus of encoded chord sequences, stored as a single contiguous array of
+    int32 tokens, where the sequence of the i-th track in `track_ids` is given
+    by tokens[offsets[i]:offsets[i+1]]. It also exposes `items()` so that it
+    can be passed in place of a dictionary of encoded sequences.
+    """
+    __slots__ = ()
+
+    def items(self):
+        """
+        Iterate over (track_id, tokens) pairs, where tokens are lists of ints,
+        as in a dictionary of encoded sequences (so that patterns extracted
+        from them hold Python ints too, whatever the container).
+        """
+        for i, track_id in enumerate(self.track_ids):
+            yield track_id, \
+                self.tokens[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def to_dict(self):
+        """
+        Convert the corpus into a dictionary of lists, indexed by track id.
+        """
+        return dict(self.items())
+
+    def select(self, mask):
+        """
+        Return a new corpus keeping only the tokens where `mask` is true.
+        """
+        kept = np.zeros(len(self.tokens) + 1, dtype=np.int64)
+        np.cumsum(mask, out=kept[1:])
+        return EncodedCorpus(self.track_ids, self.tokens[mask], kept[self.offsets])
+
+    def remap(self, lookup, collapse_repeats=False):
+        """
+        Map each token to a new one through a lookup array (a token -> token
+        map), where negative entries denote tokens to drop.
+
+        Args:
+            lookup (np.ndarray): the new token for each token in the corpus.
+            collapse_repeats (bool): whether tokens that are repeated within
+                a track after the mapping should be collapsed into one.
+
+        Returns: a new `EncodedCorpus` with the mapped tokens.
+        """
+        corpus = EncodedCorpus(self.track_ids,
+            np.asarray(lookup, dtype=np.int32)[self.tokens], self.offsets)
+        corpus = corpus.select(corpus.tokens >= 0)
+        if collapse_repeats:
+            repeated = np.zeros(len(corpus.tokens), dtype=bool)
+            repeated[1:] = corpus.tokens[1:] == corpus.tokens[:-1]
+            starts = corpus.offsets[:-1]  # first token of each track
+            repeated[starts[starts < len(repeated)]] = False
+            corpus = corpus.select(~repeated)
+
+        return corpus
+
+
+class CorpusEncodingMixin:
+    """
+    Batch encoding and decoding of whole corpora of chord sequences. Each
+    distinct label is encoded only once, and the corpus is then mapped to
+    tokens through a NumPy lookup over the interned label IDs.
+    """
+    _MEMOS = ("_fallbacks",)  # memoised results, which are not pickled
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reset_memos()
+
+    def _reset_memos(self):
+        for name in self._MEMOS:
+            setattr(self, name, {})
+
+    def __getstate__(self):
+        return {name: value for name, value in self.__dict__.items()
+                if name not in self._MEMOS}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_memos()
+
+    def _encode_label(self, label):
+        """
+        Encode a single chord label; subclasses can override this method when
+        the encoding of a label differs from `encode_event`.
+        """
+        return self.encode_event(label)
+
+    def _resolve_label(self, label):
+        """
+        Find the first simplification of a label that can be encoded, trying
+        those in `CHORD_SIMPLIFICATIONS` in order. Resolutions are memoised,
+        so each failing label is only resolved once per encoder.
+
+        Returns: a tuple with the simplified label, the name of the rule that
+            was applied, and the token; these are all None if none succeeded.
+        """
+        fallbacks = self._fallbacks
+        if label not in fallbacks:
+            fallbacks[label] = None, None, None
+            simplified = label
+            for rule, simplify in CHORD_SIMPLIFICATIONS:
+                previous, simplified = simplified, simplify(simplified)
+                if simplified == previous:
+                    continue  # nothing to simplify at this level
+                try:
+                    token = self._encode_label(simplified)
+                except Exception:
+                    continue  # go on with a stronger simplification
+                fallbacks[label] = simplified, rule, token
+                break
+
+        return fallbacks[label]
+
+    def encode_corpus(self, chord_dict: dict, fail_soft=False,
+                      report: dict = None):
+        """
+        Encode a corpus of chord sequences in a single pass.
+
+        Args:
+            chord_dict (dict): sequences of chord labels, indexed by track id.
+            fail_soft (bool): whether labels that cannot be encoded should be
+                simplified (see `_resolve_label`) rather than raising an error.
+                Labels that cannot be encoded even after simplification are
+                dropped from the sequences.
+            report (dict): an optional dictionary that, if `fail_soft` is set,
+                is updated with each label that could not be encoded (see
+                `update_report`).
+
+        Returns: an `EncodedCorpus` with the int32 tokens of all tracks.
+        """
+        track_ids = list(chord_dict.keys())
+        offsets = np.zeros(len(track_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(chord_dict[track_id])
+                                 for track_id in track_ids])
+        # Intern each label, so that it is encoded only once
+        label_ids = {}
+        interned = np.fromiter(
+            (label_ids.setdefault(label, len(label_ids))
+             for track_id in track_ids for label in chord_dict[track_id]),
+            dtype=np.int32, count=offsets[-1])
+        if not fail_soft:  # any illegal label will raise an error
+            lookup = np.fromiter(
+                (self._encode_label(label) for label in label_ids),
+                dtype=np.int32, count=len(label_ids))
+            return EncodedCorpus(track_ids, lookup[interned], offsets)
+
+        lookup = np.empty(len(label_ids), dtype=np.int32)
+        counts = np.bincount(interned, minlength=len(label_ids))
+        for label, label_id in label_ids.items():
+            try:
+                lookup[label_id] = self._encode_label(label)
+            except Exception:
+                simplified, rule, token = self._resolve_label(label)
+                lookup[label_id] = -1 if token is None else token
+                update_report(report, label, simplified, rule,
+                              int(counts[label_id]))
+        tokens = lookup[interned]
+        # Drop the unresolved labels, and shift the offsets accordingly
+        kept = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum(tokens >= 0, out=kept[1:])
+
+        return EncodedCorpus(track_ids, tokens[tokens >= 0], kept[offsets])
+
+    def decode_corpus(self, corpus: EncodedCorpus):
+        """
+        Decode an `EncodedCorpus` back to a dictionary of chord labels. Each
+        distinct token is decoded only once.
+        """
+        tokens, inverse = np.unique(corpus.tokens, return_inverse=True)
+        labels = np.array([self.decode_event(int(token)) for token in tokens],
+                          dtype=object)
+        decoded = labels[inverse]
+
+        return {track_id: decoded[corpus.offsets[i]:corpus.offsets[i+1]].tolist()
+                for i, track_id in enumerate(corpus.track_ids)}
+
+
+class TriadChordOneHotEncoding(CorpusEncodingMixin,
+                               encoder_decoder.OneHotEncoding):
     """
     Encodes chords as root + triad type, with zero index for "no chord".
     Encodes chords as follows:
@@ -80,7 +292,180 @@ class TriadChordOneHotEncoding(encoder_decoder.OneHotEncoding):
             return _PITCH_CLASS_MAPPING[index - 3 * NOTES_PER_OCTAVE - 1] + ':dim'
 
 
-class DecompositionOneHotEncoding(encoder_decoder.OneHotEncoding):
+class RootChordOneHotEncoding(CorpusEncodingMixin,
+                              encoder_decoder.OneHotEncoding):
+    """
+    Encodes chords by their root only, with zero index for "no chord".
+    0:     "no chord"
+    1-12:  chords with root C, C#, ... B (the quality is discarded).
+    """
+
+    @property
+    def num_classes(self):
+        return NOTES_PER_OCTAVE + 1
+
+    @property
+    def default_event(self):
+        return NO_CHORD
+
+    def encode_event(self, event):
+        if event == NO_CHORD:
+            return 0
+
+        root, _, _ = split_chord_figure(event)
+        if root not in natural_to_hsteps:
+            raise ChordEncodingError('%s has not a valid root' % event)
+        return natural_to_hsteps[root] % NOTES_PER_OCTAVE + 1
+
+    def decode_event(self, index):
+        if index == 0:
+            return NO_CHORD
+        return _PITCH_CLASS_MAPPING[index - 1]
+
+
+class QualityChordOneHotEncoding(CorpusEncodingMixin,
+                                 encoder_decoder.OneHotEncoding):
+    """
+    Encodes chords by their quality only, with zero index for "no chord".
+    0:     "no chord"
+    1-5:   major, minor, augmented, diminished, and other chords.
+    """
+
+    @property
+    def num_classes(self):
+        return len(_QUALITY_MAPPING) + 1
+
+    @property
+    def default_event(self):
+        return NO_CHORD
+
+    def encode_event(self, event):
+        if event == NO_CHORD:
+            return 0
+        return chord_symbol_quality(event) + 1
+
+    def decode_event(self, index):
+        if index == 0:
+            return NO_CHORD
+        return _QUALITY_MAPPING[index - 1]
+
+
+class RelativeChordOneHotEncoding(CorpusEncodingMixin,
+                                  encoder_decoder.OneHotEncoding):
+    """
+    Encodes chords relative to the previous one, as the interval between their
+    roots (in semitones, modulo the octave) and the quality of the chord, so
+    that sequences are transposition-invariant by construction and no key is
+    needed. The first chord of a sequence is encoded with a null interval.
+    Events are (interval, quality) tuples, and they are encoded as follows:
+    0:     "no chord" (any chord with no identifiable root, e.g. N and X)
+    1-60:  1 + interval * 5 + quality, where quality is one of major, minor,
+           augmented, diminished, and other (as in note_seq).
+    """
+    _MEMOS = ("_fallbacks", "_features")
+
+    @property
+    def num_classes(self):
+        return NOTES_PER_OCTAVE * len(_QUALITY_MAPPING) + 1
+
+    @property
+    def default_event(self):
+        return NO_CHORD
+
+    def encode_event(self, event):
+        if event == NO_CHORD:
+            return 0
+
+        interval, quality = event
+        return interval * len(_QUALITY_MAPPING) + quality + 1
+
+    def decode_event(self, index):
+        if index == 0:
+            return NO_CHORD
+
+        interval, quality = divmod(index - 1, len(_QUALITY_MAPPING))
+        return "+%d:%s" % (interval, _QUALITY_MAPPING[quality])
+
+    def _chord_features(self, label):
+        """
+        Return the pitch class of the root and the quality of a chord label,
+        or (-1, -1) if the label has no root. If the quality cannot be found
+        as the label cannot be parsed, the label is simplified (as in
+        `CHORD_SIMPLIFICATIONS`); CHORD_QUALITY_OTHER is used as last resort.
+        Features are memoised, as labels are shared across sequences.
+        """
+        features = self._features
+        if label in features:  # already computed
+            return features[label]
+
+        root, _, _ = split_chord_figure(label)
+        if root not in natural_to_hsteps:
+            features[label] = -1, -1
+            return features[label]
+
+        candidates = [label if ":" in label else label + ":maj"]
+        for _, simplify in CHORD_SIMPLIFICATIONS:
+            candidates.append(simplify(candidates[-1]))
+
+        quality = cslib.CHORD_QUALITY_OTHER
+        for candidate in candidates:
+            try:
+                quality = chord_symbol_quality(candidate)
+                break
+            except Exception:
+                continue  # go on with a stronger simplification
+
+        features[label] = natural_to_hsteps[root] % NOTES_PER_OCTAVE, quality
+        return features[label]
+
+    def encode_corpus(self, chord_dict: dict, fail_soft=False,
+                      report: dict = None):
+        """
+        Encode a corpus of chord sequences in a single pass, computing the
+        root and quality of each distinct label only once. Intervals are then
+        computed with respect to the previous chord with a root (if any).
+
+        Args:
+            chord_dict (dict): sequences of chord labels, indexed by track id.
+            fail_soft (bool), report (dict): only for compatibility with other
+                encoders, as all labels can be encoded (nothing is reported).
+
+        Returns: an `EncodedCorpus` with the int32 tokens of all tracks.
+        """
+        track_ids = list(chord_dict.keys())
+        lengths = np.array([len(chord_dict[track_id]) for track_id in track_ids],
+                           dtype=np.int64)
+        offsets = np.zeros(len(track_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Intern each label, so that it is parsed only once
+        label_ids = {}
+        interned = np.fromiter(
+            (label_ids.setdefault(label, len(label_ids))
+             for track_id in track_ids for label in chord_dict[track_id]),
+            dtype=np.int32, count=offsets[-1])
+        features = np.array([self._chord_features(label) for label in label_ids],
+                            dtype=np.int32).reshape(-1, 2)
+        roots, qualities = features[interned, 0], features[interned, 1]
+
+        # Find the position of the previous chord with a root, in each track
+        positions = np.arange(len(roots))
+        last_rooted = np.maximum.accumulate(np.where(roots >= 0, positions, -1))
+        previous = np.full(len(roots), -1, dtype=np.int64)
+        previous[1:] = last_rooted[:-1]
+        previous[previous < np.repeat(offsets[:-1], lengths)] = -1
+        # No previous chord (start of the track) gives a null interval
+        intervals = np.where(previous >= 0,
+            (roots - roots[np.maximum(previous, 0)]) % NOTES_PER_OCTAVE, 0)
+
+        tokens = np.where(roots >= 0,
+            intervals * len(_QUALITY_MAPPING) + qualities + 1, 0)
+        chord_corpus = EncodedCorpus(track_ids, tokens.astype(np.int32), offsets)
+
+        return chord_corpus
+
+
+class DecompositionOneHotEncoding(CorpusEncodingMixin,
+                                  encoder_decoder.OneHotEncoding):
     """
     Encodes a chord based on an enumeration function mapping the chord's note
     constituents (an array of NOTES_PER_OCTAVE elements) to a word token. This
@@ -100,7 +485,7 @@ class DecompositionOneHotEncoding(encoder_decoder.OneHotEncoding):
             same encoding (having the same constituents despite their labels).
     """
 
-    def __init__(self, chord_set: set):
+    def __init__(self, chord_set: set = ()):
         """
         Construct and initialise the encoder, given a comprehensive list of
         unique chord symbols -- intended as the support vocabulary of chords. 
@@ -112,22 +497,80 @@ class DecompositionOneHotEncoding(encoder_decoder.OneHotEncoding):
         # be other chords that are "nullified" by the modifications; although
         # it does not happen with the current data, this code would not work.
         # chord_set = [chord for chord in chord_set if chord != NO_CHORD]
-        
-        # Compute the content-based chord hash for each of them
-        self.chord_to_hash = {chord: self._compute_chord_hash(chord) 
-                              for chord in chord_set}
-        # Make sure that each unique chord hash has its own index
-        self.hash_to_index = {hash: index for index, hash
-                              in enumerate(set(self.chord_to_hash.values()))}
-
+        self.chord_to_hash = {}  # content-based chord hash for each symbol
+        self.hash_to_index = {}  # each unique chord hash has its own index
         # And now the inverse mappings, out of convenience for decoding
         # Given the non-bijective nature of chord_to_hash we keep all matches
-        self.hash_to_chords = {hash: [chord_fig for chord_fig, chord_hash
-            in self.chord_to_hash.items() if chord_hash == hash]
-            for hash in self.hash_to_index.keys()}
+        self.hash_to_chords = {}
         # The index_to_hash mapping is bijective, so it is safe to invert
-        self.index_to_hash = {index: hash for hash, index 
-            in self.hash_to_index.items()}
+        self.index_to_hash = {}
+
+        self.update_vocabulary(chord_set)
+
+    def update_vocabulary(self, chord_set):
+        """
+        Extend the vocabulary with new chord symbols, grouping them by their
+        decomposition in a single pass. Indices are assigned to unseen chord
+        hashes in sorted order, after all the existing ones: tokens that were
+        already in the vocabulary are never renumbered, so that encoded
+        sequences (and everything computed from them) remain valid.
+
+        Args:
+            chord_set (iterable): chord symbols to add to the vocabulary;
+                those that are already known are simply skipped.
+
+        Returns: the number of new tokens (decompositions) that were added.
+        """
+        new_hashes = set()
+        for chord in chord_set:
+            if chord in self.chord_to_hash:
+                continue  # already in the vocabulary
+            chord_hash = self._compute_chord_hash(chord)
+            self.chord_to_hash[chord] = chord_hash
+            if chord_hash not in self.hash_to_chords:
+                self.hash_to_chords[chord_hash] = []
+            insort(self.hash_to_chords[chord_hash], chord)
+            if chord_hash not in self.hash_to_index:
+                new_hashes.add(chord_hash)
+        # Sorting makes indices independent of the iteration order of sets
+        for chord_hash in sorted(new_hashes):
+            index = len(self.hash_to_index)
+            self.hash_to_index[chord_hash] = index
+            self.index_to_hash[index] = chord_hash
+
+        return len(new_hashes)
+
+    def save_vocabulary(self, vocab_path: str):
+        """
+        Save the vocabulary to a compact JSON file, where each token is stored
+        in index order together with its hash and all its chord symbols.
+        """
+        tokens = [[self.index_to_hash[index],
+                   sorted(self.hash_to_chords[self.index_to_hash[index]])]
+                  for index in range(len(self.index_to_hash))]
+        with open(vocab_path, "w") as vocab_file:
+            json.dump({"version": VOCABULARY_FORMAT_VERSION, "tokens": tokens},
+                      vocab_file, separators=(",", ":"))
+
+    @classmethod
+    def load_vocabulary(cls, vocab_path: str):
+        """
+        Create an encoder from a vocabulary file written by `save_vocabulary`.
+        Chord symbols are not parsed again, as their hashes are also stored.
+        """
+        with open(vocab_path, "r") as vocab_file:
+            vocabulary = json.load(vocab_file)
+        if vocabulary.get("version") != VOCABULARY_FORMAT_VERSION:
+            raise ValueError("Unsupported vocabulary format: %s" % vocab_path)
+
+        encdec = cls()
+        for index, (chord_hash, chords) in enumerate(vocabulary["tokens"]):
+            encdec.hash_to_index[chord_hash] = index
+            encdec.index_to_hash[index] = chord_hash
+            encdec.hash_to_chords[chord_hash] = chords
+            encdec.chord_to_hash.update({chord: chord_hash for chord in chords})
+
+        return encdec
 
     def _compute_chord_hash(self, chord_figure: str):
         """
@@ -143,6 +586,20 @@ class DecompositionOneHotEncoding(encoder_decoder.OneHotEncoding):
         # Use ChordalPy's hash function
         return chord_nob.get_pseudo_hash()
 
+    def _encode_label(self, label):
+        """
+        Encode a chord label through its decomposition, so that labels that
+        are not in the vocabulary (e.g. transposed ones) are also supported,
+        as long as their decomposition is.
+        """
+        chord_hash = self.chord_to_hash.get(label)
+        try:
+            if chord_hash is None:
+                chord_hash = self._compute_chord_hash(label)
+            return self.hash_to_index[chord_hash]
+        except Exception:
+            raise ChordEncodingError(label)
+
     @property
     def num_classes(self):
         return len(self.hash_to_index) # + 1 if NO_CHORD
@@ -173,10 +630,40 @@ class DecompositionOneHotEncoding(encoder_decoder.OneHotEncoding):
         given index (the actual decomposition).
         """
 
-        if index not in list(self.index_to_hash.keys()):
-            raise ValueError("%s is not a valid supported index.")
+        if index not in self.index_to_hash:
+            raise ValueError("%s is not a valid supported index." % index)
         # Retrieve all chords associated to the indexed decomposition
         chords = self.hash_to_chords[self.index_to_hash[index]]
 
-        return sorted(chords)[0]  # the shortest figure
+        return min(chords)  # the shortest figure
+
+
+
+def coarsening_map(fine_encdec, coarse_encdec):
+    """
+    Precompute a token -> token map from a fine encoding (e.g. the chord
+    decomposition) to a coarser one (e.g. triads, roots, or qualities), so
+    that sequences encoded at the finest level can be converted to coarser
+    encodings without parsing chords again (see `EncodedCorpus.remap`).
+
+    Each fine token is mapped through its decoded chord label, which is
+    simplified if the coarse encoder cannot encode it as it is. Tokens that
+    cannot be mapped at all are associated to -1.
+
+    Args:
+        fine_encdec (EncoderDecoder): the encoder of the finer tokens.
+        coarse_encdec (CorpusEncodingMixin): the coarser encoder.
+
+    Returns: an int32 array with the coarse token of each fine token.
+    """
+    lookup = np.full(fine_encdec.num_classes, -1, dtype=np.int32)
+    for index in range(fine_encdec.num_classes):
+        label = fine_encdec.decode_event(index)
+        try:
+            lookup[index] = coarse_encdec._encode_label(label)
+        except Exception:
+            _, _, token = coarse_encdec._resolve_label(label)
+            if token is not None:
+                lookup[index] = token
 
+    return lookup
@@ -12,11 +12,83 @@ hart_short_pattern = "^((N)|(([A-G][b#]*)((:(maj|min|dim|aug|maj7|min7|7|dim7|hd
 
 natural_to_hsteps = cpy.Tables.notes["naturalToHalfStep"]
 
+# Reduction of extended shorthands to the corresponding seventh chords
+_EXTENSION_TO_SEVENTH = {
+    "9": "7", "11": "7", "13": "7",
+    "maj9": "maj7", "maj11": "maj7", "maj13": "maj7",
+    "min9": "min7", "min11": "min7", "min13": "min7",
+}
+# Reduction of shorthands to the triad they are built on
+_SHORTHAND_TO_TRIAD = {
+    "min": "min", "min6": "min", "min7": "min", "minmaj7": "min",
+    "min9": "min", "min11": "min", "min13": "min",
+    "dim": "dim", "dim7": "dim", "hdim7": "dim",
+    "aug": "aug", "aug7": "aug",
+}
+
 
 def strip_chord_bass(chord_figure):
     return chord_figure.split("/")[0]
 
 
+def split_chord_figure(chord_figure):
+    """
+    Split a chord figure in Harte notation into its root, shorthand and the
+    list of modifiers (e.g. "E:min7(b5)/3" gives "E", "min7", ["b5"]), after
+    removing the bass note.
+    """
+    root, _, rest = strip_chord_bass(chord_figure).partition(":")
+    shorthand, _, modifiers = rest.partition("(")
+    modifiers = modifiers.rstrip(")")
+    return root, shorthand, modifiers.split(",") if modifiers else []
+
+
+def drop_chord_alterations(chord_figure):
+    """
+    Remove the modifiers of a chord figure and its bass, if the chord has a
+    shorthand (e.g. "E:min7(b5)" becomes "E:min7").
+    """
+    root, shorthand, modifiers = split_chord_figure(chord_figure)
+    if not shorthand:  # the chord is only defined by its intervals
+        return strip_chord_bass(chord_figure)
+    return root + ":" + shorthand
+
+
+def drop_chord_extensions(chord_figure):
+    """
+    Reduce extended chords to the corresponding seventh chords, also removing
+    alterations and bass (e.g. "C:min9(11)" becomes "C:min7").
+    """
+    root, shorthand, _ = split_chord_figure(drop_chord_alterations(chord_figure))
+    if not shorthand:  # the chord is only defined by its intervals
+        return strip_chord_bass(chord_figure)
+    return root + ":" + _EXTENSION_TO_SEVENTH.get(shorthand, shorthand)
+
+
+def chord_to_triad(chord_figure):
+    """
+    Reduce a chord to the triad it is built on (major, minor, diminished or
+    augmented), which is inferred from the intervals if there is no shorthand.
+    Chords that are not built on any of these triads are considered major.
+    """
+    root, shorthand, modifiers = split_chord_figure(chord_figure)
+    if shorthand:
+        triad = _SHORTHAND_TO_TRIAD.get(shorthand, "maj")
+    elif "b3" in modifiers:
+        triad = "dim" if "b5" in modifiers else "min"
+    else:
+        triad = "aug" if "#5" in modifiers else "maj"
+    return root + ":" + triad
+
+
+# Simplifications to attempt, in order, when a chord cannot be encoded
+CHORD_SIMPLIFICATIONS = [
+    ("alterations", drop_chord_alterations),
+    ("extensions", drop_chord_extensions),
+    ("triad", chord_to_triad),
+]
+
+
 def match_chord_quality(chord: cpy.Chord, mask_idxs: list):
 
     # Get the half-steps index of the root
@@ -5,6 +5,7 @@ import joblib
 from music21 import interval, note
 from ngrams_lib import save_joblib, open_chord
 from transposer import transpose_line
+from jams_ingestion import index_jams, align_jams
 import pandas as pd
 
 JAMS_PATH = "/Users/andreapoltronieri/Documents/Polifonia/Sonar/datasets/annotations"
@@ -38,16 +39,9 @@ def open_jams(jams_path):
 
 
 def align_path(jams_path, meta_path):
-    jamses = find_jams(jams_path, DIRS_NAME)
-    ids, paths = open_meta(meta_path)
-    tr_names = []
-    valid_paths = []
-    for i, path in enumerate(paths):
-        for jams in jamses:
-            if path.split('annotations')[1] == jams.split('annotations')[1]:
-                tr_names.append(ids[i])
-                valid_paths.append(jams)
-    return tr_names, valid_paths
+    # The JAMS files are indexed once, so each track needs a single lookup
+    jams_index = index_jams(jams_path, DIRS_NAME)
+    return align_jams(jams_index, meta_path)
 
 
 def align_chords(jams_name, jams_path, chords_path):
@@ -0,0 +1,205 @@
+"""
+Incremental readers for chord annotation corpora, where each track has an
+annotation with "chord" and "key" lists (see extra/arias.json). Tracks are
+parsed one at a time, either from a single JSON document (an object mapping
+track names to annotations) or from JSON Lines, so that work can start before
+the whole corpus is read and memory does not depend on the corpus size.
+"""
+import os
+import gzip
+import json
+import multiprocessing as mp
+
+_DEFAULT_CHUNK_SIZE = 1 << 16
+_JSONL_EXTENSIONS = (".jsonl", ".ndjson")
+
+_decoder = json.JSONDecoder()
+
+
+def open_corpus(corpus_path: str):
+    """
+    Open a corpus file for reading in text mode, decompressing it if needed.
+    """
+    if corpus_path.endswith(".gz"):
+        return gzip.open(corpus_path, "rt", encoding="utf-8")
+    return open(corpus_path, "r", encoding="utf-8")
+
+
+class _JSONStream:
+    """
+    A buffer over a text stream, from which JSON values are decoded one at a
+    time. The buffer is only extended when a value is not complete yet.
+    """
+
+    def __init__(self, stream, chunk_size=_DEFAULT_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self, size):
+        chunk = self.stream.read(size)
+        self.eof = len(chunk) == 0
+        # Drop what has already been consumed before extending
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def next_char(self, skip=" \t\n\r"):
+        """
+        Return the next character that is not in `skip`, or None at the end.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                break
+            self._read_more(self.chunk_size)
+
+        return self.buffer[self.pos] if self.pos < len(self.buffer) else None
+
+    def expect(self, char, skip=" \t\n\r"):
+        found = self.next_char(skip)
+        if found != char:
+            raise ValueError("Expected %r in JSON stream, found %r" % (char, found))
+        self.pos += 1
+
+    def decode(self):
+        """
+        Decode the next JSON value, reading more data until it is complete.
+        """
+        self.next_char()
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A value at the end of the buffer may still be incomplete
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Read chunks of increasing size, to avoid parsing again too often
+            self._read_more(read_size)
+            read_size *= 2
+
+
+def iter_json_tracks(corpus_path: str, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Iterate over the tracks in a JSON document mapping each track name to its
+    annotation, parsing the document incrementally.
+
+    Args:
+        corpus_path (str): path to the JSON file (optionally gzipped).
+        chunk_size (int): number of characters to read from the file at once.
+
+    Returns: a generator of (track_name, track_annotation) tuples.
+    """
+    with open_corpus(corpus_path) as stream:
+        json_stream = _JSONStream(stream, chunk_size)
+        json_stream.expect("{")
+        if json_stream.next_char() == "}":
+            return  # empty corpus
+        while True:
+            track_name = json_stream.decode()
+            json_stream.expect(":")
+            yield track_name, json_stream.decode()
+            if json_stream.next_char() == "}":
+                break
+            json_stream.expect(",")
+
+
+def iter_jsonl_tracks(corpus_path: str):
+    """
+    Iterate over the tracks in a JSON Lines file, where each line is either a
+    single-record dictionary mapping the track name to its annotation, or an
+    annotation holding the name of the track in the "id" field.
+
+    Returns: a generator of (track_name, track_annotation) tuples.
+    """
+    with open_corpus(corpus_path) as stream:
+        for line in stream:
+            if not line.strip():
+                continue  # skip empty lines
+            record = json.loads(line)
+            if "chord" in record:
+                yield record["id"], record
+            else:  # a single-record dictionary
+                yield next(iter(record.items()))
+
+
+def iter_chord_records(corpus_path: str, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Iterate over the chord annotations in a corpus file, which can be either
+    a JSON document or a JSON Lines file (from the extension).
+
+    Returns: a generator of (track_name, chords, key) tuples, which can be
+        passed to `lharp_api.preprocess_chord_sequences` or to the pipeline.
+    """
+    extension = os.path.splitext(corpus_path[:-3] if corpus_path.endswith(".gz")
+                                 else corpus_path)[1]
+    tracks = iter_jsonl_tracks(corpus_path) if extension in _JSONL_EXTENSIONS \
+        else iter_json_tracks(corpus_path, chunk_size)
+
+    for track_name, track_ann in tracks:
+        yield track_name, track_ann["chord"], track_ann["key"]
+
+
+def _read_shards(shard_paths, queue, chunk_size):
+    """
+    Worker reading the given shards and sending their records to the queue.
+    """
+    try:
+        for shard_path in shard_paths:
+            for record in iter_chord_records(shard_path, chunk_size):
+                queue.put(record)
+    except Exception as e:
+        queue.put(e)  # to be raised by the consumer
+    queue.put(None)
+
+
+def iter_chord_shards(shard_paths: list, n_jobs=1, max_queue=1024,
+                      chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Iterate over the chord annotations of a corpus split in several files,
+    which are read in parallel by `n_jobs` processes. Records are streamed
+    through a bounded queue, so readers cannot get too far ahead of the
+    consumer, and they are yielded as soon as they are available (i.e. the
+    order of tracks across shards is not preserved).
+
+    Args:
+        shard_paths (list): paths to the shards (JSON or JSON Lines files).
+        n_jobs (int): number of reading processes.
+        max_queue (int): maximum number of records waiting in the queue.
+        chunk_size (int): number of characters to read from a file at once.
+
+    Returns: a generator of (track_name, chords, key) tuples.
+    """
+    if n_jobs <= 1:  # no need for parallel processes
+        for shard_path in shard_paths:
+            yield from iter_chord_records(shard_path, chunk_size)
+        return
+
+    queue = mp.Queue(maxsize=max_queue)
+    workers = [mp.Process(target=_read_shards, daemon=True,
+                          args=(shard_paths[i::n_jobs], queue, chunk_size))
+               for i in range(min(n_jobs, len(shard_paths)))]
+    for worker in workers:
+        worker.start()
+
+    try:
+        running = len(workers)
+        while running > 0:
+            record = queue.get()
+            if record is None:
+                running -= 1
+            elif isinstance(record, Exception):
+                raise record
+            else:
+                yield record
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
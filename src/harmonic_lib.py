@@ -1,6 +1,12 @@
 """
 Utility functions for computing the n-gram-based harmonic similarity.
 """
+import os
+import hashlib
+
+import joblib
+
+import instrumentation
 
 
 def intersection(collection_a, collection_b):
@@ -27,11 +33,17 @@ def ngram_hsim(rpg_a:list, rpg_b:list):
     Computes the degree of maximal repetition from a bag of
     recurring patterns -- a list of tuples.
     """
+    instrumentation.count("similarity", "pairs_evaluated")
+    if len(rpg_a) == 0 or len(rpg_b) == 0:
+        instrumentation.count("similarity", "pairs_empty")
+        return 0., []  # no recurring patterns to compare
+
     degree_a = degree_max_repetition(rpg_a)
     degree_b = degree_max_repetition(rpg_b)
 
     common_rpg = intersection(rpg_a, rpg_b)
     if len(common_rpg) == 0:  # nothing in common
+        instrumentation.count("similarity", "pairs_disjoint")
         return 0., []  # no need to go further
 
     degree_common_rp = degree_max_repetition(common_rpg)
@@ -47,6 +59,66 @@ def ngram_hsim(rpg_a:list, rpg_b:list):
     return (sim_a + sim_b) / 2, longest_common_rps
 
 
+def bag_fingerprint(recpat_bag:list):
+    """
+    Computes a canonical fingerprint of a bag of recurring patterns, which
+    does not depend on the order and multiplicity of the patterns (as the
+    similarity only looks at the set of patterns). Tracks with the same
+    fingerprint will thus have the same similarity with any other track.
+    """
+    canonical = sorted(set(tuple(int(token) for token in recpat)
+                           for recpat in recpat_bag))
+    return hashlib.sha1(repr(canonical).encode("utf-8")).hexdigest()
+
+
+def group_by_fingerprint(track_rpbag:dict):
+    """
+    Groups tracks having the same bag of recurring patterns.
+
+    Returns:
+        A dictionary mapping each distinct fingerprint to the list of tracks
+        having it, in the same order as in `track_rpbag`.
+    """
+    groups = {}
+    for track_id, rpbag in track_rpbag.items():
+        groups.setdefault(bag_fingerprint(rpbag), []).append(track_id)
+    return groups
+
+
+def memoised_hsim(fp_a:str, rpg_a:list, fp_b:str, rpg_b:list, memo:dict,
+                  hsim_fn=ngram_hsim):
+    """
+    Computes the harmonic similarity between two bags of recurring patterns,
+    with fingerprints `fp_a` and `fp_b`, unless already found in the memo.
+    The memo is indexed by the sorted pair of fingerprints, as the similarity
+    is symmetric.
+    """
+    if fp_b < fp_a:  # canonical order of the pair
+        fp_a, rpg_a, fp_b, rpg_b = fp_b, rpg_b, fp_a, rpg_a
+    if (fp_a, fp_b) not in memo:
+        memo[fp_a, fp_b] = hsim_fn(rpg_a, rpg_b)
+    else:
+        instrumentation.count("similarity", "memo_hits")
+    return memo[fp_a, fp_b]
+
+
+def load_pair_memo(memo_path:str):
+    """
+    Loads a memo of harmonic similarities between pairs of fingerprints, which
+    is empty if the file does not exist yet (e.g. at the first run).
+    """
+    if not os.path.exists(memo_path):
+        return {}
+    return joblib.load(memo_path)
+
+
+def save_pair_memo(memo:dict, memo_path:str):
+    """
+    Saves a memo of harmonic similarities, to be reused across runs.
+    """
+    joblib.dump(memo, memo_path)
+
+
 def pairwise_harmonic_similarity(track_rpbag:dict, hsim_fn=ngram_hsim):
     """
     Computes the pair-wise harmonic similarity among tracks.
@@ -0,0 +1,333 @@
+"""
+A scalable builder of the Harmonic Network, the graph of the tracks connected
+by their harmonic similarity, working on edge arrays rather than on nested
+dictionaries (see `visualisation.compute_similarity_graph`). Edges can be
+read from a harmonic similarity map or directly from the sparse matrix of a
+columnar bundle, sparsified with a global threshold and/or by keeping the
+top-k edges of each node, and exported as GraphML or GEXF in a streaming
+fashion. Instead of the decoded patterns, edges hold a reference to the
+entry of the similarity map they come from (its position in the patterns of
+the columnar bundle), which can be resolved on demand with `edge_patterns`
+from the patterns given by `load_patterns`.
+"""
+import gzip
+import argparse
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+import joblib
+import numpy as np
+
+from bundle_lib import is_columnar, ColumnarBundle
+
+GRAPH_FORMATS = ["graphml", "gexf"]
+_CHUNK_SIZE = 10000  # edges formatted and written at once
+
+
+class SimilarityEdges(namedtuple("SimilarityEdges",
+        ["track_ids", "sources", "targets", "weights", "pattern_refs"])):
+    """
+    The undirected edges of the Harmonic Network, as arrays: the positions of
+    the source and target tracks in `track_ids`, the similarity of the pair
+    (the weight), and the entry of the map holding their shared patterns.
+    Edges are oriented as in the similarity map.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.weights)
+
+    def select(self, mask):
+        """
+        Return the edges selected by a boolean mask (or an array of indices).
+        """
+        return SimilarityEdges(self.track_ids, self.sources[mask],
+                               self.targets[mask], self.weights[mask],
+                               self.pattern_refs[mask])
+
+    def nodes(self):
+        """
+        Return the sorted positions of the tracks with at least one edge.
+        """
+        return np.union1d(self.sources, self.targets)
+
+
+def _undirected(track_ids, rows, cols, scores):
+    """
+    Build the edges from the entries of a sparse similarity matrix, keeping
+    the first entry of each pair of tracks (in the order of the map).
+    """
+    pairs = np.minimum(rows, cols) * len(track_ids) + np.maximum(rows, cols)
+    _, first = np.unique(pairs, return_index=True)
+    first.sort()  # edges follow the order of the map
+    return SimilarityEdges(track_ids, rows[first].astype(np.int32),
+                           cols[first].astype(np.int32),
+                           scores[first].astype(np.float64), first)
+
+
+def edges_from_hsim_map(hsim_map: dict):
+    """
+    Extract the edges of a harmonic similarity map, as a nested dictionary
+    where hsim_map[a][b] gives the similarity of a and b and their patterns.
+    Entries are enumerated row by row, as in `bundle_lib.convert_hsim_map`.
+    """
+    hsim_map = hsim_map.get('hsim_map', hsim_map)
+    positions = {track_id: i for i, track_id in enumerate(hsim_map)}
+    rows, cols, scores = [], [], []
+    for i, track_a in enumerate(hsim_map):
+        for track_b, (score, _) in hsim_map[track_a].items():
+            if track_b not in positions:  # only appearing as a column
+                positions[track_b] = len(positions)
+            rows.append(i)
+            cols.append(positions[track_b])
+            scores.append(score)
+    return _undirected(list(positions), np.array(rows, dtype=np.int64),
+                       np.array(cols, dtype=np.int64), np.array(scores))
+
+
+def edges_from_columnar(bundle_path: str):
+    """
+    Extract the edges of a columnar harmonic similarity map, straight from
+    its sparse matrix, without reading the patterns.
+    """
+    bundle = ColumnarBundle(bundle_path)
+    row_offsets = np.asarray(bundle.array("row_offsets"))
+    rows = np.repeat(np.arange(len(row_offsets) - 1), np.diff(row_offsets))
+    return _undirected(bundle.strings("track_ids").tolist(), rows,
+                       np.asarray(bundle.array("cols"), dtype=np.int64),
+                       np.asarray(bundle.array("scores")))
+
+
+def load_edges(hsim_map_path: str):
+    """
+    Extract the edges of a harmonic similarity map from a columnar bundle,
+    or from a joblib file.
+    """
+    if is_columnar(hsim_map_path):
+        return edges_from_columnar(hsim_map_path)
+    return edges_from_hsim_map(joblib.load(hsim_map_path))
+
+
+def sparsify(edges: SimilarityEdges, threshold=None, top_k=None):
+    """
+    Sparsify the Harmonic Network, keeping the edges whose weight is at least
+    `threshold`, and that are among the `top_k` heaviest edges of one of their
+    nodes, at least (ties are broken by the order of the edges).
+
+    Returns: the edges that are kept, in their original order.
+    """
+    if threshold is not None:
+        edges = edges.select(edges.weights >= threshold)
+    if top_k is not None:
+        # Each edge is ranked among those of its source and of its target
+        nodes = np.concatenate([edges.sources, edges.targets])
+        edge_ids = np.tile(np.arange(len(edges)), 2)
+        order = np.lexsort((edge_ids, -np.tile(edges.weights, 2), nodes))
+        nodes, edge_ids = nodes[order], edge_ids[order]
+        group_starts = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+        ranks = np.arange(len(nodes)) - np.repeat(
+            group_starts, np.diff(np.r_[group_starts, len(nodes)]))
+        edges = edges.select(np.unique(edge_ids[ranks < top_k]))
+    return edges
+
+
+class ColumnarPatterns:
+    """
+    The shared patterns of each entry of a columnar harmonic similarity map,
+    indexed by entry (the `pattern_refs` of the edges), and read on access.
+    Patterns made of chord labels are returned as such.
+    """
+
+    def __init__(self, bundle_path: str):
+        bundle = ColumnarBundle(bundle_path)
+        self._patterns = bundle.nested("patterns")
+        self._labels = bundle.strings("labels").tolist() \
+            if bundle.manifest["decoded"] else None
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __getitem__(self, ref):
+        patterns = [pattern.tolist() for pattern in self._patterns[ref]]
+        if self._labels is not None:
+            return [[self._labels[j] for j in pattern] for pattern in patterns]
+        return [tuple(pattern) for pattern in patterns]
+
+
+def patterns_from_hsim_map(hsim_map: dict):
+    """
+    List the shared patterns of each entry of a harmonic similarity map, in
+    the order of `edges_from_hsim_map`, so that they are indexed by entry.
+    """
+    hsim_map = hsim_map.get('hsim_map', hsim_map)
+    return [patterns for row in hsim_map.values()
+            for _, patterns in row.values()]
+
+
+def load_patterns(hsim_map_path: str):
+    """
+    Load the shared patterns of a harmonic similarity map, indexed by entry,
+    from a columnar bundle (read on access), or from a joblib file.
+    """
+    if is_columnar(hsim_map_path):
+        return ColumnarPatterns(hsim_map_path)
+    return patterns_from_hsim_map(joblib.load(hsim_map_path))
+
+
+def edge_patterns(edges: SimilarityEdges, edge: int, patterns, encdec=None):
+    """
+    Resolve the patterns shared by the tracks of an edge, through its
+    `pattern_refs` entry into the patterns of the similarity map (as given by
+    `load_patterns`). If a decoder is provided, patterns are decoded into
+    chord labels.
+    """
+    patterns = patterns[edges.pattern_refs[edge]]
+    if encdec is not None:
+        patterns = [[encdec.decode_event(idx) for idx in pattern]
+                    for pattern in patterns]
+    return patterns
+
+
+def to_networkx(edges: SimilarityEdges):
+    """
+    Create a networkx graph from the edges, where the similarity of each pair
+    is the weight of the edge, and `pattern_ref` the entry of its patterns.
+    """
+    import networkx as nx  # only needed for the analysis of the graph
+    G = nx.Graph()
+    G.add_nodes_from(edges.track_ids[i] for i in edges.nodes())
+    G.add_edges_from(
+        (edges.track_ids[s], edges.track_ids[t], {"weight": w, "pattern_ref": r})
+        for s, t, w, r in zip(edges.sources.tolist(), edges.targets.tolist(),
+                              edges.weights.tolist(), edges.pattern_refs.tolist()))
+    return G
+
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def _chunks(edges: SimilarityEdges):
+    for start in range(0, len(edges), _CHUNK_SIZE):
+        end = start + _CHUNK_SIZE
+        yield start, zip(edges.sources[start:end].tolist(),
+                         edges.targets[start:end].tolist(),
+                         edges.weights[start:end].tolist(),
+                         edges.pattern_refs[start:end].tolist())
+
+
+def write_graphml(edges: SimilarityEdges, out_path: str, node_attributes=None):
+    """
+    Write the Harmonic Network as GraphML (gzipped if the path ends with .gz),
+    where edges are formatted and written in chunks.
+
+    Args:
+        edges (SimilarityEdges): the edges of the network.
+        out_path (str): the path of the GraphML file.
+        node_attributes (dict): optional string attributes of the nodes, as
+            a dictionary of dictionaries, e.g. {"title": {track_id: title}}.
+    """
+    node_attributes = node_attributes or {}
+    with _open_text(out_path) as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        for name in node_attributes:
+            out_file.write(f'<key id={quoteattr(name)} for="node" '
+                           f'attr.name={quoteattr(name)} attr.type="string"/>\n')
+        out_file.write('<key id="weight" for="edge" attr.name="weight" '
+                       'attr.type="double"/>\n<key id="pattern_ref" for="edge" '
+                       'attr.name="pattern_ref" attr.type="long"/>\n'
+                       '<graph edgedefault="undirected">\n')
+        node_ids = [quoteattr(str(track_id)) for track_id in edges.track_ids]
+        for i in edges.nodes().tolist():
+            track_id = edges.track_ids[i]
+            out_file.write(f'<node id={node_ids[i]}>' + "".join(
+                f'<data key={quoteattr(name)}>{escape(str(values[track_id]))}'
+                f'</data>' for name, values in node_attributes.items()
+                if track_id in values) + '</node>\n')
+        for _, chunk in _chunks(edges):
+            out_file.write("".join(
+                f'<edge source={node_ids[s]} target={node_ids[t]}>'
+                f'<data key="weight">{w!r}</data>'
+                f'<data key="pattern_ref">{r}</data></edge>\n'
+                for s, t, w, r in chunk))
+        out_file.write('</graph>\n</graphml>\n')
+
+
+def write_gexf(edges: SimilarityEdges, out_path: str, node_attributes=None):
+    """
+    Write the Harmonic Network as GEXF 1.2 (gzipped if the path ends with .gz),
+    where edges are formatted and written in chunks. Nodes are identified by
+    their position in the track ids, and labelled with the track id.
+
+    Args:
+        edges (SimilarityEdges): the edges of the network.
+        out_path (str): the path of the GEXF file.
+        node_attributes (dict): optional string attributes of the nodes, as
+            a dictionary of dictionaries, e.g. {"title": {track_id: title}}.
+    """
+    node_attributes = node_attributes or {}
+    with _open_text(out_path) as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                       '<graph mode="static" defaultedgetype="undirected">\n')
+        if node_attributes:
+            out_file.write('<attributes class="node">\n' + "".join(
+                f'<attribute id="{j}" title={quoteattr(name)} type="string"/>\n'
+                for j, name in enumerate(node_attributes)) + '</attributes>\n')
+        out_file.write('<attributes class="edge">\n<attribute id="0" '
+                       'title="pattern_ref" type="long"/>\n</attributes>\n'
+                       '<nodes>\n')
+        for i in edges.nodes().tolist():
+            track_id = edges.track_ids[i]
+            values = "".join(
+                f'<attvalue for="{j}" value={quoteattr(str(values[track_id]))}/>'
+                for j, values in enumerate(node_attributes.values())
+                if track_id in values)
+            out_file.write(f'<node id="{i}" label={quoteattr(str(track_id))}>'
+                           + (f'<attvalues>{values}</attvalues>' if values else '')
+                           + '</node>\n')
+        out_file.write('</nodes>\n<edges>\n')
+        for start, chunk in _chunks(edges):
+            out_file.write("".join(
+                f'<edge id="{start + k}" source="{s}" target="{t}" weight="{w!r}">'
+                f'<attvalues><attvalue for="0" value="{r}"/></attvalues></edge>\n'
+                for k, (s, t, w, r) in enumerate(chunk)))
+        out_file.write('</edges>\n</graph>\n</gexf>\n')
+
+
+WRITERS = {"graphml": write_graphml, "gexf": write_gexf}
+
+
+def main():
+    """
+    Main function to parse the arguments and call the main process.
+    """
+    parser = argparse.ArgumentParser(
+        description='Export of the Harmonic Network as a sparse graph.')
+
+    parser.add_argument('hsim_map', action='store', type=str,
+                        help='Path to the harmonic similarity map (joblib or '
+                             'columnar bundle).')
+    parser.add_argument('out_path', action='store', type=str,
+                        help='Path of the graph file (.gz for compression).')
+    parser.add_argument('--format', choices=GRAPH_FORMATS, default='graphml',
+                        help='Format of the graph file.')
+    parser.add_argument('--threshold', action='store', type=float,
+                        help='Minimum similarity of the edges to keep.')
+    parser.add_argument('--top_k', action='store', type=int,
+                        help='Number of heaviest edges to keep for each node.')
+
+    args = parser.parse_args()
+    edges = load_edges(args.hsim_map)
+    num_edges = len(edges)
+    edges = sparsify(edges, args.threshold, args.top_k)
+    WRITERS[args.format](edges, args.out_path)
+    print(f"Harmonic Network with {len(edges.nodes())} nodes and {len(edges)} "
+          f"edges (out of {num_edges}) written in {args.out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Streaming export of the harmonic similarity pairs (harSimPairs), where each
+record is written as soon as it is produced, so that memory does not grow
+with the size of the map. Records can be written as a single JSON document
+(pretty-printed or compact) or as JSON Lines, optionally gzipped, and split
+in shards holding the pairs of a fixed number of tracks. Each file is written
+under a temporary name and renamed when complete: consumers can read the
+shards that are already available before the export finishes.
+"""
+import os
+import gzip
+import json
+
+FORMATS = ["json", "jsonl"]
+MANIFEST_FILE = "manifest.json"
+PARTIAL_SUFFIX = ".part"
+
+_COMPACT = (",", ":")
+
+
+def _open_text(path: str, compress=False):
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+class _RecordFile:
+    """
+    A single output file of records, written under a temporary name until
+    it is closed. In the JSON format, records are enclosed in the harSimPairs
+    list, formatted as `json.dump` would do with the same indentation.
+    """
+
+    def __init__(self, path: str, fmt: str, indent=None):
+        self.path = path
+        self.fmt = fmt
+        self.indent = indent
+        self.num_records = 0
+        self._file = _open_text(path + PARTIAL_SUFFIX, path.endswith(".gz"))
+        if fmt == "json":
+            self._file.write('{"harSimPairs":[' if indent is None else
+                             '{\n' + ' ' * indent + '"harSimPairs": [')
+
+    def write(self, record: dict):
+        if self.fmt == "jsonl":
+            self._file.write(json.dumps(record, separators=_COMPACT) + "\n")
+        elif self.indent is None:
+            if self.num_records > 0:
+                self._file.write(",")
+            self._file.write(json.dumps(record, separators=_COMPACT))
+        else:  # records are nested at the second level
+            prefix = "\n" + " " * (2 * self.indent)
+            self._file.write(("," if self.num_records > 0 else "") + prefix +
+                             json.dumps(record, indent=self.indent)
+                             .replace("\n", prefix))
+        self.num_records += 1
+
+    def close(self):
+        if self.fmt == "json":
+            if self.indent is None:
+                self._file.write("]}")
+            elif self.num_records > 0:
+                self._file.write("\n" + " " * self.indent + "]\n}")
+            else:
+                self._file.write("]\n}")
+        self._file.close()
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+
+    def abort(self):
+        self._file.close()  # the partial file is left for inspection
+
+
+class HarSimPairsWriter:
+    """
+    Writes harSimPairs records one at a time, either to a single file, or to
+    shards in a directory (if `tracks_per_shard` is given), each holding the
+    records of `tracks_per_shard` consecutive tracks (as recordingA). When
+    sharding, a manifest listing the complete shards is written at the end.
+
+    Args:
+        out_path (str): path of the output file, or of the shard directory.
+        fmt (str): "json" for a single document, or "jsonl" for JSON Lines.
+        indent (int): indentation of the JSON document (None for compact).
+        tracks_per_shard (int): number of tracks in each shard, if sharding.
+        compress (bool): whether shards are gzipped (single files are gzipped
+            if their path ends with .gz).
+    """
+
+    def __init__(self, out_path: str, fmt="json", indent=None,
+                 tracks_per_shard=None, compress=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported format {fmt}, choose from {FORMATS}")
+        self.out_path = out_path
+        self.fmt = fmt
+        self.indent = None if fmt == "jsonl" else indent
+        self.tracks_per_shard = tracks_per_shard
+        self.compress = compress
+        self.shards = []  # (file name, number of records) of complete shards
+        self._current, self._track, self._num_tracks = None, None, 0
+        if tracks_per_shard is None:
+            self._current = _RecordFile(out_path, fmt, self.indent)
+        else:
+            os.makedirs(out_path, exist_ok=True)
+
+    def _shard_name(self):
+        extension = ".jsonl" if self.fmt == "jsonl" else ".json"
+        return f"harsim-{len(self.shards):05d}{extension}" + \
+            (".gz" if self.compress else "")
+
+    def _close_shard(self):
+        self._current.close()
+        self.shards.append((os.path.basename(self._current.path),
+                            self._current.num_records))
+        self._current = None
+
+    def write(self, record: dict):
+        if self.tracks_per_shard is not None and \
+                record["recordingA"] != self._track:
+            self._track = record["recordingA"]
+            self._num_tracks += 1
+            if self._num_tracks > self.tracks_per_shard:
+                self._close_shard()
+                self._num_tracks = 1
+            if self._current is None:
+                self._current = _RecordFile(os.path.join(
+                    self.out_path, self._shard_name()), self.fmt, self.indent)
+        self._current.write(record)
+
+    def close(self):
+        if self.tracks_per_shard is None:
+            self._current.close()
+            return
+        if self._current is not None:
+            self._close_shard()
+        with open(os.path.join(self.out_path, MANIFEST_FILE), "w") as mf:
+            json.dump({"format": self.fmt, "shards": [
+                {"file": name, "records": num_records}
+                for name, num_records in self.shards]}, mf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._current is not None:  # incomplete files are not renamed
+            self._current.abort()
+        return False
@@ -0,0 +1,276 @@
+"""
+Instrumentation of the pipeline stages: timers and counters per stage (and
+optionally per track), peak memory tracking through `tracemalloc`, and
+profiling of chosen stages with `cProfile`. Everything is collected in a
+single report that can be saved as JSON. Instrumentation is disabled by
+default, and hooks then reduce to a check of a module-level flag; it can be
+enabled with `enable`, or by setting the LHARP_INSTRUMENT environment
+variable to the path where the report is saved at exit (where "{pid}" is
+replaced by the id of the process, to also keep the reports of workers).
+Tasks running on worker processes can also collect their stage times and
+counters apart, with `collecting`, and send them back to the main process,
+where they are merged in its report with `merge`.
+
+Usage:
+    with instrumentation.timer("similarity"):
+        ...
+    instrumentation.count("similarity", "pairs")
+"""
+import io
+import os
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import tracemalloc
+import multiprocessing
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+
+REPORT_FORMAT_VERSION = 1
+ENV_VARIABLE = "LHARP_INSTRUMENT"
+_PROFILE_TOP = 25  # functions listed in the report for each profile
+
+ENABLED = False
+_config = {}
+_stages = {}  # stage -> {"calls", "total_s", "max_s", "peak_bytes", ...}
+_counters = {}  # stage -> counter -> value
+_tracks = {}  # stage -> track -> seconds, if per-track timing is enabled
+_profiles = {}  # stage -> cProfile.Profile
+_active = []  # stack of [stage, peak of nested stages] being timed
+_null_timer = nullcontext()
+
+
+def enable(per_track=False, memory=False, profile=()):
+    """
+    Enable the instrumentation, clearing what was collected before.
+
+    Args:
+        per_track (bool): whether the time of each track is also recorded.
+        memory (bool): whether the peak memory of each stage is tracked with
+            `tracemalloc` (this slows down allocations considerably).
+        profile (iterable): names of the stages to profile with `cProfile`.
+    """
+    global ENABLED
+    reset()
+    _config.update(per_track=per_track, memory=memory, profile=set(profile))
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    ENABLED = True
+
+
+def disable():
+    """
+    Disable the instrumentation, keeping what was collected for the report.
+    """
+    global ENABLED
+    ENABLED = False
+    if _config.get("memory") and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset():
+    for collected in (_stages, _counters, _tracks, _profiles):
+        collected.clear()
+    _active.clear()
+
+
+def timer(stage: str, track=None):
+    """
+    A context manager timing a stage (and a track of it, if given). Nested
+    timers are supported, e.g. a stage running within another stage.
+    """
+    if not ENABLED:
+        return _null_timer
+    return _timer(stage, track)
+
+
+def _reset_peak():
+    """
+    Reset the peak of the traced memory, where supported (Python 3.9+), and
+    return the current and peak traced memory at the start of a stage.
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()
+
+
+def _stage_peak(start_memory):
+    """
+    Return the peak memory of a stage, given the traced memory at its start:
+    if the peak could not be reset and was not exceeded by the stage, this
+    is the largest of its start and end memory (a lower bound).
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    if peak > start_memory[1]:
+        return peak
+    return max(start_memory[0], current)
+
+
+def _stage_stats(stage):
+    return _stages.setdefault(stage, {"calls": 0, "total_s": 0., "max_s": 0.})
+
+
+@contextmanager
+def _timer(stage, track):
+    profile = None
+    if stage in _config["profile"] and \
+            all(frame[0] != stage for frame in _active):
+        profile = _profiles.setdefault(stage, cProfile.Profile())
+    memory = _config["memory"] and tracemalloc.is_tracing()
+    if memory:  # peaks are measured from the start of the stage
+        start_memory = _reset_peak()
+
+    frame = [stage, 0]  # with the peak memory of the nested stages
+    _active.append(frame)
+    if profile is not None:
+        profile.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+        _active.pop()
+
+        stats = _stage_stats(stage)
+        stats["calls"] += 1
+        stats["total_s"] += elapsed
+        stats["max_s"] = max(stats["max_s"], elapsed)
+        if memory:
+            peak = max(_stage_peak(start_memory), frame[1])
+            stats["peak_bytes"] = max(stats.get("peak_bytes", 0), peak)
+            if _active:  # the peak was reset for the enclosing stage too
+                _active[-1][1] = max(_active[-1][1], peak)
+        if track is not None and _config["per_track"]:
+            tracks = _tracks.setdefault(stage, {})
+            tracks[track] = tracks.get(track, 0.) + elapsed
+
+
+def timed(stage: str):
+    """
+    A decorator timing each call of a function as the given stage.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _timer(stage, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(stage: str, counter: str, value=1):
+    """
+    Increment a counter of a stage (e.g. the number of pairs evaluated).
+    """
+    if ENABLED:
+        counters = _counters.setdefault(stage, {})
+        counters[counter] = counters.get(counter, 0) + value
+
+
+def add_time(stage: str, seconds: float, calls=1, max_s=None):
+    """
+    Record time that was measured elsewhere (e.g. in worker processes), over
+    the given number of calls, the longest of which took `max_s` seconds (by
+    default, the average time of the calls).
+    """
+    if ENABLED:
+        stats = _stage_stats(stage)
+        stats["calls"] += calls
+        stats["total_s"] += seconds
+        stats["max_s"] = max(stats["max_s"],
+                             seconds / calls if max_s is None else max_s)
+
+
+@contextmanager
+def collecting():
+    """
+    A context manager collecting the stage times and counters of a block
+    apart from the rest of the report, e.g. in a task running on a worker
+    process. It yields a dictionary, holding what was collected at exit,
+    which can be sent back to the main process and merged with `merge`.
+    Workers only collect if the instrumentation is enabled in their process
+    (e.g. if they were forked after `enable`).
+    """
+    collected = {"stages": {}, "counters": {}}
+    stages, counters = dict(_stages), dict(_counters)
+    _stages.clear()
+    _counters.clear()
+    try:
+        yield collected
+    finally:
+        collected["stages"].update(_stages)
+        collected["counters"].update(_counters)
+        _stages.clear()
+        _stages.update(stages)
+        _counters.clear()
+        _counters.update(counters)
+
+
+def merge(collected: dict):
+    """
+    Merge the stage times and counters collected apart (see `collecting`).
+    """
+    for stage, stats in collected["stages"].items():
+        add_time(stage, stats["total_s"], stats["calls"], stats["max_s"])
+    for stage, counters in collected["counters"].items():
+        for counter, value in counters.items():
+            count(stage, counter, value)
+
+
+def _profile_summary(profile):
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    summary = []
+    for func, (_, ncalls, tottime, cumtime, _) in sorted(
+            stats.stats.items(), key=lambda item: -item[1][3])[:_PROFILE_TOP]:
+        summary.append({"function": "%s:%d(%s)" % func, "calls": ncalls,
+                        "tottime_s": tottime, "cumtime_s": cumtime})
+    return summary
+
+
+def report(**extra):
+    """
+    Return the report of what was collected, as a JSON-serialisable dict;
+    additional entries (e.g. the parameters of the run) can be given.
+    """
+    return {
+        "version": REPORT_FORMAT_VERSION,
+        "config": {name: sorted(value) if isinstance(value, set) else value
+                   for name, value in _config.items()},
+        "stages": _stages,
+        "counters": _counters,
+        "tracks": _tracks,
+        "profiles": {stage: _profile_summary(profile)
+                     for stage, profile in _profiles.items()},
+        **extra,
+    }
+
+
+def save_report(report_path: str, **extra):
+    """
+    Save the report as JSON, and the raw profile of each profiled stage next
+    to it (as <report>.<stage>.prof, to be inspected with pstats/snakeviz).
+    """
+    with open(report_path, "w") as report_file:
+        json.dump(report(**extra), report_file, indent=2)
+    for stage, profile in _profiles.items():
+        profile.dump_stats(f"{os.path.splitext(report_path)[0]}.{stage}.prof")
+
+
+def _save_report_at_exit(report_path):
+    # Worker processes inherit the variable, but only the main process saves
+    # its report, unless the path holds a {pid} field (one report each)
+    if "{pid}" in report_path:
+        save_report(report_path.format(pid=os.getpid()))
+    elif multiprocessing.current_process().name == "MainProcess":
+        save_report(report_path)
+
+
+if os.environ.get(ENV_VARIABLE):  # e.g. for production runs
+    enable(per_track=True)
+    atexit.register(_save_report_at_exit, os.environ[ENV_VARIABLE])
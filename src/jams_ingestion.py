@@ -0,0 +1,163 @@
+"""
+Bulk ingestion of chord datasets annotated in JAMS format (e.g. Isophonics,
+Schubert-Winterreise, and JAAH), producing a single data bundle aligned with
+the dataset metadata (see setup/sonar_datasets_meta.csv).
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from ngrams_lib import save_joblib
+from utils import is_file
+
+DIRS_NAME = ['isophonics', 'schubert-winterreise', 'jaah']
+NAMESPACES = ['chord', 'key_mode']
+
+
+def jams_alignment_key(jams_path: str):
+    """
+    Return the portion of a JAMS path that is used to align it with the paths
+    in the metadata, which is relative to the "annotations" directory.
+    """
+    return jams_path.split('annotations')[1]
+
+
+def index_jams(jams_path: str, dirs_name: list = DIRS_NAME):
+    """
+    Walk the annotation tree once, and index the JAMS files found in the given
+    dataset directories by their alignment key (see `jams_alignment_key`).
+
+    Args:
+        jams_path (str): root directory of the annotations.
+        dirs_name (list): names of the dataset directories to include.
+
+    Returns: a dictionary mapping each alignment key to the JAMS file path.
+    """
+    jams_index = {}
+    for path, dirs, _ in os.walk(jams_path):
+        for dir in dirs:
+            if dir in dirs_name:
+                for fn in os.listdir(f"{path}/{dir}"):
+                    jams_file = f"{path}/{dir}/{fn}"
+                    jams_index[jams_alignment_key(jams_file)] = jams_file
+    return jams_index
+
+
+def align_jams(jams_index: dict, meta_path: str):
+    """
+    Align the metadata with the indexed JAMS files, through a single lookup
+    for each track in the metadata.
+
+    Returns: the ids of the tracks having a JAMS file, and the JAMS paths.
+    """
+    meta = pd.read_csv(meta_path)
+    tr_names, valid_paths = [], []
+    for track_id, meta_path in zip(meta['id'].tolist(), meta['path'].tolist()):
+        jams_file = jams_index.get(jams_alignment_key(meta_path))
+        if jams_file is not None:
+            tr_names.append(track_id)
+            valid_paths.append(jams_file)
+    return tr_names, valid_paths
+
+
+def parse_jams(jams_path: str, namespaces: list = NAMESPACES):
+    """
+    Parse a JAMS file, extracting only the observations of the given
+    namespaces into compact arrays: a list of values and an array of times.
+
+    Returns: a dictionary with a (values, times) tuple for each namespace.
+    """
+    with open(jams_path, 'r') as jf:
+        jams_data = json.load(jf)
+
+    parsed = {namespace: ([], []) for namespace in namespaces}
+    for annotation in jams_data['annotations']:
+        if annotation['namespace'] in parsed:
+            values, times = parsed[annotation['namespace']]
+            for observation in annotation['data']:
+                values.append(observation['value'])
+                times.append(observation['time'])
+
+    return {namespace: (values, np.array(times, dtype=np.float64))
+            for namespace, (values, times) in parsed.items()}
+
+
+def ingest_jams(jams_path: str, meta_path: str, n_jobs=1, dirs_name=DIRS_NAME):
+    """
+    Index, align and parse all the JAMS files of a collection, where files
+    are parsed in parallel on a pool of `n_jobs` processes.
+
+    Returns: a dictionary mapping the id of each track in the metadata (if
+        found) to its parsed annotations, as returned by `parse_jams`.
+    """
+    jams_index = index_jams(jams_path, dirs_name)
+    tr_names, valid_paths = align_jams(jams_index, meta_path)
+
+    parsed = Parallel(n_jobs=n_jobs, batch_size=32)(
+        delayed(parse_jams)(jams_file) for jams_file in valid_paths)
+
+    return dict(zip(tr_names, parsed))
+
+
+def build_databundle(jams_path: str, meta_path: str, out_path=None, n_jobs=1,
+                     dirs_name=DIRS_NAME):
+    """
+    Create a data bundle from a JAMS collection, holding the chord ('preproc')
+    and key ('keys') annotations of each track as (value, time) tuples, in the
+    same order as the metadata. Tracks without a JAMS file are not included.
+
+    Args:
+        jams_path (str): root directory of the annotations.
+        meta_path (str): path to the CSV file with the dataset metadata.
+        out_path (str): where the data bundle is saved, if given.
+        n_jobs (int): number of processes used to parse the JAMS files.
+        dirs_name (list): names of the dataset directories to include.
+
+    Returns: the data bundle, as a dictionary.
+    """
+    ingested = ingest_jams(jams_path, meta_path, n_jobs, dirs_name)
+
+    databundle = {'preproc': {}, 'keys': {}}
+    for track_id, annotations in ingested.items():
+        chords, chord_times = annotations['chord']
+        keys, key_times = annotations['key_mode']
+        databundle['preproc'][track_id] = list(zip(chords, chord_times.tolist()))
+        databundle['keys'][track_id] = list(zip(keys, key_times.tolist()))
+
+    if out_path is not None:
+        save_joblib(databundle, out_path)
+
+    return databundle
+
+
+def main():
+    """
+    Main function to parse the arguments and call the main process.
+    """
+    parser = argparse.ArgumentParser(
+        description='Bulk ingestion of chord datasets in JAMS format.')
+
+    parser.add_argument('jams_path', action='store', type=str,
+                        help='Root directory of the JAMS annotations.')
+    parser.add_argument('meta_path', type=lambda x: is_file(parser, x),
+                        help='Path to the CSV file with the datasets metadata.')
+    parser.add_argument('out_path', action='store', type=str,
+                        help='Path of the data bundle that will be created.')
+    parser.add_argument('--datasets', nargs='+', default=DIRS_NAME,
+                        help='Names of the dataset directories to ingest.')
+    parser.add_argument('--n_jobs', action='store', type=int, default=1,
+                        help='Number of processes used to parse JAMS files.')
+
+    args = parser.parse_args()
+
+    databundle = build_databundle(args.jams_path, args.meta_path,
+        args.out_path, n_jobs=args.n_jobs, dirs_name=args.datasets)
+    print(f"Ingested {len(databundle['preproc'])} tracks in {args.out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,472 @@
+"""
+End-to-end runner of the harmonic similarity pipeline on a corpus directory:
+ingest -> normalise -> encode -> extract -> similarity -> export. Tracks are
+streamed through the stages, so that parsing, normalisation and extraction of
+different tracks overlap on a pool of worker processes, whereas the encoding
+is done in the main process (as it grows the vocabulary). Only a bounded
+number of tracks is in flight at any time, so that memory does not depend on
+the size of the corpus. The similarity stage starts once all the bags of
+recurring patterns are available, and is parallelised over blocks of rows.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import joblib
+
+import instrumentation
+from chord_encodings import DecompositionOneHotEncoding, merge_reports
+from chord_encodings import RelativeChordOneHotEncoding
+from corpus_reader import iter_chord_records
+from harmonic_lib import ngram_hsim, group_by_fingerprint
+from jams_ingestion import parse_jams
+from lharp_api import reduce_chord_sequence, has_known_key
+from lharp_api import normalise_chord_sequence, encode_chord_sequence
+from lharp_api import expand_similarity
+from ngrams_lib import extract_ngrams, save_joblib
+from utils import create_dir
+
+logger = logging.getLogger("hsimilarity.lharp")
+
+STAGES = ["ingest", "normalise", "encode", "extract", "similarity", "export"]
+ENCODERS = ["decomposition", "relative"]
+
+_JAMS_EXTENSIONS = (".jams",)
+_CORPUS_EXTENSIONS = (".json", ".jsonl", ".ndjson")
+_BLOCKS_PER_WORKER = 4  # for load balancing in the similarity stage
+
+
+class _InlineExecutor:
+    """
+    An executor running each task as soon as it is submitted, which is used
+    in place of a pool of processes when a single worker is requested.
+    """
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _executor(workers, **kwargs):
+    return ProcessPoolExecutor(workers, **kwargs) if workers > 1 \
+        else _InlineExecutor(**kwargs)
+
+
+def find_corpus_files(corpus_dir: str):
+    """
+    Walk the corpus directory, looking for JAMS files and chord corpora in
+    JSON or JSON Lines format (optionally gzipped), in a deterministic order.
+
+    Returns: a tuple with the list of JAMS paths and that of corpus paths.
+    """
+    jams_paths, corpus_paths = [], []
+    for path, dirs, files in os.walk(corpus_dir):
+        dirs.sort()  # walk sub-directories in sorted order too
+        for fname in sorted(files):
+            base = fname[:-3] if fname.endswith(".gz") else fname
+            if base.endswith(_JAMS_EXTENSIONS):
+                jams_paths.append(os.path.join(path, fname))
+            elif base.endswith(_CORPUS_EXTENSIONS):
+                corpus_paths.append(os.path.join(path, fname))
+    return jams_paths, corpus_paths
+
+
+def iter_corpus_sources(corpus_dir: str, chunk_size: int):
+    """
+    Iterate over the tracks of a corpus directory, as the sources to ingest:
+    either ("jams", track_name, path) tuples, where the JAMS file is parsed by
+    the workers, or ("record", track_name, (chords, key)) tuples, for tracks
+    that are streamed from JSON corpora (see `corpus_reader`).
+    """
+    jams_paths, corpus_paths = find_corpus_files(corpus_dir)
+    for jams_path in jams_paths:
+        track_name = os.path.splitext(os.path.relpath(jams_path, corpus_dir))[0]
+        yield "jams", track_name, jams_path
+    for corpus_path in corpus_paths:
+        for track_name, chords, key in iter_chord_records(corpus_path, chunk_size):
+            yield "record", track_name, (chords, key)
+
+
+def iter_databundle_sources(databundle_path: str):
+    """
+    Iterate over the tracks of a chord data bundle, such as
+    setup/sonar_databundle.joblib, with the chord annotations in 'preproc'
+    and the key annotations in 'keys', as ("record", track_name, (chords,
+    key)) sources.
+    """
+    databundle = joblib.load(databundle_path)
+    keys = databundle["keys"]
+    for track_name, chords in databundle["preproc"].items():
+        yield "record", track_name, (chords, keys.get(track_name, []))
+
+
+def _ingest_normalise(kind: str, track_name: str, source, relative: bool,
+                      fail_soft=False):
+    """
+    Worker task of the first two stages: parse the annotations of a track (if
+    needed), and perform the harmonic reduction of the chord sequence, which
+    is then transposed to the tonic unless chords are encoded relatively (see
+    `lharp_api.normalise_chord_sequence`).
+
+    Returns: the track name, the normalised chord labels (None if the track
+        has no known key), the fail-soft report of the labels that could not
+        be transposed, and the time spent in each of the two stages.
+    """
+    start = time.perf_counter()
+    if kind == "jams":
+        annotations = parse_jams(source)
+        chords = list(zip(*annotations["chord"]))
+        key = list(zip(*annotations["key_mode"]))
+    else:  # already parsed by the corpus reader
+        chords, key = source
+    ingested = time.perf_counter()
+
+    chords, report = reduce_chord_sequence(chords), {}
+    if not relative:  # normalisation at the tonic-level
+        chords = normalise_chord_sequence(chords, key, fail_soft, report) \
+            if has_known_key(key) else None
+
+    return track_name, chords, report, ingested - start, \
+        time.perf_counter() - ingested
+
+
+def _extract(track_name: str, tokens: list, min_order: int):
+    """
+    Worker task of the extraction stage, returning the bag of recurring
+    patterns of the track, the time spent on it, and its instrumentation.
+    """
+    start = time.perf_counter()
+    with instrumentation.collecting() as collected:
+        bag = extract_ngrams(track_name, tokens, n_start=min_order)[track_name]
+    return track_name, bag, time.perf_counter() - start, collected
+
+
+class _TrackEncoder:
+    """
+    Encoder of the normalised tracks, holding the token of each label seen so
+    far. New labels are added to the vocabulary of decomposition encoders.
+    """
+
+    def __init__(self, encdec, fail_soft=False):
+        self.encdec = encdec
+        self.fail_soft = fail_soft
+        self.report = {}  # labels that were simplified or dropped
+        self.label_tokens = {}
+        self.grow = isinstance(encdec, DecompositionOneHotEncoding)
+
+    def _grow_vocabulary(self, chords: list):
+        for label in dict.fromkeys(chords):  # in order of occurrence
+            if label not in self.label_tokens and \
+                    label not in self.encdec.chord_to_hash:
+                try:
+                    self.encdec.update_vocabulary([label])
+                except Exception:  # illegal label, see _encode_label_soft
+                    pass
+
+    def __call__(self, track_name: str, chords: list):
+        if isinstance(self.encdec, RelativeChordOneHotEncoding):
+            return self.encdec.encode_corpus(
+                {track_name: chords}, self.fail_soft, self.report).tokens
+
+        if self.grow:
+            self._grow_vocabulary(chords)
+        return encode_chord_sequence(chords, self.encdec, self.label_tokens,
+                                     self.fail_soft, self.report)
+
+
+def run_tracks(sources, encoder, workers=1, min_order=3, relative=False,
+               queue_size=64, timings=None):
+    """
+    Run the ingest, normalise, encode and extract stages on all the tracks,
+    in a pipelined fashion: at most `queue_size` tracks are waiting for each
+    of the stages running on the workers, and tracks are encoded (in order)
+    as soon as they have been normalised.
+
+    Args:
+        sources (iterable): the tracks to process, see `iter_corpus_sources`.
+        encoder (_TrackEncoder): the encoder of the normalised tracks.
+        workers (int): number of worker processes.
+        min_order (int): the minimum length of recurring patterns to extract.
+        relative (bool): whether chords are encoded relatively.
+        queue_size (int): maximum number of in-flight tracks for each stage.
+        timings (dict): accumulates the time spent in each stage.
+
+    Returns: the encoded tracks and their bags of recurring patterns, in the
+        same order as the sources (tracks without a key are skipped).
+    """
+    timings = {} if timings is None else timings
+    for stage in STAGES[:4]:
+        timings.setdefault(stage, 0.)
+    encoded, bags = {}, {}
+    normalising, extracting = deque(), deque()
+
+    def on_extracted(track_name, bag, elapsed, collected):
+        bags[track_name] = bag
+        timings["extract"] += elapsed
+        instrumentation.add_time("extract", elapsed)
+        instrumentation.merge(collected)
+
+    def on_normalised(track_name, chords, report, t_ingest, t_norm):
+        timings["ingest"] += t_ingest
+        timings["normalise"] += t_norm
+        instrumentation.add_time("ingest", t_ingest)
+        instrumentation.add_time("normalise", t_norm)
+        merge_reports(encoder.report, report)
+        if chords is None:
+            logger.warning(f"Skipping {track_name}: no key annotation")
+            return
+        start = time.perf_counter()
+        with instrumentation.timer("encode", track_name):
+            encoded[track_name] = encoder(track_name, chords)
+        timings["encode"] += time.perf_counter() - start
+        _drain(extracting, on_extracted, queue_size - 1)
+        extracting.append(pool.submit(_extract, track_name,
+                                      encoded[track_name].tolist(), min_order))
+
+    with _executor(workers) as pool:
+        sources = iter(sources)
+        while True:
+            start = time.perf_counter()
+            source = next(sources, None)  # reading of streamed corpora
+            timings["ingest"] += time.perf_counter() - start
+            if source is None:
+                break
+            # Backpressure: wait for the oldest track if the queue is full
+            _drain(normalising, on_normalised, queue_size - 1)
+            normalising.append(pool.submit(_ingest_normalise, *source,
+                                           relative, encoder.fail_soft))
+            _drain(extracting, on_extracted, queue_size)
+
+        _drain(normalising, on_normalised, 0)
+        _drain(extracting, on_extracted, 0)
+
+    # Bags are collected in completion order, so the source order is restored
+    return encoded, {track_name: bags[track_name] for track_name in encoded}
+
+
+def _drain(queue: deque, callback, max_size: int):
+    """
+    Pass the results of the completed tasks at the head of the queue to the
+    callback, waiting for the oldest ones until at most `max_size` are left.
+    """
+    while queue and (len(queue) > max_size or queue[0].done()):
+        callback(*queue.popleft().result())
+
+
+_sim_bags, _sim_sizes = None, None  # set in each worker of the similarity
+
+
+def _init_similarity(bags: list, sizes: list):
+    global _sim_bags, _sim_sizes
+    _sim_bags, _sim_sizes = bags, sizes
+
+
+def _similarity_rows(offset: int, step: int, min_score: float):
+    """
+    Worker task of the similarity stage, comparing the bags of rows offset,
+    offset + step, ... with all the following ones (and with themselves, when
+    the bag is shared by more than one track). Interleaving the rows balances
+    the triangular workload across tasks.
+
+    Returns: the (i, j, hsim, longest_rps) matches with hsim >= min_score,
+        the time spent on them, and the instrumentation of the task.
+    """
+    start = time.perf_counter()
+    matches = []
+    with instrumentation.collecting() as collected:
+        for i in range(offset, len(_sim_bags), step):
+            for j in range(i, len(_sim_bags)):
+                if i == j and _sim_sizes[i] < 2:
+                    continue  # a track is not compared with itself
+                hsim, longest_rps = ngram_hsim(_sim_bags[i], _sim_bags[j])
+                if hsim > 0. and hsim >= min_score:
+                    matches.append((i, j, hsim, longest_rps))
+    return matches, time.perf_counter() - start, collected
+
+
+def harmonic_similarity(chords_recpat: dict, encdec, workers=1, min_score=0.,
+                        duplicate=True, timings=None):
+    """
+    Compute the harmonic similarity map of the given tracks, as done by
+    `lharp_api.harmonic_similarity_intra` with deduplication of the bags of
+    recurring patterns, but in parallel over blocks of rows.
+
+    Args:
+        chords_recpat (dict): the recurring patterns of each track.
+        encdec (EncoderDecoder): used to decode the longest shared patterns.
+        workers (int): number of worker processes.
+        min_score (float): the minimum similarity of the pairs to keep.
+        duplicate (bool): whether the map is made symmetric.
+        timings (dict): accumulates the time spent in the similarity stage.
+
+    Returns: the hsim_map, with the (hsim, longest_rps) of each pair of tracks
+        having a strictly positive similarity not lower than `min_score`.
+    """
+    timings = {} if timings is None else timings
+    groups = group_by_fingerprint(chords_recpat)
+    tracks = list(groups.values())  # tracks sharing each distinct bag
+    bags = [chords_recpat[group[0]] for group in tracks]
+    sizes = [len(group) for group in tracks]
+    positions = {track_id: i for i, track_id in enumerate(chords_recpat)}
+    hsim_map = {track_id: {} for track_id in chords_recpat}
+
+    num_blocks = max(1, min(len(bags), workers * _BLOCKS_PER_WORKER))
+    with _executor(workers, initializer=_init_similarity,
+                   initargs=(bags, sizes)) as pool:
+        blocks = [pool.submit(_similarity_rows, offset, num_blocks, min_score)
+                  for offset in range(num_blocks)]
+        for block in blocks:
+            matches, elapsed, collected = block.result()
+            timings["similarity"] = timings.get("similarity", 0.) + elapsed
+            # Summed across workers, apart from the elapsed similarity stage
+            instrumentation.add_time("similarity_rows", elapsed)
+            instrumentation.merge(collected)
+            for i, j, hsim, longest_rps in matches:
+                expand_similarity(hsim_map, tracks[i], tracks[j], hsim,
+                                  longest_rps, encdec, duplicate, positions,
+                                  same_bag=i == j)
+
+    return hsim_map
+
+
+def export_outputs(out_dir: str, encoded: dict, chords_recpat: dict,
+                   hsim_map: dict, encdec, report: dict = None):
+    """
+    Save the outputs of the pipeline in the given directory, in the same
+    formats as the setup bundles: the encoding bundle, the recurring patterns
+    (as `ngrams_lib.process_ngrams`), and the harmonic similarity map. The
+    vocabulary of decomposition encoders, and the report of the labels that
+    were simplified or dropped (if any) are also saved as JSON files.
+    """
+    save_joblib({"encoded": {track_id: tokens.tolist() for track_id, tokens
+                             in encoded.items()}, "encoder_decoder": encdec},
+                os.path.join(out_dir, "encoding_bundle.joblib"))
+    save_joblib([{track_id: bag} for track_id, bag in chords_recpat.items()],
+                os.path.join(out_dir, "ngrams.joblib"))
+    save_joblib({"hsim_map": hsim_map}, os.path.join(out_dir, "hsim_map.joblib"))
+
+    if isinstance(encdec, DecompositionOneHotEncoding):
+        encdec.save_vocabulary(os.path.join(out_dir, "vocabulary.json"))
+    if report:
+        with open(os.path.join(out_dir, "fail_soft_report.json"), "w") as rf:
+            json.dump(report, rf, indent=2)
+
+
+def run_pipeline(corpus_dir: str, out_dir: str, encdec, workers=1,
+                 min_score=0., min_order=3, fail_soft=False, queue_size=64,
+                 chunk_size=1 << 16):
+    """
+    Run the whole pipeline on a corpus directory (or on a chord data bundle,
+    see `iter_databundle_sources`), and export its outputs.
+
+    Returns: a dictionary with the time spent in each stage, where the time
+        of the stages running on the workers is summed across processes,
+        and "total" is the elapsed (wall-clock) time of the whole run.
+    """
+    start = time.perf_counter()
+    timings = {stage: 0. for stage in STAGES}
+    relative = isinstance(encdec, RelativeChordOneHotEncoding)
+    encoder = _TrackEncoder(encdec, fail_soft)
+
+    sources = iter_databundle_sources(corpus_dir) \
+        if corpus_dir.endswith(".joblib") else \
+        iter_corpus_sources(corpus_dir, chunk_size)
+    encoded, chords_recpat = run_tracks(sources, encoder, workers,
+        min_order, relative, queue_size, timings)
+    logger.info(f"Processed {len(encoded)} tracks")
+    with instrumentation.timer("similarity"):
+        hsim_map = harmonic_similarity(
+            chords_recpat, encdec, workers, min_score, timings=timings)
+
+    export_start = time.perf_counter()
+    with instrumentation.timer("export"):
+        export_outputs(out_dir, encoded, chords_recpat, hsim_map, encdec,
+                       encoder.report)
+    timings["export"] = time.perf_counter() - export_start
+    timings["total"] = time.perf_counter() - start
+
+    with open(os.path.join(out_dir, "timings.json"), "w") as tf:
+        json.dump(timings, tf, indent=2)
+    return timings
+
+
+def main():
+    """
+    Main function to parse the arguments and call the main process.
+    """
+    parser = argparse.ArgumentParser(
+        description='Run the harmonic similarity pipeline on a corpus.')
+
+    parser.add_argument('corpus_dir', action='store', type=str,
+                        help='Directory with JAMS files or JSON chord corpora '
+                             '(or a chord data bundle, in joblib).')
+    parser.add_argument('out_dir', action='store', type=str,
+                        help='Directory where the outputs will be saved.')
+    parser.add_argument('--workers', action='store', type=int, default=1,
+                        help='Number of worker processes.')
+    parser.add_argument('--min-score', action='store', type=float, default=0.,
+                        help='Minimum harmonic similarity of the pairs to keep.')
+    parser.add_argument('--min-order', action='store', type=int, default=3,
+                        help='Minimum length of the recurring patterns.')
+    parser.add_argument('--encoder', choices=ENCODERS, default=ENCODERS[0],
+                        help='Encoding of the chords: key-based decomposition '
+                             'or relative to the previous chord.')
+    parser.add_argument('--vocabulary', action='store', type=str,
+                        help='Initial vocabulary of the decomposition encoder.')
+    parser.add_argument('--fail-soft', action='store_true', default=False,
+                        help='Simplify or drop illegal chords, not aborting.')
+    parser.add_argument('--queue-size', action='store', type=int, default=64,
+                        help='Maximum number of in-flight tracks per stage.')
+    parser.add_argument('--report', action='store', type=str,
+                        help='Path of the JSON instrumentation report.')
+    parser.add_argument('--profile', nargs='+', default=[],
+                        help='Stages to profile with cProfile (with --report).')
+    parser.add_argument('--trace-memory', action='store_true', default=False,
+                        help='Track the peak memory of stages (with --report).')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.path.isdir(args.corpus_dir) and not (
+            args.corpus_dir.endswith(".joblib") and os.path.isfile(args.corpus_dir)):
+        parser.error(f"The directory {args.corpus_dir} does not exist!")
+    create_dir(args.out_dir)
+    if args.encoder == "relative":
+        encdec = RelativeChordOneHotEncoding()
+    elif args.vocabulary is not None:
+        encdec = DecompositionOneHotEncoding.load_vocabulary(args.vocabulary)
+    else:  # the vocabulary is built from the corpus
+        encdec = DecompositionOneHotEncoding()
+
+    if args.report is not None:  # workers send their stats back
+        instrumentation.enable(per_track=True, memory=args.trace_memory,
+                               profile=args.profile)
+    timings = run_pipeline(args.corpus_dir, args.out_dir, encdec, args.workers,
+        args.min_score, args.min_order, args.fail_soft, args.queue_size)
+
+    if args.report is not None:
+        instrumentation.save_report(args.report, timings=timings,
+                                    args=vars(args))
+
+    print(f"{'stage':<12}{'seconds':>10}")
+    for stage, elapsed in timings.items():
+        print(f"{stage:<12}{elapsed:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
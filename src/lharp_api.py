@@ -2,11 +2,28 @@
 A collection of simplified functions to compute the LRP harmonic similarity.
 '''
 
+import sys
+import logging
+from functools import lru_cache
+
+import numpy as np
 from ChordalPy.Transposers import transpose
 
+import chord_lib
+import instrumentation
+import ngrams_lib
+import chord_encodings
+from stage_cache import fingerprint, code_version
+from utils import remove_consecutive_repeats
+from chord_lib import strip_chord_bass
 from ngrams_lib import extract_ngrams
-from harmonic_lib import ngram_hsim
-from chord_encodings import ChordEncodingError
+from harmonic_lib import ngram_hsim, group_by_fingerprint, memoised_hsim
+from chord_encodings import ChordEncodingError, coarsening_map, update_report
+from chord_encodings import TriadChordOneHotEncoding, RootChordOneHotEncoding
+from chord_encodings import QualityChordOneHotEncoding
+from chord_encodings import RelativeChordOneHotEncoding
+
+logger = logging.getLogger("hsimilarity.lharp_api")
 
 
 CHORD_MAP = {
@@ -22,7 +39,9 @@ def preprocess_chord_sequences(chord_json:str):
     key information). This is needed to avoid encoding issues.
 
     Args:
-        - chord_json (str): path to a JSON file with chord annotations.
+        - chord_json (dict): the chord annotations, indexed by track id, or an
+            iterable of (track_name, chords, key) records, as those streamed
+            by `corpus_reader.iter_chord_records`.
     
     Returns:
         - a dictionary with the pre-processed annotations, indexed by
@@ -39,11 +58,11 @@ def preprocess_chord_sequences(chord_json:str):
     chord_pproc = {}
     key_dict = {}
 
-    for track_name, track_ann in chord_json.items():
-        key_dict[track_name] = track_ann["key"]
+    for track_name, track_chords, track_key in _iter_chord_records(chord_json):
+        key_dict[track_name] = track_key
         chord_pproc[track_name] = []
         # Pre-process one after the other
-        for chord in track_ann["chord"]:
+        for chord in track_chords:
             chord_class = chord[0]  # just keep the label
             chord_class = CHORD_MAP.get(chord_class, chord_class)
             chord_pproc[track_name].append(chord_class)
@@ -51,6 +70,17 @@ def preprocess_chord_sequences(chord_json:str):
     return chord_pproc, key_dict
 
 
+def _iter_chord_records(chord_json):
+    """
+    Iterate over (track_name, chords, key) records, from either a dictionary
+    of chord annotations or an iterable of records (returned as it is).
+    """
+    if not isinstance(chord_json, dict):
+        return iter(chord_json)
+    return ((track_name, track_ann["chord"], track_ann["key"])
+            for track_name, track_ann in chord_json.items())
+
+
 def normalise_chord_sequences(chord_dict:dict, key_dict:dict):
     """
     Normalise each chord annotation by transposing the harmonic
@@ -88,38 +118,79 @@ def normalise_chord_sequences(chord_dict:dict, key_dict:dict):
     return chord_transp
 
 
-def encode_chord_sequences(chord_norm:dict, encdec):
+def relativise_chord_sequences(chord_dict:dict, encdec=None):
+    """
+    Alternative to the key-based normalisation (and encoding) of chord
+    sequences, where each chord is encoded relative to the previous one, as
+    the interval between their roots and the quality of the chord. This makes
+    the harmonic similarity invariant to transpositions by construction, so
+    key annotations are not needed and no chord is transposed.
+
+    Args:
+        chord_dict (dict): a dictionary holding the pre-processed chord
+            sequences, where each element is indexed by track id.
+        encdec (RelativeChordOneHotEncoding): the relative encoder-decoder to
+            use, which is also needed to decode the patterns in the hsim_map.
+
+    Returns: an `EncodedCorpus` with the relative chord tokens, which can be
+        passed to `extract_recurring_pattern`.
+    """
+    encdec = RelativeChordOneHotEncoding() if encdec is None else encdec
+    return encdec.encode_corpus(chord_dict)
+
+
+def encode_chord_sequences(chord_norm:dict, encdec, fail_soft=False,
+                           report:dict=None):
     """
     Encode sequences of chord symbols/labels expressed in Harte notation,
     using the given encoder-decoder instance (arbitrary chord encodings
     are thus supported). If an illegal chord label is found (one that
-    cannot be encoded) an error is thrown and a message is printed.
+    cannot be encoded) an error is thrown, unless `fail_soft` is set.
 
     Args:
         - chord_norm (dict): pre-processed and normalised chord sequences,
             indexed by track id in the dictionary.
         - encdec (EncoderDecoder): an instance of an encoder-decoder that
             transforms a chord label into an integer number (one-hot).
+        - fail_soft (bool): whether illegal chord labels should be replaced
+            by their simplest encodable simplification (dropping alterations,
+            then extensions, then falling back to the triad), or dropped.
+        - report (dict): an optional dictionary that, if `fail_soft` is set,
+            will be updated with the labels that had to be simplified/dropped
+            (see `chord_encodings.update_report`).
 
     Returns: a dictionary with the encoded chord sequences.
 
-    Notes
-        - This should simply throw an exception rather than printing.
+    Notes:
+        - Use `encode_chord_corpus` to keep the encoded sequences in a
+            single contiguous array, rather than in lists.
     """
-    chord_encoded = {}
+    return encode_chord_corpus(chord_norm, encdec, fail_soft, report).to_dict()
 
-    for track_name, chords in chord_norm.items():
-        chord_encoded[track_name] = []
-        for chord in chords:  # iterating over chords
-            try:  # attempting encoding, if possible
-                hash = encdec._compute_chord_hash(chord)
-                token = encdec.hash_to_index[hash]
-                chord_encoded[track_name].append(token)
-            except:  # this should abort the whole process
-                print(f"Could not encode: {chord}")
-                raise ChordEncodingError(chord)
-    
-    return chord_encoded
+
+def encode_chord_corpus(chord_norm:dict, encdec, fail_soft=False,
+                        report:dict=None):
+    """
+    Encode sequences of chord labels in batch, as in `encode_chord_sequences`,
+    but returning an `EncodedCorpus`: a contiguous int32 array of tokens with
+    the offsets of each track, which can be passed as is to the extraction of
+    recurring patterns. Each distinct label is encoded only once.
+
+    Args:
+        - chord_norm (dict): pre-processed and normalised chord sequences,
+            indexed by track id in the dictionary.
+        - encdec (EncoderDecoder): an encoder-decoder supporting batch
+            encoding (see `chord_encodings.CorpusEncodingMixin`).
+        - fail_soft (bool): whether illegal chord labels are simplified or
+            dropped (and reported) instead of aborting the encoding.
+        - report (dict): an optional dictionary that, if `fail_soft` is set,
+            will be updated with the labels that had to be simplified/dropped.
+
+    Returns: an `EncodedCorpus` with the encoded chord sequences.
+    """
+    with instrumentation.timer("encode"):
+        instrumentation.count("encode", "tracks", len(chord_norm))
+        return encdec.encode_corpus(chord_norm, fail_soft, report)
 
 
 def extract_recurring_pattern(chord_enc:dict, min_order=3):
@@ -128,7 +199,8 @@ def extract_recurring_pattern(chord_enc:dict, min_order=3):
     excluding patterns of lower order.
 
     Args:
-        chord_enc (dict): encoded chord sequences indexed by track id.
+        chord_enc (dict): encoded chord sequences indexed by track id, or an
+            `EncodedCorpus` as returned by `encode_chord_corpus`.
         min_order (int): the minimum length of full repetitions to extract.
 
     Returns: a dictionary with all the recurring patterns for each track.
@@ -137,8 +209,9 @@ def extract_recurring_pattern(chord_enc:dict, min_order=3):
     recurring_patterns = {}  # per-track bag of recurring patterns
 
     for track_name, chords in chord_enc.items():
-        recurring_patterns.update(extract_ngrams(
-            track_name, chords, n_start=3))
+        with instrumentation.timer("extract", track_name):
+            recurring_patterns.update(extract_ngrams(
+                track_name, chords, n_start=min_order))
 
     return recurring_patterns
 
@@ -154,8 +227,10 @@ def dictionarify_recpat_data(recpat_data):
                 if not isinstance(recpat_data, dict) else recpat_data
 
 
+@instrumentation.timed("similarity")
 def harmonic_similarity_inter(
-    chords_recpat_in:dict, chords_recpat_target:dict, encdec, duplicate=False):
+    chords_recpat_in:dict, chords_recpat_target:dict, encdec, duplicate=False,
+    dedup=False, memo:dict=None):
     """
     Compute the harmonic similarity of a new group of tracks with pieces that
     have already been processed (e.g. in previous study).
@@ -168,6 +243,12 @@ def harmonic_similarity_inter(
             convert the longest shared recurring patterns in the output map.
         - duplicate (bool): whether the harmonic similarity map to return is
             made symmetric -- entries are replicated (A[i,j] == A[j,i]). 
+        - dedup (bool): whether tracks with the same bag of recurring patterns
+            are grouped, so that the similarity is computed (and decoded) only
+            once for each distinct pair of bags (see `bag_fingerprint`).
+        - memo (dict): an optional memo of similarities between fingerprints,
+            which implies `dedup` and can be persisted across runs (see
+            `harmonic_lib.load_pair_memo` and `harmonic_lib.save_pair_memo`).
     
     Returns: the hsim_map, a matrix encoding the pair-wise harmonic similarity
         among tracks in `chords_recpat_in` and those in `chords_recpat_target`.
@@ -180,6 +261,9 @@ def harmonic_similarity_inter(
         - Include a parameter for making the dictionary simmetric, meaning
             that entries are replicated (A[i,j] == A[j,i]). 
     """
+    if dedup or memo is not None:
+        return _harmonic_similarity_dedup(chords_recpat_in,
+            chords_recpat_target, encdec, duplicate, memo, intra=False)
     hsim_map = {id: {} for id in list(chords_recpat_in.keys())}
 
     for track_name, track_brps in chords_recpat_in.items():
@@ -188,6 +272,8 @@ def harmonic_similarity_inter(
             hsim, longest_rps = ngram_hsim(track_brps, target_brps)
             longest_rps = [[encdec.decode_event(idx) for idx in lsrp_shot] \
                 for lsrp_shot in longest_rps]  # keep and decode
+            instrumentation.count("similarity", "decode_calls",
+                                  sum(map(len, longest_rps)))
             if hsim > 0.:  # save only non-trivial similarities
                 hsim_map[track_name][target_name] = hsim, longest_rps
                 if duplicate:  # replicate the hsim info if needed
@@ -196,7 +282,9 @@ def harmonic_similarity_inter(
     return hsim_map
 
 
-def harmonic_similarity_intra(chords_recpat:dict, encdec, duplicate=True):
+@instrumentation.timed("similarity")
+def harmonic_similarity_intra(chords_recpat:dict, encdec, duplicate=True,
+                              dedup=False, memo:dict=None):
     """
     Compute the pair-wise harmonic similarity between tracks, for which their
     recurring patterns are provided. The similarity value, together with the
@@ -211,11 +299,19 @@ def harmonic_similarity_intra(chords_recpat:dict, encdec, duplicate=True):
             convert the longest shared recurring patterns in the output map.
         - duplicate (bool): whether the harmonic similarity map to return is
             made symmetric -- entries are replicated (A[i,j] == A[j,i]).
+        - dedup (bool): whether tracks with the same bag of recurring patterns
+            (e.g. covers, or duplicated datasets) are grouped, so that the
+            similarity is computed only once for each distinct pair of bags.
+        - memo (dict): an optional memo of similarities between fingerprints,
+            which implies `dedup` and can be persisted across runs.
 
     Returns: the hsim_map, a matrix encoding the pair-wise harmonic similarity
         among tracks in `chords_recpat`, including the longest shared recurring
         pattern on which the similarity is based (useful for interpretation).
     """
+    if dedup or memo is not None:
+        return _harmonic_similarity_dedup(chords_recpat, chords_recpat,
+            encdec, duplicate, memo, intra=True)
     track_ids = list(chords_recpat.keys())
     hsim_map = {track_id: {} for track_id in track_ids}
 
@@ -228,6 +324,8 @@ def harmonic_similarity_intra(chords_recpat:dict, encdec, duplicate=True):
             hsim, longest_rps = ngram_hsim(a_rpbag, b_rpbag)
             longest_rps = [[encdec.decode_event(idx) for idx in lsrp_shot] \
                 for lsrp_shot in longest_rps]  # keep and decode patterns
+            instrumentation.count("similarity", "decode_calls",
+                                  sum(map(len, longest_rps)))
             if hsim > 0.:  # populate the matrix only non-trivial
                 hsim_map[track_a][track_b] = hsim, longest_rps
                 if duplicate:  # replicate the hsim info if needed
@@ -235,3 +333,318 @@ def harmonic_similarity_intra(chords_recpat:dict, encdec, duplicate=True):
 
     return hsim_map
 
+
+
+def _harmonic_similarity_dedup(
+    chords_recpat_a:dict, chords_recpat_b:dict, encdec, duplicate=True,
+    memo:dict=None, intra=True):
+    """
+    Compute the harmonic similarity map as `harmonic_similarity_intra` (if
+    `intra`) or `harmonic_similarity_inter`, but only once for each distinct
+    pair of bags of recurring patterns; results are then expanded to all the
+    pairs of tracks having those bags.
+    """
+    memo = {} if memo is None else memo
+    groups_a = group_by_fingerprint(chords_recpat_a)
+    groups_b = groups_a if intra else group_by_fingerprint(chords_recpat_b)
+    positions = {track_id: i for i, track_id in enumerate(chords_recpat_a)}
+    hsim_map = {track_id: {} for track_id in chords_recpat_a}
+
+    fps_a, fps_b = list(groups_a), list(groups_b)
+    for x, fp_a in enumerate(fps_a):
+        tracks_a = groups_a[fp_a]
+        # In the intra case, each unordered pair of fingerprints is seen once
+        for fp_b in (fps_b[x:] if intra else fps_b):
+            tracks_b = groups_b[fp_b]
+            if intra and fp_a == fp_b and len(tracks_a) < 2:
+                continue  # a track is not compared with itself
+            hsim, longest_rps = memoised_hsim(
+                fp_a, chords_recpat_a[tracks_a[0]],
+                fp_b, chords_recpat_b[tracks_b[0]], memo)
+            if hsim <= 0.:  # populate the matrix only non-trivial
+                continue
+            expand_similarity(hsim_map, tracks_a, tracks_b, hsim, longest_rps,
+                              encdec, duplicate, positions if intra else None,
+                              same_bag=fp_a == fp_b)
+
+    return hsim_map
+
+
+def expand_similarity(hsim_map:dict, tracks_a:list, tracks_b:list, hsim,
+                      longest_rps, encdec, duplicate=True, positions=None,
+                      same_bag=False):
+    """
+    Save the similarity of a pair of bags of recurring patterns in the map,
+    for all the pairs of tracks having those bags, where the longest shared
+    patterns are decoded only once. In the intra case, given the `positions`
+    of the tracks, each pair is saved as (earlier, later), and tracks sharing
+    the same bag (`same_bag`) are not compared with themselves.
+    """
+    longest_rps = [[encdec.decode_event(idx) for idx in lsrp_shot] \
+        for lsrp_shot in longest_rps]  # decoded once per pair
+    instrumentation.count("similarity", "decode_calls",
+                          sum(map(len, longest_rps)))
+    for track_a in tracks_a:
+        for track_b in tracks_b:
+            first, second = track_a, track_b
+            if positions is not None:  # each pair as (earlier, later)
+                if positions[track_a] >= positions[track_b]:
+                    if same_bag:
+                        continue  # itself, or seen the other way
+                    first, second = track_b, track_a
+            hsim_map[first][second] = hsim, longest_rps
+            if duplicate:  # replicate the hsim info if needed
+                hsim_map.setdefault(second, {})[first] = hsim, longest_rps
+
+
+def encode_multi_resolution(
+    chord_norm:dict, encdec, coarse_encdecs:dict=None, fail_soft=False,
+    collapse_repeats=True):
+    """
+    Encode the chord sequences once at the finest level (e.g. through the
+    chord decomposition), and derive coarser views of the corpus by mapping
+    tokens through precomputed token -> token maps, with no further parsing.
+
+    Args:
+        - chord_norm (dict): pre-processed and normalised chord sequences,
+            indexed by track id in the dictionary.
+        - encdec (EncoderDecoder): the encoder-decoder of the finest level.
+        - coarse_encdecs (dict): the coarser encoder-decoders indexed by the
+            name of the view; by default, triad, root and quality views.
+        - fail_soft (bool): whether illegal labels are simplified or dropped
+            rather than aborting the encoding (see `encode_chord_corpus`).
+        - collapse_repeats (bool): whether consecutive repetitions produced
+            by the coarser encodings should be collapsed into one token.
+
+    Returns: a dictionary mapping the name of each view to a tuple with the
+        `EncodedCorpus` and the encoder-decoder of the view. The finest view
+        is always included, with name "fine".
+    """
+    if coarse_encdecs is None:  # default views
+        coarse_encdecs = {"triad": TriadChordOneHotEncoding(),
+                          "root": RootChordOneHotEncoding(),
+                          "quality": QualityChordOneHotEncoding()}
+
+    chord_corpus = encode_chord_corpus(chord_norm, encdec, fail_soft)
+    chord_views = {"fine": (chord_corpus, encdec)}
+
+    for view_name, coarse_encdec in coarse_encdecs.items():
+        lookup = coarsening_map(encdec, coarse_encdec)
+        chord_views[view_name] = chord_corpus.remap(
+            lookup, collapse_repeats=collapse_repeats), coarse_encdec
+
+    return chord_views
+
+
+def harmonic_similarity_multi(chord_views:dict, min_order=3, duplicate=True):
+    """
+    Extract the recurring patterns and compute the pair-wise harmonic
+    similarity for several views (encodings) of the same corpus in one job.
+
+    Args:
+        - chord_views (dict): a tuple with an `EncodedCorpus` and the related
+            encoder-decoder for each view, as given by `encode_multi_resolution`.
+        - min_order (int): the minimum length of recurring patterns to extract.
+        - duplicate (bool): whether the harmonic similarity maps to return are
+            made symmetric -- entries are replicated (A[i,j] == A[j,i]).
+
+    Returns: a dictionary with the hsim_map of each view.
+    """
+    hsim_maps = {}
+    for view_name, (chord_corpus, encdec) in chord_views.items():
+        chords_recpat = extract_recurring_pattern(chord_corpus, min_order)
+        hsim_maps[view_name] = harmonic_similarity_intra(
+            chords_recpat, encdec, duplicate=duplicate)
+
+    return hsim_maps
+
+
+def reduce_chord_sequence(track_chords:list):
+    """
+    Harmonic reduction of a single chord annotation, given as a list of
+    (chord, time) tuples: the chord-map fix-ups are applied, bass notes are
+    removed, and consecutive repetitions are then collapsed.
+
+    Returns: the list of reduced chord labels.
+    """
+    chords = [CHORD_MAP.get(chord[0], chord[0]) for chord in track_chords]
+    chords = [strip_chord_bass(chord) for chord in chords]
+    return remove_consecutive_repeats(chords)
+
+
+NO_CHORD_SYMBOLS = ("N", "X")  # no-chord and unknown chord, in Harte
+
+
+@lru_cache(maxsize=None)
+def transpose_label(chord:str, tonic:str):
+    """
+    Transpose a chord label at the tonic-level, where shorthand labels with
+    no quality (e.g. 'Db' or 'Db/5') are first written in Harte form, as the
+    transposer expects a root and a quality; no-chord symbols are returned
+    unchanged. As the transposer may spell the new root with a run of
+    accidentals (e.g. 'B###########'), these roots are respelled. Results are
+    memoised, as labels and keys are shared across tracks.
+    """
+    if chord in NO_CHORD_SYMBOLS:
+        return chord
+    if ":" not in chord:
+        chord = strip_chord_bass(chord) + ":maj"
+    root, quality = transpose(chord, tonic).split(":", 1)
+    if len(root) > 2:  # more than one accidental
+        pitch_class = chord_lib.natural_to_hsteps[root[0]] \
+            + root.count("#") - root.count("b")
+        root = chord_encodings._PITCH_CLASS_MAPPING[
+            pitch_class % chord_encodings.NOTES_PER_OCTAVE]
+    return f"{root}:{quality}"
+
+
+def track_tonic(track_key:list):
+    """
+    Return the tonic of the first global key annotation of a track, which is
+    the one used for the key-based normalisation.
+    """
+    return track_key[0][0].split(":")[0]
+
+
+def has_known_key(track_key:list):
+    """
+    Whether a track has a key annotation with a known tonic, which is needed
+    for the key-based normalisation; tracks without one are skipped.
+    """
+    return len(track_key) > 0 and track_tonic(track_key) not in NO_CHORD_SYMBOLS
+
+
+def normalise_chord_sequence(chords:list, track_key:list, fail_soft=False,
+                             report:dict=None):
+    """
+    Transpose a reduced chord sequence to the tonic of its key annotation
+    (see `transpose_label`), which has to be known (see `has_known_key`).
+    Chords that cannot be transposed raise a `ChordEncodingError`, unless
+    `fail_soft` is set: they are then dropped, and reported with the
+    "transposition" rule.
+
+    Returns: the list of transposed chord labels.
+    """
+    tonic, transposed = track_tonic(track_key), []
+    for chord in chords:
+        try:
+            transposed.append(transpose_label(chord, tonic))
+        except Exception:
+            if not fail_soft:
+                raise ChordEncodingError(chord)
+            update_report(report, chord, None, "transposition")
+    return transposed
+
+
+def encode_chord_sequence(chords:list, encdec, label_tokens:dict,
+                          fail_soft=False, report:dict=None):
+    """
+    Encode the normalised chord labels of a track one by one, where the token
+    of each label (and how it was resolved, if it could not be encoded as it
+    is) is memoised in `label_tokens`, which can be shared across tracks.
+    Labels that are simplified or dropped are reported at each occurrence.
+
+    Returns: an int32 array with the tokens, without the dropped labels.
+    """
+    tokens = []
+    for chord in chords:
+        if chord not in label_tokens:
+            label_tokens[chord] = _encode_label_soft(chord, encdec, fail_soft)
+        token, resolution = label_tokens[chord]
+        if resolution is not None:
+            update_report(report, chord, *resolution)
+        if token >= 0:
+            tokens.append(token)
+    return np.array(tokens, dtype=np.int32)
+
+
+def iter_chord_pipeline(
+    chord_json:dict, encdec, min_order=3, relative=False, fail_soft=False,
+    report:dict=None, cache=None):
+    """
+    Run the whole pre-processing pipeline, one track at a time, in a single
+    pass: chord-map fix-ups, removal of bass notes and consecutive repeats,
+    normalisation, encoding, and extraction of the recurring patterns. As no
+    intermediate data structure is kept for the whole corpus, memory is only
+    bounded by the largest track. Chord labels are only transposed once for
+    each key they occur in, and encoded once. Unless chords are encoded
+    relatively, tracks without a known key are skipped (with a warning).
+
+    Args:
+        - chord_json (dict): the chord annotations indexed by track id, or
+            an iterable of records, as expected by `preprocess_chord_sequences`
+            (e.g. streamed from disk by `corpus_reader.iter_chord_records`).
+        - encdec (EncoderDecoder): the encoder-decoder for the chord tokens;
+            this has to be a `RelativeChordOneHotEncoding` if `relative`.
+        - min_order (int): the minimum length of recurring patterns to extract.
+        - relative (bool): whether chord sequences are encoded relatively
+            (see `relativise_chord_sequences`) rather than by key-based
+            normalisation and encoding.
+        - fail_soft (bool): whether illegal chord labels are simplified or
+            dropped instead of aborting (see `encode_chord_sequences`).
+        - report (dict): an optional dictionary that, if `fail_soft` is set,
+            will be updated with the labels that had to be simplified/dropped
+            (see `chord_encodings.update_report`).
+        - cache (StageCache): an optional cache of the outputs of each track,
+            keyed by the annotations of the track, the encoder vocabulary, the
+            other parameters and the code version; only tracks that are not
+            in the cache are processed (and reported).
+
+    Returns: a generator of (track_id, tokens, bag) tuples, where tokens is an
+        int32 array and bag is the list of recurring patterns of the track.
+    """
+    assert min_order > 1, "Order needs to be strictly greater than 1."
+    label_tokens = {}  # holds the token of each normalised label
+    if cache is not None:  # shared by the keys of all tracks
+        params = fingerprint(encdec, min_order, relative, fail_soft)
+        code = code_version(sys.modules[__name__],
+                            chord_lib, chord_encodings, ngrams_lib)
+
+    for track_name, track_chords, track_key in _iter_chord_records(chord_json):
+        if cache is not None:
+            track_hash = cache.key("pipeline",
+                (track_name, track_chords, track_key), params, code)
+            track_output = cache.get(track_hash)
+            if track_output is not None:
+                instrumentation.count("pipeline", "cache_hits")
+                yield (track_name,) + track_output
+                continue
+
+        # Only the processing is timed, not the consumer of the generator
+        with instrumentation.timer("pipeline", track_name):
+            chords = reduce_chord_sequence(track_chords)
+
+            if relative:  # no transposition is needed here
+                tokens = encdec.encode_corpus(
+                    {track_name: chords}, fail_soft, report).tokens
+            elif not has_known_key(track_key):
+                logger.warning(f"Skipping {track_name}: no key annotation")
+                instrumentation.count("pipeline", "skipped_tracks")
+                continue
+            else:  # transposition only at the tonic-level
+                chords = normalise_chord_sequence(
+                    chords, track_key, fail_soft, report)
+                tokens = encode_chord_sequence(
+                    chords, encdec, label_tokens, fail_soft, report)
+
+            bag = extract_ngrams(track_name, tokens.tolist(), n_start=min_order)
+            if cache is not None:
+                cache.put(track_hash, (tokens, bag[track_name]))
+        yield track_name, tokens, bag[track_name]
+
+
+def _encode_label_soft(chord, encdec, fail_soft=False):
+    """
+    Encode a single chord label, falling back to its simplifications if the
+    label is illegal and `fail_soft` is set; -1 is returned if these fail.
+
+    Returns: the token, and a (simplified, rule) tuple if the label could not
+        be encoded as it is (see `CorpusEncodingMixin._resolve_label`).
+    """
+    try:
+        return encdec._encode_label(chord), None
+    except Exception:
+        if not fail_soft:
+            raise ChordEncodingError(chord)
+        simplified, rule, token = encdec._resolve_label(chord)
+        return -1 if token is None else token, (simplified, rule)
@@ -4,6 +4,9 @@ import joblib
 import pandas as pd
 from nltk import ngrams as nltk_ngrams
 
+import instrumentation
+from bundle_lib import is_columnar, open_chord_columnar, open_ngram_columnar
+
 DATABUNDLE_PATH = "../setup/sonar_databundle.joblib"
 OUTPUT_FILE = "../sonar_ngrams.joblib"  # name of the joblib output file
 
@@ -53,6 +56,8 @@ def extract_ngrams(track_name: str, sequence: list, n_start: int = 2):
             else:
                 break
     search_ngrams(sequence, n_start)
+    instrumentation.count("extract", "tracks")
+    instrumentation.count("extract", "patterns", len(all_track_ngrams))
     return {track_name: all_track_ngrams}
 
 
@@ -104,7 +109,10 @@ def open_chord(chords_path: str):
     dicts
         returns two dictionaries containing raw chords and encoded chords, respectively. The dictionaries have
         the following structure: key=track name, value=list of tuples.
+        If chords_path is a columnar bundle, a read-only mapping is returned.
     """
+    if is_columnar(chords_path):
+        return open_chord_columnar(chords_path)
     with open(chords_path, "rb") as cd:
         chords = joblib.load(cd)
     raw_chord = chords['preproc']
@@ -124,7 +132,10 @@ def open_ngram(ngram_path: str):
     dict
         returns a dictionary containing all the ngrams. The dictionary has
         the following structure: key=track name, value=list of tuples.
+        If ngram_path is a columnar bundle, a read-only mapping is returned.
     """
+    if is_columnar(ngram_path):
+        return open_ngram_columnar(ngram_path)
     with open(ngram_path, "rb") as fo:
         ngrams_bag = joblib.load(fo)
     ngrams_bag_dict = {list(track_dict.keys())[0]: track_dict[list(track_dict.keys())[0]] for track_dict in ngrams_bag}
@@ -1,157 +1,317 @@
 from ngrams_lib import *
 from utils import convert_time
+from bundle_lib import is_columnar, open_encoded_columnar, open_hsim_map_columnar
+from harsim_writer import HarSimPairsWriter
+import os
 import random
-import json
+from joblib import Parallel, delayed
 
 HSIM_ENCODING_BUNDLE = '../setup/sonar_hsim_map_global.joblib'
 
 
 def open_encoded(encoded_path):
+    if is_columnar(encoded_path):
+        return open_encoded_columnar(encoded_path)
     with open(encoded_path, "rb") as eb:
         enc = joblib.load(eb)
         return enc['encoded']
 
 
 def open_hsim_map(hsim_map_path):
+    if is_columnar(hsim_map_path):
+        return open_hsim_map_columnar(hsim_map_path)
     with open(hsim_map_path, "rb") as cd:
         data = joblib.load(cd)
         return data
 
 
-def align_data(hsim_map, encoded_chord, track_title):
-    all_all = []
+class AlignmentIndex:
+    """Per-track data needed to align the patterns of a harmonic similarity map
+    with the raw chord annotations, which is built once for each track (when
+    first needed) rather than for each pair of tracks.
+    Parameters
+    ----------
+    track_ids: list
+        the ids of the tracks in the metadata
+    raw_chords: dict
+        a dictionary with key=track name and value=list of (chord, time) tuples
+    encoded_chords: dict
+        a dictionary with key=track name and value=list of encoded chords
+    """
+
+    def __init__(self, track_ids, raw_chords, encoded_chords):
+        self.position = {track_id: i for i, track_id in enumerate(track_ids)}
+        self.raw_chords = raw_chords
+        self.encoded_chords = encoded_chords
+        self._tracks = {}
+
+    def track(self, tr_name):
+        """Returns the alignment data of a track, as a dictionary holding its
+        chords, timestamps (also formatted as strings), its encoded sequence,
+        and the offsets of its n-grams (filled on demand).
+        """
+        if tr_name not in self._tracks:
+            if tr_name not in self.position:
+                raise ValueError(f"{tr_name} is not in the metadata")
+            tr_raw = self.raw_chords[tr_name]
+            timestamps = [t for c, t in tr_raw]
+            self._tracks[tr_name] = {
+                "chords": [c for c, t in tr_raw],
+                "timestamps": timestamps,
+                "times": [convert_time(t) for t in timestamps],
+                "encoded": [int(c) for c in self.encoded_chords[tr_name]],
+                "offsets": {},  # n-gram length -> n-gram -> first offset
+            }
+        return self._tracks[tr_name]
+
+    def ngram_offset(self, tr_name, n_gram):
+        """Returns the position of the first occurrence of the n-gram in the
+        encoded sequence of the track, as `ngrams_lib.single_ngram_position`.
+        """
+        track = self.track(tr_name)
+        length = len(n_gram)
+        if length not in track["offsets"]:
+            offsets, encoded = {}, track["encoded"]
+            for i in range(len(encoded) - length + 1):
+                offsets.setdefault(tuple(encoded[i:i + length]), i)
+            track["offsets"][length] = offsets
+        try:
+            return track["offsets"][length][tuple(n_gram)], length
+        except KeyError:
+            raise ValueError(f"{n_gram} is not in the sequence of {tr_name}")
+
+
+def align_pair(index, tr_name, m, sim_val, patterns):
+    """Aligns the shared patterns of a pair of tracks with their raw chords,
+    producing the corresponding record of the harSimPairs export.
+    """
+    track_a, track_b = index.track(tr_name), index.track(m)
+    patterns_index_a = [index.ngram_offset(tr_name, pattern) for pattern in patterns]
+    patterns_index_b = [index.ngram_offset(m, pattern) for pattern in patterns]
+    pattern_raw_a = [track_a["chords"][i:i + l] for i, l in patterns_index_a]
+    pattern_raw_b = [track_b["chords"][i:i + l] for i, l in patterns_index_b]
+    if patterns:  # the times of the first pattern are used for all matches
+        i, l = patterns_index_a[0]
+        start_a, end_a = track_a["times"][i], track_a["times"][i + l]
+        i, l = patterns_index_b[0]
+        start_b, end_b = track_b["times"][i], track_b["times"][i + l]
+
+    cp_matches = []
+    for num in range(len(pattern_raw_a)):
+        cp_matches.append({"cpMatchId": f"{num + 1:05d}",
+                           "humanSimScore": None,
+                           'cpaA': {
+                               "id": tr_name + '_' + '_'.join(pattern_raw_a[num]),
+                               "start": start_a,
+                               "end": end_a,
+                           },
+                           'cpaB': {
+                               "id": m + '_' + '_'.join(pattern_raw_b[num]),
+                               "start": start_b,
+                               "end": end_b,
+                           }
+                           })
+
+    return {'recordingA': tr_name,
+            'recordingB': m,
+            'compSimScore': sim_val,
+            'cpMatches': cp_matches}
+
+
+def iter_aligned_pairs(hsim_map, index):
+    """Generates the harSimPairs records of the harmonic similarity map one at a
+    time, in the order of the map (all the pairs of a track are consecutive).
+    """
     for tr_name in hsim_map['hsim_map']:
         maps = hsim_map['hsim_map'][tr_name]
         for m in maps:
-            file_id_a = ids.index(tr_name)
-            file_id_b = ids.index(m)
-            id1 = track_title[file_id_a]
-            if type(id1) != float:
-                id_a = ''.join([i for i in id1 if not i.isdigit()]).replace('-', '').replace('_', '').replace('CD', '') \
-                    .replace('BackInTheU.S.S.R.', 'BackInTheUSSR')
-                # if id_a in spoty_names:
-                #     point_a = spoty_names.index(id_a)
-                #     s_id_a = spoty_uri[point_a]
-                # else:
-                #     s_id_a = None
-            id2 = track_title[file_id_b]
-            if type(id2) != float:
-                id_b = ''.join([i for i in id2 if not i.isdigit()]).replace('-', '').replace('_', '').replace('CD', '') \
-                    .replace('BackInTheU.S.S.R.', 'BackInTheUSSR')
-                # if id_b in spoty_names:
-                #     point_b = spoty_names.index(id_b)
-                #     s_id_b = spoty_uri[point_b]
-                # else:
-                #     s_id_b = None
-
-            # print(id_b)
-            # spotify_link_a = get_spotify_link(path_a)
-
             sim_val, patterns = maps[m]
-            tr_raw_a = raw[tr_name]
-            tr_raw_b = raw[m]
-            encoded_ch_a = encoded_chord[tr_name]
-            encoded_ch_b = encoded_chord[m]
-            chords_a = [c for c, t in tr_raw_a]
-            chords_b = [c for c, t in tr_raw_b]
-            timestamps_a = [t for c, t in tr_raw_a]
-            timestamps_b = [t for c, t in tr_raw_b]
-            patterns_index_a = [single_ngram_position(encoded_ch_a, pattern) for pattern in patterns]
-            patterns_index_b = [single_ngram_position(encoded_ch_b, pattern) for pattern in patterns]
-            pattern_raw_a = [chords_a[i:i + l] for i, l in patterns_index_a]
-            pattern_raw_b = [chords_b[i:i + l] for i, l in patterns_index_b]
-            pattern_time_a = [(convert_time(timestamps_a[i]), convert_time(timestamps_a[i + l])) for i, l in
-                              patterns_index_a]
-            pattern_time_b = [(convert_time(timestamps_b[i]), convert_time(timestamps_b[i + l])) for i, l in
-                              patterns_index_b]
-            pattern_times_a = [(timestamps_a[i: i + l + 1]) for i, l in
-                               patterns_index_a]
-            pattern_times_b = [(timestamps_b[i: i + l + 1]) for i, l in
-                               patterns_index_b]
-
-            sc_link_a = [f"https://soundcloud.com/jacopo-de-berardinis/{tr_name.replace('_', '-')}#t={timestamps_a[i]}"
-                         for i, l in patterns_index_a]
-            sc_link_b = [f"https://soundcloud.com/jacopo-de-berardinis/{m.replace('_', '-')}#t={timestamps_b[i]}"
-                         for i, l in patterns_index_b]
-
-            cp_matches = []
-            for i, num in enumerate(range(len(pattern_raw_a))):
-                all = [tr_name,
-                       m,
-                       pattern_raw_a[num],
-                       pattern_raw_b[num],
-                       pattern_time_a[num],
-                       pattern_time_b[num],
-                       ''.join(str(_) for _ in sc_link_a[num]),
-                       ''.join(str(_) for _ in sc_link_b[num]),
-                       # s_id_a,
-                       # s_id_b,
-                       None,
-                       None]
-
-                cp_match = {"cpMatchId": f"{i + 1:05d}",
-                            "humanSimScore": None,
-                            'cpaA': {
-                                "id": tr_name + '_' + '_'.join(pattern_raw_a[num]),
-                                "start": pattern_time_a[0][0],
-                                "end": pattern_time_a[0][1],
-                            },
-                            'cpaB': {
-                                "id": m + '_' + '_'.join(pattern_raw_b[num]),
-                                "start": pattern_time_b[0][0],
-                                "end": pattern_time_b[0][1],
-                            }
-                            }
-                cp_matches.append(cp_match)
-
-            all_dict = {'recordingA': tr_name,
-                        'recordingB': m,
-                        'compSimScore': sim_val,
-                        }
-            all_dict.update({'cpMatches': cp_matches})
-
-            all_times = [tr_name, m, sim_val, pattern_raw_a, pattern_raw_b, pattern_times_a, pattern_times_b]
-            all_all.append(all_dict)
-
-    with open("../harmonic_similarity.json", "w") as outfile:
-        json.dump({'harSimPairs': all_all}, outfile, indent=4)
-
-    return all_all
-
-
-def create_spreadsheets(data_list):
-    z = 0
-    while z < 1000:
-        choice_list = []
-        temp_choice = []
-        z += 1
-        while len(choice_list) < 15:
-            choice = random.choice(data_list)
-            index_a = ids.index(choice[0])
-            index_b = ids.index(choice[1])
-            if f"{choice[0]}+{choice[1]}" not in temp_choice and artist[index_a] != artist[index_b] and title[index_a] \
-                    != title[index_b]:
-                choice_list.append(choice)
-                temp_choice.append(f"{choice[1]}+{choice[0]}")
-                choice_index = data_list.index(choice)
-                data_list.pop(choice_index)
+            yield align_pair(index, tr_name, m, sim_val, patterns)
+
+
+def export_aligned_pairs(hsim_map, index, writer):
+    """Writes the harSimPairs records of the harmonic similarity map as they are
+    produced, through a `harsim_writer.HarSimPairsWriter`, with bounded memory.
+    Returns
+    -------
+    int
+        the number of records that were written.
+    """
+    num_records = 0
+    with writer:
+        for record in iter_aligned_pairs(hsim_map, index):
+            writer.write(record)
+            num_records += 1
+    return num_records
+
+
+def align_data(hsim_map, encoded_chord, track_title, index=None,
+               out_path="../harmonic_similarity.json"):
+    """Aligns the patterns shared by each pair of tracks in the harmonic
+    similarity map with the raw chord annotations, and saves the harSimPairs.
+    Parameters
+    ----------
+    hsim_map: dict
+        the harmonic similarity map bundle, with the map in 'hsim_map'
+    encoded_chord: dict
+        a dictionary with key=track name and value=list of encoded chords
+    track_title: list
+        the titles of the tracks in the metadata (not used in the export)
+    index: AlignmentIndex, optional
+        a pre-built alignment index; if not given, one is built from the
+        metadata ids and the raw chords of the module.
+    out_path: str, optional
+        the path of the JSON file, which is written as records are produced.
+
+    Returns
+    -------
+    int
+        the number of harSimPairs records, one for each pair of tracks in the
+        map; records are written as they are produced, and not kept in memory
+        (see `iter_spreadsheet_rows` to sample them for annotation).
+    """
+    if index is None:
+        index = AlignmentIndex(ids, raw, encoded_chord)
+    return export_aligned_pairs(
+        hsim_map, index, HarSimPairsWriter(out_path, indent=4))
+
+
+SPREADSHEET_COLUMNS = ['track_1',
+                       'track_2',
+                       'pattern_track_1',
+                       'pattern_track_2',
+                       'time_pattern_track_1',
+                       'time_pattern_track_2',
+                       'sonification_pattern_track_1',
+                       'sonification_pattern_track_2',
+                       'spotify_uri_track_1',
+                       'spotify_uri_track_2',
+                       'Is the shared pattern good for the demo? (Yes/No)',
+                       'Rate the goodness of the shared pattern (from 1 to 5)']
+SPREADSHEET_FORMATS = ['xlsx', 'csv', 'parquet']
+
+
+def sample_splits(data_list, track_ids, track_artist, track_title,
+                  split_size=15, max_splits=1000, seed=None):
+    """Samples splits of pairs without replacement, where the two tracks of a
+    pair must have a different artist and title, and a split cannot hold both
+    a pair and its inverse. Rows are drawn from a shuffled index, and those
+    that are rejected only because of the inverse pair are retried first in
+    the next split.
+    Parameters
+    ----------
+    data_list: list
+        the rows to sample, starting with the ids of the two tracks
+    track_ids: list
+        the ids of the tracks in the metadata
+    track_artist: list
+        the artists of the tracks in the metadata
+    track_title: list
+        the titles of the tracks in the metadata
+    split_size: int, optional
+        the number of rows in each split (the last one may be smaller)
+    max_splits: int, optional
+        the maximum number of splits to sample
+    seed: int, optional
+        the seed of the random generator, for reproducibility
+
+    Returns
+    -------
+    list
+        a list of splits, each being the list of the indexes of its rows.
+    """
+    position = {track_id: i for i, track_id in enumerate(track_ids)}
+    valid = [i for i, row in enumerate(data_list)  # constraints on the pairs
+             if track_artist[position[row[0]]] != track_artist[position[row[1]]]
+             and track_title[position[row[0]]] != track_title[position[row[1]]]]
+    random.Random(seed).shuffle(valid)
+
+    splits, deferred, next_row = [], [], 0
+    while len(splits) < max_splits and (deferred or next_row < len(valid)):
+        split, split_pairs, retry = [], set(), deferred
+        deferred = []
+        while len(split) < split_size:
+            if retry:
+                row = retry.pop(0)
+            elif next_row < len(valid):
+                row = valid[next_row]
+                next_row += 1
             else:
+                break  # no more rows to sample
+            track_a, track_b = data_list[row][0], data_list[row][1]
+            if (track_b, track_a) in split_pairs:
+                deferred.append(row)  # the inverse pair is in the split
                 continue
+            split.append(row)
+            split_pairs.add((track_a, track_b))
+        deferred.extend(retry)
+        if not split:
+            break  # only inverse pairs are left
+        splits.append(split)
+
+    return splits
+
+
+def write_split(rows, out_path, fmt='xlsx'):
+    """Writes the rows of a split to a spreadsheet, in the given format."""
+    df = pd.DataFrame(rows, columns=SPREADSHEET_COLUMNS)
+    if fmt == 'xlsx':
+        df.to_excel(out_path, index=False)
+    elif fmt == 'csv':
+        df.to_csv(out_path, index=False)
+    elif fmt == 'parquet':  # through pyarrow
+        df.to_parquet(out_path, index=False)
+    else:
+        raise ValueError(f"Unsupported format {fmt}, choose from {SPREADSHEET_FORMATS}")
+
+
+def iter_spreadsheet_rows(records):
+    """Generates the spreadsheet rows (see `SPREADSHEET_COLUMNS`) of harSimPairs
+    records, e.g. from `iter_aligned_pairs`, one for each pair of tracks with
+    a shared pattern, from the first match of the pair. The columns to be
+    filled later (sonification, Spotify URIs and ratings) are left empty.
+    """
+    for record in records:
+        if not record['cpMatches']:
+            continue  # no pattern to annotate
+        track_a, track_b = record['recordingA'], record['recordingB']
+        cpa_a = record['cpMatches'][0]['cpaA']
+        cpa_b = record['cpMatches'][0]['cpaB']
+        yield [track_a, track_b,
+               cpa_a['id'][len(track_a) + 1:].split('_'),
+               cpa_b['id'][len(track_b) + 1:].split('_'),
+               f"{cpa_a['start']} - {cpa_a['end']}",
+               f"{cpa_b['start']} - {cpa_b['end']}"] \
+            + [None] * (len(SPREADSHEET_COLUMNS) - 6)
+
+
+def create_spreadsheets(data_list, out_dir='split_global', split_size=15,
+                        max_splits=1000, seed=None, fmt='xlsx', n_jobs=1):
+    """Samples the splits of pairs to annotate (see `sample_splits`) and writes
+    each of them once, as harmonic_similarity_timestamps_<n>.<fmt>, where the
+    spreadsheets are written in parallel by `n_jobs` processes.
+    Parameters
+    ----------
+    data_list: iterable
+        the spreadsheet rows of the pairs, which are only kept as rows (the
+        aligned records are not), e.g. from the harmonic similarity map:
+        `iter_spreadsheet_rows(iter_aligned_pairs(hsim_map, index))`
+
+    Returns
+    -------
+    list
+        the paths of the spreadsheets that were written.
+    """
+    data_list = list(data_list)  # rows are sampled by position
+    splits = sample_splits(data_list, ids, artist, title, split_size,
+                           max_splits, seed)
+    out_paths = [os.path.join(out_dir, f'harmonic_similarity_timestamps_{z}.{fmt}')
+                 for z in range(1, len(splits) + 1)]
+    Parallel(n_jobs=n_jobs)(delayed(write_split)(
+        [data_list[row] for row in split], out_path, fmt)
+        for split, out_path in zip(splits, out_paths))
 
-            df = pd.DataFrame(choice_list, columns=['track_1',
-                                                    'track_2',
-                                                    'pattern_track_1',
-                                                    'pattern_track_2',
-                                                    'time_pattern_track_1',
-                                                    'time_pattern_track_2',
-                                                    'sonification_pattern_track_1',
-                                                    'sonification_pattern_track_2',
-                                                    'spotify_uri_track_1',
-                                                    'spotify_uri_track_2',
-                                                    'Is the shared pattern good for the demo? (Yes/No)',
-                                                    'Rate the goodness of the shared pattern (from 1 to 5)'])
-
-            df.to_excel(f'split_global/harmonic_similarity_timestamps_{z}.xlsx', index=False)
+    return out_paths
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+"""
+On-demand sonification of pattern occurrences: only the time window of a
+pattern is rendered, from the chord annotations and timestamps of the data
+bundle, for a track or for a pair of tracks sharing the pattern (as A/B
+comparison clips, where the two occurrences are separated by a short gap).
+Clips are kept in a size-bounded LRU cache on disk, so that previews can be
+served interactively without sonifying whole tracks in advance.
+
+Usage:
+    renderer = SnippetRenderer(raw_chords, SOUNDFONTS["salamander"],
+                               "snippet_cache", max_bytes=2 ** 30)
+    clip_path = renderer.render_match(index, track_a, track_b, pattern)
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import soundfile as sf
+
+from constants import _DEFAULT_SAMPLE_RATE
+from sonification import AUDIO_FORMATS, PersistentSynth
+from sonification import get_chord_times, get_harmonic_notesequence
+
+PARTIAL_SUFFIX = ".part"
+
+
+class AudioLRUCache:
+    """
+    A directory of audio clips, bounded in size: when a new clip exceeds
+    `max_bytes`, the least recently used clips are deleted. The access time
+    of a clip is its modification time, which is updated at each hit, so
+    that the order of use is preserved across processes and restarts.
+
+    Args:
+        cache_dir (str): the directory holding the clips.
+        max_bytes (int): the maximum size of the clips in the cache.
+        audio_format (str): the format of the clips, from AUDIO_FORMATS.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, audio_format="wav"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.audio_format = audio_format
+        os.makedirs(cache_dir, exist_ok=True)
+        self._sizes = {}  # clip path -> size, in order of use
+        clips = [entry for entry in os.scandir(cache_dir) if entry.is_file()
+                 and entry.name.endswith(f".{audio_format}")]
+        for entry in sorted(clips, key=lambda entry: entry.stat().st_mtime):
+            self._sizes[entry.path] = entry.stat().st_size
+
+    @property
+    def size(self):
+        return sum(self._sizes.values())
+
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, f"{key}.{self.audio_format}")
+
+    def get(self, key: str):
+        """
+        Return the path of the clip with the given key, or None if missing.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self._sizes.pop(path, None)  # evicted by another process
+            return None
+        os.utime(path)  # marked as the most recently used
+        self._sizes[path] = self._sizes.pop(path, os.path.getsize(path))
+        return path
+
+    def put(self, key: str, wave: np.ndarray, sample_rate: int, keep=()):
+        """
+        Write a clip to the cache, evicting the least recently used ones if
+        needed (except those in `keep`), and return its path. Clips are
+        written under a temporary name, so that readers never see incomplete
+        files.
+        """
+        path = self._path(key)
+        partial_path = path + PARTIAL_SUFFIX
+        sf.write(partial_path, wave, sample_rate,
+                 format=AUDIO_FORMATS[self.audio_format])
+        os.replace(partial_path, path)
+        self._sizes.pop(path, None)
+        self._sizes[path] = os.path.getsize(path)
+        self._evict(keep={path, *keep})
+        return path
+
+    def _evict(self, keep):
+        total = self.size
+        for path in list(self._sizes):
+            if total <= self.max_bytes:
+                break  # clips in keep are left, even if the cache is full
+            if path in keep:
+                continue
+            total -= self._sizes.pop(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+
+
+class SnippetRenderer:
+    """
+    Renders the time windows of pattern occurrences, given as the offset and
+    length of the pattern in the chord sequence of a track. The soundfont is
+    loaded once, in a `PersistentSynth` created on the first render.
+
+    Args:
+        raw_chords (dict): the chord annotations of each track, as lists of
+            (chord, time) tuples (see `ngrams_lib.open_chord`).
+        soundfont (str): path to the soundfont used for the synthesis.
+        cache_dir (str): the directory of the clip cache.
+        max_bytes (int): the maximum size of the clip cache.
+        program (int): the MIDI program of the instrument.
+        fix_times (bool): whether chords are rendered with fixed durations.
+        audio_format (str): the format of the clips, from AUDIO_FORMATS.
+        sample_rate (int): the sample rate of the clips.
+        synth (callable): a synthesis function, as those of note_seq, which
+            replaces the `PersistentSynth` if given.
+    """
+
+    def __init__(self, raw_chords: dict, soundfont: str, cache_dir: str,
+                 max_bytes=2 ** 30, program=0, fix_times=False,
+                 audio_format="wav", sample_rate=_DEFAULT_SAMPLE_RATE,
+                 synth=None):
+        self.raw_chords = raw_chords
+        self.soundfont = soundfont
+        self.program = program
+        self.fix_times = fix_times
+        self.sample_rate = sample_rate
+        self.cache = AudioLRUCache(cache_dir, max_bytes, audio_format)
+        self._synth = synth
+
+    @property
+    def synth(self):
+        if self._synth is None:  # the soundfont is only loaded when needed
+            self._synth = PersistentSynth(self.soundfont, self.sample_rate)
+        return self._synth
+
+    def window(self, track_name: str, offset: int, length: int):
+        """
+        Return the chord annotations of a pattern occurrence, with times from
+        the start of the window, and the duration of the window.
+        """
+        chords, times = get_chord_times(
+            self.raw_chords[track_name], self.fix_times)
+        if offset < 0 or offset + length >= len(times):
+            raise ValueError(f"Pattern ({offset}, {length}) is out of the "
+                             f"chord sequence of {track_name}")
+        times = np.asarray(times, dtype=float)
+        start = times[offset]
+        window = [(chord, time - start) for chord, time in zip(
+            chords[offset:offset + length], times[offset:offset + length])]
+        return window, times[offset + length] - start
+
+    def _key(self, *windows):
+        content = json.dumps([os.path.basename(self.soundfont), self.program,
+                              self.sample_rate, windows], default=float)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def _synthesise(self, window, duration):
+        chord_ns = get_harmonic_notesequence(
+            window, prog=self.program, end_time=duration)
+        return self.synth(chord_ns, sample_rate=self.sample_rate,
+                          sf2_path=self.soundfont)
+
+    def render(self, track_name: str, offset: int, length: int, keep=()):
+        """
+        Return the path of the clip of a pattern occurrence in a track, which
+        is only rendered if not in the cache (where the clips in `keep` are
+        not evicted to make room for it).
+        """
+        window = self.window(track_name, offset, length)
+        key = self._key(window)
+        clip_path = self.cache.get(key)
+        if clip_path is None:
+            clip_path = self.cache.put(
+                key, self._synthesise(*window), self.sample_rate, keep)
+        return clip_path
+
+    def render_pair(self, track_a: str, offset_a: int, track_b: str,
+                    offset_b: int, length: int, gap=0.5):
+        """
+        Return the path of an A/B comparison clip, where the occurrence of
+        the pattern in track A is followed by `gap` seconds of silence and by
+        the occurrence in track B.
+        """
+        window_a = self.window(track_a, offset_a, length)
+        window_b = self.window(track_b, offset_b, length)
+        key = self._key(window_a, window_b, gap)
+        clip_path = self.cache.get(key)
+        if clip_path is None:
+            silence = np.zeros(int(gap * self.sample_rate))
+            wave = np.concatenate([self._synthesise(*window_a), silence,
+                                   self._synthesise(*window_b)])
+            clip_path = self.cache.put(key, wave, self.sample_rate)
+        return clip_path
+
+    def render_match(self, index, track_a: str, track_b: str, pattern,
+                     compare=True, gap=0.5):
+        """
+        Render the first occurrence of a shared pattern (an encoded n-gram of
+        the harmonic similarity map) in two tracks, located through an
+        `ngrams_processing.AlignmentIndex`.
+
+        Returns: the path of the A/B comparison clip if `compare` is set,
+            otherwise the paths of the clips of track A and track B.
+        """
+        offset_a, length = index.ngram_offset(track_a, pattern)
+        offset_b, _ = index.ngram_offset(track_b, pattern)
+        if compare:
+            return self.render_pair(track_a, offset_a, track_b, offset_b,
+                                    length, gap)
+        clip_a = self.render(track_a, offset_a, length)
+        return clip_a, self.render(track_b, offset_b, length, keep={clip_a})
+
+    def close(self):
+        if isinstance(self._synth, PersistentSynth):
+            self._synth.close()
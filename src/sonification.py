@@ -2,9 +2,13 @@
 Utilities for the sonification of arbitrary symbolic sequences.
 """
 import os
+import json
 import time
+import hashlib
 import logging
 import argparse
+import multiprocessing as mp
+from queue import Empty
 
 import note_seq
 import numpy as np
@@ -16,12 +20,20 @@ from tqdm import tqdm
 
 import ChordalPy
 
+import instrumentation
 from constants import _DEFAULT_SAMPLE_RATE, SOUNDFONTS
 from chord_lib import strip_chord_bass
 from utils import is_file, create_dir
 
 logger = logging.getLogger("hsimilarity.sonification")
 
+MANIFEST_FILE = "sonification_manifest.jsonl"
+AUDIO_FORMATS = {"wav": "WAV", "flac": "FLAC", "ogg": "OGG"}  # extensions
+
+_BLOCK_SIZE = 65536  # samples rendered at once, for block-wise synthesis
+_INT16_SCALE = 32768.  # fluidsynth renders samples as 16-bit integers
+_POLL_INTERVAL = 5.  # seconds between checks of the sonification workers
+
 
 def save_notesequence(note_sequence, out_dir, midi_fname=None, suffix=""):
   """
@@ -55,9 +67,33 @@ def synthesise_sequence(
   return wave
 
 
-def get_harmonic_notesequence(chord_annotations:list, fix_times=False, prog=0):
+def synthesise_sequence_blocks(
+    note_sequence, out_file, synth, audio_format="wav",
+    block_size=_BLOCK_SIZE, gain=1.):
   """
-  Create a note-sequence encoding the given harmonic progression.
+  Sonification of a note-sequence object through a `PersistentSynth`, where
+  the audio is rendered and written in blocks, so that peak memory does not
+  depend on the duration of the sequence.
+  Args:
+    note_sequence: A music_pb2.NoteSequence to synthesize.
+    out_file: filename of the audio file to be written.
+    synth: A `PersistentSynth`, rendering at its own sample rate.
+    audio_format: one of AUDIO_FORMATS, e.g. "flac" for lossless compression.
+    block_size: maximum number of samples rendered and written at once.
+    gain: scaling of the samples, which are not normalised (see
+      `PersistentSynth.render_blocks`).
+  """
+  with sf.SoundFile(out_file, "w", samplerate=synth.sample_rate, channels=1,
+                    format=AUDIO_FORMATS[audio_format]) as audio_file:
+    for block in synth.render_blocks(note_sequence, block_size, gain):
+      audio_file.write(block)
+
+
+def get_chord_times(chord_annotations:list, fix_times=False, end_time=None):
+  """
+  Split the given harmonic annotations into chords and their times, where the
+  end time of the last chord is appended (see `get_harmonic_notesequence`);
+  this is `end_time`, if given, when timings are available.
   """
   if isinstance((chord_annotations[0]), (list, tuple)):
     chords = list(map(lambda x: x[0], chord_annotations))
@@ -71,23 +107,137 @@ def get_harmonic_notesequence(chord_annotations:list, fix_times=False, prog=0):
       fix_times = True  # this is the only viable option
   # Append the end time of the latest chord, which is assumed to
   # have the same duration of the penultimate chord, or 1s frames.
-  times = list(range(len(chords) + 1)) if fix_times else \
-    np.append(times, [times[-1] + (times[-1] - times[-2])])
+  if fix_times:
+    times = list(range(len(chords) + 1))
+  elif end_time is not None:
+    times = np.append(times, [end_time])
+  else:
+    times = np.append(times, [times[-1] + (times[-1] - times[-2])])
+
+  return chords, times
+
+
+def get_chord_pitches(chord_fig:str):
+  """
+  Return the MIDI pitches of the note constituents of a chord figure, in the
+  octave starting from middle C (the bass note is not considered).
+  """
+  # Remove bass note before parsing the chord
+  chord_nob = strip_chord_bass(chord_fig)
+  # Append the major chord quality if absent
+  if ":" not in chord_nob:
+      chord_nob = chord_nob + ":maj"
+  # Parse the chord and get the decomposition
+  chord = ChordalPy.parse_chord(chord_nob)
+  return tuple(60 + offset for offset, idx
+      in enumerate(chord.get_note_array()) if idx != 0)
+
+
+class PersistentSynth:
+  """
+  A FluidSynth synthesiser that loads the soundfont only once, and can then
+  be used for many sequences -- as a drop-in replacement of the synthesis
+  function `note_seq.midi_synth.fluidsynth`, which loads the soundfont at
+  each call. Instruments are rendered as done by pretty_midi, and the whole
+  waveform is normalised to [-1, 1]; long sequences can be rendered block by
+  block instead (see `render_blocks` and `synthesise_sequence_blocks`).
+  """
+
+  def __init__(self, soundfont, sample_rate=_DEFAULT_SAMPLE_RATE):
+    import fluidsynth  # optional, as for the synthesis through note_seq
+    self.soundfont = soundfont
+    self.sample_rate = sample_rate
+    self.synth = fluidsynth.Synth(samplerate=sample_rate)
+    self.sfid = self.synth.sfload(soundfont)
+
+  def _select_program(self, channel, instrument):
+    self.synth.cc(channel, 120, 0)  # all sound off, from previous sequences
+    self.synth.cc(channel, 121, 0)  # reset all controllers
+    self.synth.program_select(channel, self.sfid,
+                              128 if instrument.is_drum else 0,
+                              instrument.program)
+
+  def _render_blocks(self, instruments, block_size):
+    """
+    Render the given pretty_midi instruments together, one on each channel,
+    yielding the waveform in blocks of at most `block_size` samples.
+    """
+    events, channels = [], (c for c in range(16) if c != 9)
+    for instrument in instruments:
+      channel = 9 if instrument.is_drum else next(channels)
+      self._select_program(channel, instrument)
+      events += [(note.start, 1, channel, note.pitch, note.velocity)
+                 for note in instrument.notes]
+      events += [(note.end, 0, channel, note.pitch, None)
+                 for note in instrument.notes]
+      events += [(cc.time, 2, channel, cc.number, cc.value)
+                 for cc in instrument.control_changes]
+    events.sort(key=lambda event: (event[0], event[1] != 0))
+
+    # Events are followed by 1 second of silence, as in pretty_midi
+    position = 0  # number of samples rendered so far
+    end = (events[-1][0] + 1.,) if len(events) > 0 else (0.,)
+    events.append(end + (None,) * 4)  # only renders up to the end
+    for event_time, kind, channel, number, value in events:
+      target = int(self.sample_rate * event_time)
+      while position < target:
+        num_samples = min(block_size, target - position)
+        yield self.synth.get_samples(num_samples)[::2].astype(np.float32)
+        position += num_samples
+      if kind == 1:
+        self.synth.noteon(channel, number, value)
+      elif kind == 0:
+        self.synth.noteoff(channel, number)
+      elif kind == 2:
+        self.synth.cc(channel, number, value)
+
+  def _render_instrument(self, instrument):
+    blocks = list(self._render_blocks([instrument], _BLOCK_SIZE))
+    return np.concatenate(blocks).astype(np.float64) / _INT16_SCALE
+
+  def render_blocks(self, sequence, block_size=_BLOCK_SIZE, gain=1.):
+    """
+    Render a note-sequence block by block, so that memory does not grow with
+    the length of the sequence. As the peak of the whole waveform is not
+    known in advance, blocks are not normalised: samples are scaled by the
+    given gain, and clipped to [-1, 1].
+    """
+    midi = note_seq.midi_io.note_sequence_to_pretty_midi(sequence)
+    instruments = [instrument for instrument in midi.instruments
+                   if len(instrument.notes) > 0]
+    for block in self._render_blocks(instruments, block_size):
+      yield np.clip(block * (gain / _INT16_SCALE), -1., 1.)
+
+  def __call__(self, sequence, sample_rate=None, sf2_path=None):
+    if sample_rate is not None and sample_rate != self.sample_rate:
+      raise ValueError(f"The synthesiser runs at {self.sample_rate} Hz")
+    midi = note_seq.midi_io.note_sequence_to_pretty_midi(sequence)
+    waves = [self._render_instrument(instrument)
+             for instrument in midi.instruments if len(instrument.notes) > 0]
+    if len(waves) == 0:
+      return np.array([])
+    wave = np.zeros(max(len(w) for w in waves))
+    for w in waves:
+      wave[:len(w)] += w
+    peak = np.abs(wave).max()
+    return wave / peak if peak > 0 else wave
+
+  def close(self):
+    self.synth.delete()
+
+
+def get_harmonic_notesequence(chord_annotations:list, fix_times=False, prog=0,
+                              end_time=None):
+  """
+  Create a note-sequence encoding the given harmonic progression, where the
+  last chord ends at `end_time`, if given (see `get_chord_times`).
+  """
+  chords, times = get_chord_times(chord_annotations, fix_times, end_time)
 
   chord_ns = note_seq.protobuf.music_pb2.NoteSequence()
   for i, chord_fig in enumerate(chords):  # iterate over all chords
       start_time, end_time = times[i], times[i+1]
-      # Remove bass note before parsing the chord
-      chord_nob = strip_chord_bass(chord_fig)
-      # Append the major chord quality if absent
-      if ":" not in chord_nob:
-          chord_nob = chord_nob + ":maj"
-      # Parse the chord and get the decomposition
-      chord = ChordalPy.parse_chord(chord_nob)
-      chord_pitches = [60 + offset for offset, idx 
-          in enumerate(chord.get_note_array()) if idx != 0]
-      
-      for pitch in chord_pitches:  # add each note constituent
+      for pitch in get_chord_pitches(chord_fig):  # add each note constituent
           chord_ns.notes.add(
               pitch=pitch, velocity=80, program=prog,
               start_time=start_time, end_time=end_time)
@@ -98,18 +248,541 @@ def get_harmonic_notesequence(chord_annotations:list, fix_times=False, prog=0):
   return chord_ns
 
 
+def decode_pseudo_hash(chord_hash:str):
+  """
+  Decode the pseudo-hash of a chord (see `ChordalPy.Chord.get_pseudo_hash`),
+  where each letter encodes 3 semitones of the note array, into the array of
+  the 12 pitch classes of the chord (C first).
+  """
+  bits = [(ord(letter) - 97) >> shift & 1
+          for letter in chord_hash for shift in (2, 1, 0)]
+  return np.array(bits, dtype=bool)
+
+
+def _encode_vlq(values:np.ndarray):
+  """
+  Encode non-negative integers (< 2^28) as MIDI variable-length quantities,
+  returning a (n, 4) array of bytes and the mask of the bytes to write.
+  """
+  shifts = np.array([21, 14, 7, 0])
+  groups = (values[:, None] >> shifts) & 0x7F
+  num_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) \
+    + (values >= 1 << 21)
+  mask = np.arange(4) >= 4 - num_bytes[:, None]
+  groups[:, :3] |= 0x80  # continuation bit, except for the last byte
+  return groups, mask
+
+
+class ChordMidiBuilder:
+  """
+  Builds the note-sequences and MIDI files of chord progressions from token
+  arrays (as encoded by a `DecompositionOneHotEncoding`) and their times. The
+  pitches of each token are decoded once, from the pseudo-hash of its chord
+  decomposition, into a table; consecutive repetitions of the same chord are
+  merged into sustained notes. MIDI files are written directly from arrays of
+  note events, without going through note_seq and pretty_midi.
+
+  Args:
+    encdec (DecompositionOneHotEncoding): the encoder of the tokens.
+    prog (int): the MIDI program of the instrument.
+    velocity (int): the velocity of all the notes.
+    base_pitch (int): the MIDI pitch of C, in the octave of the chords.
+  """
+
+  TICKS_PER_QUARTER = 220  # as in note_seq
+  TEMPO_QPM = 120
+
+  def __init__(self, encdec, prog=0, velocity=80, base_pitch=60):
+    self.encdec = encdec
+    self.prog = prog
+    self.velocity = velocity
+    self.base_pitch = base_pitch
+    self.pitch_table = np.stack(
+      [decode_pseudo_hash(encdec.index_to_hash[index])
+       for index in range(encdec.num_classes)]) if encdec.num_classes \
+      else np.zeros((0, 12), dtype=bool)
+    self._label_tokens = {}  # chord label -> token
+
+  @classmethod
+  def from_annotations(cls, data:dict, **kwargs):
+    """
+    Create a builder whose vocabulary has all the chords of the given
+    harmonic annotations, indexed by track name.
+    """
+    from chord_encodings import DecompositionOneHotEncoding
+    chord_set = {chord_fig for chord_annotations in data.values()
+                 for chord_fig in get_chord_times(chord_annotations, True)[0]}
+    return cls(DecompositionOneHotEncoding(chord_set), **kwargs)
+
+  def tokenise(self, chord_annotations:list, fix_times=False):
+    """
+    Return the tokens of the given harmonic annotations, and their times
+    with the end time of the last chord (see `get_chord_times`).
+    """
+    chords, times = get_chord_times(chord_annotations, fix_times)
+    tokens = np.empty(len(chords), dtype=np.int64)
+    for i, chord_fig in enumerate(chords):
+      if chord_fig not in self._label_tokens:
+        self._label_tokens[chord_fig] = self.encdec._encode_label(chord_fig)
+      tokens[i] = self._label_tokens[chord_fig]
+    return tokens, np.asarray(times, dtype=float)
+
+  def note_arrays(self, tokens:np.ndarray, times:np.ndarray, merge=True):
+    """
+    Return the pitches, start and end times of the notes of a chord sequence,
+    where `times` has one more element than `tokens` (the last end time).
+    Notes are sorted by chord, and by pitch within each chord.
+    """
+    tokens, times = np.asarray(tokens), np.asarray(times, dtype=float)
+    starts = np.arange(len(tokens))
+    if merge:  # only the first of consecutive identical chords is kept
+      starts = np.flatnonzero(np.r_[True, tokens[1:] != tokens[:-1]])
+    ends = np.r_[starts[1:], len(tokens)]
+    chord_idx, pitch_class = np.nonzero(self.pitch_table[tokens[starts]])
+    return (self.base_pitch + pitch_class, times[starts][chord_idx],
+            times[ends][chord_idx])
+
+  def to_notesequence(self, tokens:np.ndarray, times:np.ndarray, merge=True):
+    """
+    Create the note-sequence of a chord sequence, as `get_harmonic_notesequence`
+    but with identical consecutive chords merged (if `merge` is set).
+    """
+    chord_ns = note_seq.protobuf.music_pb2.NoteSequence()
+    for pitch, start_time, end_time in zip(
+        *self.note_arrays(tokens, times, merge)):
+      chord_ns.notes.add(pitch=int(pitch), velocity=self.velocity,
+        program=self.prog, start_time=start_time, end_time=end_time)
+    chord_ns.total_time = float(times[-1])
+    chord_ns.tempos.add(qpm=self.TEMPO_QPM)
+    return chord_ns
+
+  def to_midi_bytes(self, tokens:np.ndarray, times:np.ndarray, merge=True):
+    """
+    Return the content of a single-track MIDI file (format 0) with the notes
+    of a chord sequence, encoding all the note events at once.
+    """
+    pitches, starts, ends = self.note_arrays(tokens, times, merge)
+    ticks_per_second = self.TICKS_PER_QUARTER * self.TEMPO_QPM / 60
+    start_ticks = np.round(starts * ticks_per_second).astype(np.int64)
+    end_ticks = np.round(ends * ticks_per_second).astype(np.int64)
+    audible = end_ticks > start_ticks  # notes shorter than a tick are dropped
+    pitches = pitches[audible]
+    # Note-off events come first, when they occur with note-on events
+    ticks = np.r_[end_ticks[audible], start_ticks[audible]]
+    is_on = np.r_[np.zeros(len(pitches), int), np.ones(len(pitches), int)]
+    order = np.lexsort((is_on, ticks))
+    ticks, is_on = ticks[order], is_on[order]
+
+    # Note-offs are note-ons with null velocity, so that the status byte is
+    # written only once (running status), as all events have the same one
+    deltas, delta_mask = _encode_vlq(np.diff(np.r_[0, ticks]))
+    events = np.column_stack([deltas, np.full(len(ticks), 0x90),
+      np.r_[pitches, pitches][order], np.where(is_on, self.velocity, 0)])
+    mask = np.column_stack([delta_mask, np.arange(len(ticks)) == 0,
+                            np.ones((len(ticks), 2), bool)])
+    tempo = 60000000 // self.TEMPO_QPM  # microseconds per quarter note
+    track = b"\x00\xff\x51\x03" + tempo.to_bytes(3, "big") \
+      + bytes([0x00, 0xC0, self.prog]) \
+      + events[mask].astype(np.uint8).tobytes() + b"\x00\xff\x2f\x00"
+    return b"MThd" + (6).to_bytes(4, "big") \
+      + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") \
+      + self.TICKS_PER_QUARTER.to_bytes(2, "big") \
+      + b"MTrk" + len(track).to_bytes(4, "big") + track
+
+  def write_midi(self, midi_path, chord_annotations:list, fix_times=False):
+    """
+    Write the MIDI file of the given harmonic annotations.
+    """
+    with open(midi_path, "wb") as midi_file:
+      midi_file.write(self.to_midi_bytes(
+        *self.tokenise(chord_annotations, fix_times)))
+
+
+def _write_midi_chunk(builder, items, out_dir, fix_times):
+  for track_name, chord_annotations in items:
+    builder.write_midi(os.path.join(out_dir, f"{track_name}.mid"),
+                       chord_annotations, fix_times)
+  return len(items)
+
+
+def write_midi_batch(data:dict, out_dir, builder=None, fix_times=False,
+                     prog=0, n_jobs=1, chunk_size=256):
+  """
+  Write the MIDI files of many chord sequences, indexed by track name, with
+  a `ChordMidiBuilder` (created from the annotations, for the given program,
+  if not given). Tracks
+  are processed in chunks, to amortise the dispatch to the `n_jobs` workers.
+
+  Returns: the number of MIDI files written.
+  """
+  if builder is None:
+    builder = ChordMidiBuilder.from_annotations(data, prog=prog)
+  items = list(data.items())
+  return sum(Parallel(n_jobs=n_jobs)(
+    delayed(_write_midi_chunk)(builder, items[i:i + chunk_size],
+                               out_dir, fix_times)
+    for i in range(0, len(items), chunk_size)))
+
+
+class VoicingCache:
+  """
+  A cache of the waveforms of chord voicings, where each distinct voicing (a
+  set of pitches, for the program and soundfont of the cache) is synthesised
+  only once: the chord is held for `hold` seconds, followed by a release tail
+  of `release` seconds. Chords held for longer are rendered separately, for
+  each duration in whole seconds. Waveforms can also be persisted in a
+  directory, to be shared across processes and runs. Voicings are rendered
+  through a `PersistentSynth` at a fixed `gain`, without normalisation, so
+  that they keep their relative levels once assembled.
+  """
+
+  def __init__(self, soundfont, program=0, sample_rate=_DEFAULT_SAMPLE_RATE,
+               hold=4., release=1., cache_dir=None, synth=None, gain=1.):
+    self.soundfont = soundfont
+    self.program = program
+    self.sample_rate = sample_rate
+    self.hold = hold
+    self.release = release
+    self.cache_dir = cache_dir
+    self.synth = synth  # created at the first rendering, if not given
+    self.gain = gain
+    self.waves = {}
+    if cache_dir is not None:
+      create_dir(cache_dir)
+
+  def _cache_path(self, pitches, hold):
+    name = "_".join(str(pitch) for pitch in pitches)
+    font = os.path.splitext(os.path.basename(self.soundfont))[0]
+    return os.path.join(self.cache_dir, f"{font}_p{self.program}_"
+      f"{self.sample_rate}_g{self.gain:g}_{hold:g}_{self.release:g}_{name}.npy")
+
+  def render(self, pitches:tuple, hold:float):
+    """
+    Synthesise a voicing held for `hold` seconds, followed by the release.
+    """
+    voicing_ns = note_seq.protobuf.music_pb2.NoteSequence()
+    for pitch in pitches:
+      voicing_ns.notes.add(pitch=pitch, velocity=80, program=self.program,
+                           start_time=0., end_time=hold)
+    # A neutral event makes sure that the release tail is rendered too
+    voicing_ns.control_changes.add(time=hold + self.release, control_number=64,
+                                   control_value=0, program=self.program)
+    voicing_ns.total_time = hold + self.release
+    voicing_ns.tempos.add(qpm=120)
+
+    if self.synth is None:
+      self.synth = PersistentSynth(self.soundfont, self.sample_rate)
+    wave = np.concatenate(list(self.synth.render_blocks(
+      voicing_ns, gain=self.gain)))
+    num_samples = int(round((hold + self.release) * self.sample_rate))
+    wave = np.asarray(wave, dtype=np.float32)[:num_samples]
+    return np.pad(wave, (0, num_samples - len(wave)))
+
+  def get(self, pitches:tuple, duration:float):
+    """
+    Return the waveform of a voicing that can be held for `duration` seconds,
+    and the duration it was rendered with.
+    """
+    hold = self.hold if duration <= self.hold else float(np.ceil(duration))
+    if (pitches, hold) not in self.waves:
+      cache_path = None if self.cache_dir is None \
+        else self._cache_path(pitches, hold)
+      if cache_path is not None and os.path.exists(cache_path):
+        wave = np.load(cache_path)
+      else:
+        wave = self.render(pitches, hold)
+        if cache_path is not None:  # atomic, as workers share the cache
+          tmp_path = cache_path[:-len(".npy")] + f".{os.getpid()}.tmp.npy"
+          np.save(tmp_path, wave)
+          os.replace(tmp_path, cache_path)
+      self.waves[pitches, hold] = wave
+    return self.waves[pitches, hold], hold
+
+
+def assemble_chord_sequence(chord_annotations:list, voicing_cache:VoicingCache,
+                            fix_times=False, fade=0.01):
+  """
+  Create the waveform of a harmonic progression from the cached waveforms of
+  its voicings, rather than synthesising the whole sequence. Each chord is
+  cut at its end time, where it is cross-faded (over `fade` seconds) with the
+  release tail of the voicing; tails overlap with the following chords.
+  Chords are placed at their annotated times, so that the waveform keeps the
+  silence before the first chord, as `get_harmonic_notesequence`. As the
+  overlapping parts add up, the waveform is normalised by its peak once
+  assembled.
+
+  Returns: the waveform, as a float32 array normalised to [-1, 1].
+  """
+  chords, times = get_chord_times(chord_annotations, fix_times)
+  sample_rate = voicing_cache.sample_rate
+  bounds = np.round(np.asarray(times, dtype=np.float64) * sample_rate)
+  bounds = bounds.astype(np.int64)  # absolute, as the MIDI
+  num_release = int(round(voicing_cache.release * sample_rate))
+  num_fade = int(round(fade * sample_rate))
+
+  wave = np.zeros(bounds[-1] + num_release, dtype=np.float32)
+  for i, chord_fig in enumerate(chords):
+    num_held = int(bounds[i+1] - bounds[i])
+    if num_held <= 0:
+      continue  # chords with no duration are not heard
+    voicing, hold = voicing_cache.get(
+      get_chord_pitches(chord_fig), num_held / sample_rate)
+    num_hold = int(round(hold * sample_rate))
+    start, fade_len = bounds[i], min(num_fade, num_held)
+    # The held portion, cross-faded with the portion preceding the release
+    wave[start:start + num_held] += voicing[:num_held]
+    if fade_len > 0:
+      wave[start + num_held - fade_len:start + num_held] += \
+        (voicing[num_hold - fade_len:num_hold] -
+         voicing[num_held - fade_len:num_held]) * \
+        np.linspace(0., 1., fade_len, dtype=np.float32)
+    # The release tail, overlapping with what follows
+    tail = voicing[num_hold:num_hold + num_release]
+    wave[start + num_held:start + num_held + len(tail)] += tail
+
+  peak = np.abs(wave).max()
+  return wave / peak if peak > 0 else wave
+
+
+_voicing_caches = {}  # a voicing cache per process and configuration
+
+
+def get_voicing_cache(soundfont, program=0, cache_dir=None, synth=None):
+  """
+  Return the voicing cache of this process for the given configuration; the
+  `PersistentSynth` rendering the voicings is created if not given.
+  """
+  if (soundfont, program, cache_dir) not in _voicing_caches:
+    _voicing_caches[soundfont, program, cache_dir] = \
+      VoicingCache(soundfont, program, cache_dir=cache_dir, synth=synth)
+  return _voicing_caches[soundfont, program, cache_dir]
+
+
 def sonify_chord_sequence(
   track_name, chord_annotations, soundfont,
-  out_dir="./", fix_times=False, prog=0):
+  out_dir="./", fix_times=False, prog=0, voicings=False,
+  synth=None, audio_format="wav"):
+  """
+  Save the MIDI and the audio of a harmonic progression. The audio is
+  rendered and written block by block (see `synthesise_sequence_blocks`),
+  so that memory does not grow with the duration of the track; a
+  `PersistentSynth` can be given as `synth`, to avoid loading the soundfont
+  for each track. Other synthesis functions (e.g. those of note_seq) render
+  the whole waveform at once. If `voicings` is set, the audio is assembled
+  from cached chord voicings (see `assemble_chord_sequence`) instead.
+  """
 
-  chord_ns = get_harmonic_notesequence(
-    chord_annotations, fix_times=fix_times, prog=prog)
+  with instrumentation.timer("sonify", track_name):
+    chord_ns = get_harmonic_notesequence(
+      chord_annotations, fix_times=fix_times, prog=prog)
+    instrumentation.count("sonify", "notes", len(chord_ns.notes))
 
-  save_notesequence(
-    chord_ns, os.path.join(out_dir, "midi"), f"{track_name}.mid")
-  synthesise_sequence(
-    chord_ns, os.path.join(out_dir, "audio", f"{track_name}.wav"),
-    synth=note_seq.midi_synth.fluidsynth, sf2_path=soundfont)
+    save_notesequence(
+      chord_ns, os.path.join(out_dir, "midi"), f"{track_name}.mid")
+    audio_path = get_output_paths(out_dir, track_name, audio_format)["audio"]
+    if voicings:  # voicings are shared by all the tracks
+      voicing_cache = get_voicing_cache(
+        soundfont, prog, os.path.join(out_dir, "voicings"),
+        synth if isinstance(synth, PersistentSynth) else None)
+      sf.write(audio_path, assemble_chord_sequence(
+        chord_annotations, voicing_cache, fix_times),
+        voicing_cache.sample_rate, format=AUDIO_FORMATS[audio_format])
+    elif synth is None:  # the soundfont is only loaded for this track
+      synth = PersistentSynth(soundfont)
+      try:
+        synthesise_sequence_blocks(chord_ns, audio_path, synth, audio_format)
+      finally:
+        synth.close()
+    elif isinstance(synth, PersistentSynth):
+      synthesise_sequence_blocks(chord_ns, audio_path, synth, audio_format)
+    else:
+      wave = synthesise_sequence(chord_ns, synth=synth, sf2_path=soundfont)
+      sf.write(audio_path, wave, _DEFAULT_SAMPLE_RATE,
+               format=AUDIO_FORMATS[audio_format])
+
+
+def get_output_paths(out_dir, track_name, audio_format="wav"):
+  """
+  Return the paths of the files produced by the sonification of a track.
+  """
+  return {"midi": os.path.join(out_dir, "midi", f"{track_name}.mid"),
+          "audio": os.path.join(out_dir, "audio",
+                                f"{track_name}.{audio_format}")}
+
+
+def hash_annotations(chord_annotations:list):
+  """
+  Return a digest of the harmonic annotations of a track, so that changes to
+  the annotations can be detected when resuming the sonification.
+  """
+  content = json.dumps(chord_annotations, default=float)
+  return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class SonificationManifest:
+  """
+  A run manifest in JSON Lines, with an entry for each sonified track: the
+  hash of its annotations, the sonification parameters (soundfont, program,
+  etc.) and the size of its output files. Entries are appended as tracks are
+  completed, so that an interrupted run can be resumed: a track is skipped
+  only if its outputs are complete and were produced from the same
+  annotations and parameters; otherwise it is sonified again.
+
+  Args:
+    path (str): path of the manifest file.
+    params (dict): the parameters of the current run.
+    resume (bool): whether to keep the entries of a previous run, which are
+      otherwise discarded.
+  """
+
+  def __init__(self, path, params:dict, resume=False):
+    self.path = path
+    self.params = params
+    self.audio_format = params.get("audio_format", "wav")
+    self.entries = self._load() if resume else {}
+    # Entries are compacted, and those from other parameters are dropped
+    self.entries = {track_name: entry for track_name, entry
+                    in self.entries.items() if entry["params"] == params}
+    with open(path + ".tmp", "w") as manifest_file:
+      for entry in self.entries.values():
+        manifest_file.write(json.dumps(entry) + "\n")
+    os.replace(path + ".tmp", path)
+
+  def _load(self):
+    entries = {}
+    if not os.path.exists(self.path):
+      return entries
+    with open(self.path, "r") as manifest_file:
+      for line in manifest_file:
+        try:  # the last line may be truncated if the run was interrupted
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          logger.warning(f"Skipping a malformed line in {self.path}")
+          continue
+        entries[entry["track"]] = entry  # the latest entry is kept
+    return entries
+
+  def is_complete(self, track_name, chord_annotations, out_dir):
+    """
+    Whether the outputs of a track are up to date (same annotations and
+    parameters) and complete (files exist, with the recorded sizes).
+    """
+    entry = self.entries.get(track_name)
+    if entry is None or entry["hash"] != hash_annotations(chord_annotations):
+      return False
+    output_paths = get_output_paths(out_dir, track_name, self.audio_format)
+    for output, path in output_paths.items():
+      if not os.path.isfile(path) or \
+          os.path.getsize(path) != entry["outputs"].get(output):
+        return False
+    try:  # audio headers are also checked, as sizes may be those of a copy
+      sf.info(output_paths["audio"])
+    except RuntimeError:
+      return False
+    return True
+
+  def record(self, track_name, chord_annotations, out_dir):
+    """
+    Append the entry of a track that was sonified.
+    """
+    entry = {"track": track_name, "hash": hash_annotations(chord_annotations),
+             "params": self.params, "outputs": {
+               output: os.path.getsize(path) for output, path
+               in get_output_paths(out_dir, track_name,
+                                   self.audio_format).items()}}
+    self.entries[track_name] = entry
+    with open(self.path, "a") as manifest_file:
+      manifest_file.write(json.dumps(entry) + "\n")
+
+
+def _sonification_worker(tasks, results, soundfont, sonify_args):
+  """
+  A worker loading the soundfont once, and then sonifying chunks of tracks
+  until it gets None; the outcome of each track is sent to the results. If
+  the synthesiser cannot be created, all the tracks of the first chunk are
+  reported as failed, and the worker stops.
+  """
+  synth = None
+  try:
+    try:
+      synth = PersistentSynth(soundfont)
+    except Exception as e:
+      chunk = tasks.get()
+      for track_name, _ in chunk or []:
+        results.put((track_name, repr(e)))
+      return
+    for chunk in iter(tasks.get, None):
+      for track_name, chord_annotations in chunk:
+        try:
+          sonify_chord_sequence(track_name, chord_annotations, soundfont,
+                                synth=synth, **sonify_args)
+          results.put((track_name, None))
+        except Exception as e:  # reported, without stopping the worker
+          results.put((track_name, repr(e)))
+  finally:
+    if synth is not None:
+      synth.close()
+    results.put(None)
+
+
+def sonify_with_workers(data:dict, soundfont, num_workers=1, chunk_size=16,
+                        max_queue=64, on_done=None, **sonify_args):
+  """
+  Sonify the given chord sequences on a pool of workers, each holding a
+  `PersistentSynth` and processing chunks of `chunk_size` tracks. Outcomes
+  are streamed back through a bounded queue, so that the progress bar shows
+  the tracks that are actually done.
+
+  Args:
+    data (dict): the chord annotations indexed by track name.
+    soundfont (str): path to the soundfont to load in each worker.
+    num_workers (int): number of worker processes.
+    chunk_size (int): number of tracks sent to a worker at once.
+    max_queue (int): maximum number of outcomes waiting in the queue.
+    on_done (callable): called with the name of each track sonified.
+    sonify_args: other arguments of `sonify_chord_sequence`.
+
+  Returns: a dictionary with the error of each track that failed.
+  """
+  tasks, results = mp.Queue(), mp.Queue(maxsize=max_queue)
+  items = list(data.items())
+  for i in range(0, len(items), chunk_size):
+    tasks.put(items[i:i + chunk_size])
+  workers = [mp.Process(target=_sonification_worker, daemon=True,
+                        args=(tasks, results, soundfont, sonify_args))
+             for _ in range(num_workers)]
+  for worker in workers:
+    tasks.put(None)  # one stop signal for each worker
+    worker.start()
+
+  failed, pending, running = {}, set(data), len(workers)
+  with tqdm(total=len(items)) as progress:
+    while running > 0:
+      try:
+        outcome = results.get(timeout=_POLL_INTERVAL)
+      except Empty:  # workers killed (e.g. out of memory) send no stop signal
+        if not any(worker.is_alive() for worker in workers):
+          tasks.cancel_join_thread()  # the chunks left are never read
+          break
+        continue
+      if outcome is None:
+        running -= 1
+        continue
+      track_name, error = outcome
+      pending.discard(track_name)
+      if error is not None:
+        logger.error(f"Could not sonify {track_name}: {error}")
+        failed[track_name] = error
+      elif on_done is not None:
+        on_done(track_name)
+      progress.update(1)
+  for worker in workers:
+    worker.join()
+
+  for track_name in pending:  # left by the workers that stopped early
+    logger.error(f"Could not sonify {track_name}: no worker left")
+    failed[track_name] = "No worker left to sonify the track"
+  return failed
     
 
 def main():
@@ -134,6 +807,18 @@ def main():
                         help='Whether the durations should be discarded.')
     parser.add_argument('--program', action='store', type=int, default=0,
                         help='Program MIDI number of the instrument to use.')
+    parser.add_argument('--voicings', action='store_true', default=False,
+                        help='Whether to assemble audio from cached voicings.')
+    parser.add_argument('--persistent', action='store_true', default=False,
+                        help='Whether each worker keeps the soundfont loaded, '
+                             'rather than loading it for each track.')
+    parser.add_argument('--chunk_size', action='store', type=int, default=16,
+                        help='Number of tracks given to each worker at once.')
+    parser.add_argument('--audio_format', choices=list(AUDIO_FORMATS),
+                        default='wav', help='Format of the audio files, '
+                        'which are rendered and written block by block.')
+    parser.add_argument('--midi_only', action='store_true', default=False,
+                        help='Whether to only write the MIDI files, in batch.')
     
     # Logging and checkpointing 
     parser.add_argument('--log_dir', action='store',
@@ -151,15 +836,59 @@ def main():
     out_dir = create_dir(args.out_dir)  # create the root output dir
     create_dir(os.path.join(args.out_dir, "midi"))
     create_dir(os.path.join(args.out_dir, "audio"))
+    if args.midi_only:  # identical consecutive chords are merged
+        print("Writing the MIDI files of {} chord sequences".format(len(data)))
+        write_midi_batch(data, os.path.join(out_dir, "midi"),
+                         fix_times=args.fix_times, prog=args.program,
+                         n_jobs=args.num_threads)
+        print('Done!')
+        return
+
     soundfont = SOUNDFONTS[args.soundfont]
+    log_dir = create_dir(args.log_dir) if args.log_dir else out_dir
 
+    # The manifest records the tracks completed, with their parameters
+    params = {"soundfont": os.path.basename(soundfont),
+              "program": args.program, "fix_times": args.fix_times,
+              "voicings": args.voicings, "sample_rate": _DEFAULT_SAMPLE_RATE,
+              "audio_format": args.audio_format,
+              # Tracks are rendered block by block with a fixed gain, instead
+              # of normalising the peak of each track
+              "gain": 1.}
+    manifest = SonificationManifest(os.path.join(log_dir, MANIFEST_FILE),
+                                    params, resume=args.resume)
     print("Found {} chord sequences to sonify".format(len(data)))
+    if args.resume:  # only missing, corrupt or stale outputs are redone
+        data = {track_name: chord_annotations for track_name, chord_annotations
+                in data.items() if not manifest.is_complete(
+                    track_name, chord_annotations, out_dir)}
+        print(f"Resuming: {len(data)} chord sequences left to sonify")
+
     print(f"Running sonification using {args.num_threads} threads. Be patient.")
-    Parallel(n_jobs=args.num_threads)(delayed(sonify_chord_sequence)\
-      (track_name, chord_annotations, soundfont,
-       out_dir, args.fix_times, args.program) \
-         for track_name, chord_annotations in tqdm(data.items()))
-    
+    if args.persistent:  # a long-lived synthesiser in each worker
+        failed = sonify_with_workers(data, soundfont, args.num_threads,
+            args.chunk_size, out_dir=out_dir, fix_times=args.fix_times,
+            prog=args.program, voicings=args.voicings,
+            audio_format=args.audio_format, on_done=lambda name:
+                manifest.record(name, data[name], out_dir))
+        if len(failed) > 0:
+            print(f"Could not sonify {len(failed)} chord sequences")
+    else:  # tracks are recorded in the manifest after each batch
+        items = list(data.items())
+        batch_size = args.chunk_size * args.num_threads
+        with Parallel(n_jobs=args.num_threads) as parallel, \
+                tqdm(total=len(items)) as progress:
+            for i in range(0, len(items), batch_size):
+                batch = items[i:i + batch_size]
+                parallel(delayed(sonify_chord_sequence)\
+                  (track_name, chord_annotations, soundfont,
+                   out_dir, args.fix_times, args.program, args.voicings,
+                   audio_format=args.audio_format) \
+                     for track_name, chord_annotations in batch)
+                for track_name, chord_annotations in batch:
+                    manifest.record(track_name, chord_annotations, out_dir)
+                progress.update(len(batch))
+
     print('Done!')
 
 if __name__ == "__main__":
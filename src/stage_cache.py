@@ -0,0 +1,203 @@
+"""
+A content-addressed cache for the outputs of the pipeline stages, where
+each result is stored under a hash of its input data, of the parameters of
+the stage (e.g. the minimum order of patterns, or the encoder vocabulary),
+and of the version of the code computing it. A change in any of these only
+invalidates the results depending on it, even at the level of single tracks.
+"""
+import os
+import hashlib
+import inspect
+import logging
+
+import joblib
+import numpy as np
+
+logger = logging.getLogger("hsimilarity.stage_cache")
+
+CACHE_EXTENSION = ".joblib"
+EVICTION_RATIO = 0.8  # fraction of max_bytes to keep after eviction
+
+
+def _update_hash(hasher, obj):
+    """
+    Feed a canonical representation of the given object to the hasher.
+    """
+    if isinstance(obj, (str, bytes)):
+        data = obj.encode("utf-8") if isinstance(obj, str) else obj
+        hasher.update(b"s%d:" % len(data) + data)
+    elif obj is None or isinstance(obj, (bool, int, float, np.generic)):
+        hasher.update(b"n" + repr(obj.item() if isinstance(obj, np.generic)
+                                  else obj).encode("utf-8"))
+    elif isinstance(obj, np.ndarray):
+        hasher.update(b"a%s%s" % (str(obj.dtype).encode("utf-8"),
+                                  str(obj.shape).encode("utf-8")))
+        hasher.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(b"l%d" % len(obj))
+        for item in obj:
+            _update_hash(hasher, item)
+    elif isinstance(obj, dict):
+        hasher.update(b"d%d" % len(obj))
+        for key in sorted(obj, key=repr):  # order-independent
+            _update_hash(hasher, key)
+            _update_hash(hasher, obj[key])
+    elif isinstance(obj, (set, frozenset)):
+        _update_hash(hasher, sorted(obj, key=repr))
+    elif hasattr(obj, "__dict__"):  # e.g. encoder-decoders
+        _update_hash(hasher, type(obj).__qualname__)
+        # Private attributes are considered as caches and skipped
+        _update_hash(hasher, {name: value for name, value in vars(obj).items()
+                              if not name.startswith("_")})
+    else:
+        raise TypeError("Cannot fingerprint object of type %s" % type(obj))
+
+
+def fingerprint(*objects):
+    """
+    Compute a content-based hash of the given objects: dictionaries, lists,
+    arrays, and objects are hashed according to their content, so the same
+    fingerprint is obtained in different runs.
+    """
+    hasher = hashlib.sha256()
+    for obj in objects:
+        _update_hash(hasher, obj)
+    return hasher.hexdigest()
+
+
+def code_version(*modules_or_functions):
+    """
+    Fingerprint the source code of the given modules/functions, so that
+    cached results are invalidated when the code that produced them changes.
+    """
+    sources = []
+    for obj in modules_or_functions:
+        try:
+            sources.append(inspect.getsource(obj))
+        except (OSError, TypeError):  # e.g. defined interactively
+            code = getattr(obj, "__code__", None)
+            sources.append(code.co_code if code is not None
+                           else getattr(obj, "__qualname__", repr(obj)))
+    return fingerprint(sources)
+
+
+class StageCache:
+    """
+    A cache of stage outputs on disk, indexed by content-based keys, with a
+    least-recently-used eviction policy when the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def key(self, stage: str, data, params=None, code=None):
+        """
+        Compute the key of a stage output, from its inputs. Fingerprints that
+        have already been computed (e.g. of parameters shared across tracks)
+        can be passed as strings to avoid computing them again.
+
+        Args:
+            stage (str): name of the stage.
+            data: input data of the stage.
+            params: parameters of the stage.
+            code (str): the version of the code, see `code_version`.
+        """
+        return fingerprint(stage, data, params, code)
+
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_EXTENSION)
+
+    def _entries(self):
+        for path, _, files in os.walk(self.cache_dir):
+            for fname in files:
+                if fname.endswith(CACHE_EXTENSION):
+                    entry_path = os.path.join(path, fname)
+                    yield entry_path, os.path.getmtime(entry_path)
+
+    def __contains__(self, key: str):
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str, default=None):
+        """
+        Return the output stored under the given key, or `default` if none.
+        """
+        entry_path = self._path(key)
+        try:
+            value = joblib.load(entry_path)
+        except (FileNotFoundError, EOFError):
+            return default
+        os.utime(entry_path)  # mark the entry as recently used
+        return value
+
+    def put(self, key: str, value):
+        """
+        Store an output under the given key, evicting old entries if needed.
+        """
+        entry_path = self._path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        if os.path.exists(entry_path):
+            self.size -= os.path.getsize(entry_path)
+        tmp_path = entry_path + ".tmp"
+        joblib.dump(value, tmp_path)
+        os.replace(tmp_path, entry_path)  # atomic, for concurrent readers
+        self.size += os.path.getsize(entry_path)
+
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            # Leave some room, so that eviction is not triggered at every put
+            self.evict(int(self.max_bytes * EVICTION_RATIO))
+
+    def evict(self, max_bytes: int):
+        """
+        Remove the least recently used entries, until the size of the cache
+        is not greater than `max_bytes`.
+        """
+        for entry_path, _ in sorted(self._entries(), key=lambda e: e[1]):
+            if self.size <= max_bytes:
+                break
+            self.size -= os.path.getsize(entry_path)
+            os.remove(entry_path)
+            logger.debug(f"Evicted {entry_path} from the stage cache")
+
+    def call(self, stage: str, fn, *args, **kwargs):
+        """
+        Return the output of fn(*args, **kwargs), computing it only if it is
+        not in the cache yet. The source of fn is part of the key.
+        """
+        key = self.key(stage, args, kwargs, code_version(fn))
+        value = self.get(key, default=self)
+        if value is self:  # not found, as None is a valid output
+            value = fn(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def map_tracks(self, stage: str, fn, track_dict: dict, params=None,
+                   code=None):
+        """
+        Apply a stage to each track independently, with per-track caching:
+        only the tracks whose data changed (or that are new) are computed.
+
+        Args:
+            stage (str): name of the stage.
+            fn (function): the stage, as fn(track_id, track_data, **params).
+            track_dict (dict): the input data of each track.
+            params (dict): parameters of the stage, shared by all tracks.
+            code (str): the version of the code, see `code_version`.
+
+        Returns: a dictionary with the output of the stage for each track.
+        """
+        params = {} if params is None else params
+        params_fp = fingerprint(params)  # computed only once for all tracks
+        code = code_version(fn) if code is None else code
+
+        outputs = {}
+        for track_id, track_data in track_dict.items():
+            key = self.key(stage, (track_id, track_data), params_fp, code)
+            outputs[track_id] = self.get(key, default=self)
+            if outputs[track_id] is self:
+                outputs[track_id] = fn(track_id, track_data, **params)
+                self.put(key, outputs[track_id])
+
+        return outputs
@@ -0,0 +1,298 @@
+"""
+Generation of synthetic corpora of encoded chord sequences, for testing the
+pipeline at scale without licensed data. A first-order Markov model is fitted
+on the token transitions and on the sequence lengths of an encoding bundle
+(e.g. setup/sonar_encoding_bundle.joblib), and then sampled to produce any
+number of tracks, with controllable rates of repetition (recurring patterns
+within a track) and of cover duplication (noisy copies of earlier tracks).
+Corpora are saved in the formats consumed by the pipeline: encoding bundles
+(joblib or columnar), or chord annotations in JSON Lines for `lharp`.
+"""
+import os
+import gzip
+import json
+import argparse
+
+import joblib
+import numpy as np
+
+from bundle_lib import BundleWriter, _offsets_from_lengths
+from utils import is_file
+
+ENCODING_BUNDLE_PATH = "../setup/sonar_encoding_bundle.joblib"
+FORMATS = ["joblib", "columnar", "jsonl"]
+DEFAULT_KEY = "C:maj"  # sequences are already normalised to the tonic
+
+
+class MarkovChordModel:
+    """
+    A first-order Markov model of encoded chord sequences, holding the
+    distribution of the first token, the transition probabilities between
+    tokens, and the empirical distribution of sequence lengths.
+    """
+
+    def __init__(self, tokens, start_probs, transitions, lengths):
+        self.tokens = np.asarray(tokens)  # the token of each state
+        self.start_probs = np.asarray(start_probs, dtype=np.float64)
+        self.transitions = np.asarray(transitions, dtype=np.float64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.unigram_probs = self.transitions.sum(axis=0)
+        self.unigram_probs /= self.unigram_probs.sum()
+        # Rows are shifted by their index, so that the next state of many
+        # chains can be sampled with a single search in the flattened array
+        cumulative = np.cumsum(self.transitions, axis=1)
+        cumulative /= cumulative[:, -1:]
+        self._flat_cumulative = (cumulative + np.arange(len(self.tokens))
+                                 [:, None]).ravel()
+
+    @classmethod
+    def fit(cls, encoded: dict, vocab_size: int = None):
+        """
+        Fit the model on the encoded chord sequences of a corpus.
+
+        Args:
+            encoded (dict): the encoded chord sequences, indexed by track id.
+            vocab_size (int): if given, only the most frequent tokens are kept
+                and the transitions are re-normalised among them.
+
+        Returns: the fitted model.
+        """
+        sequences = [np.asarray(sequence, dtype=np.int64)
+                     for sequence in encoded.values() if len(sequence) > 0]
+        tokens, counts = np.unique(np.concatenate(sequences), return_counts=True)
+        if vocab_size is not None:
+            if vocab_size > len(tokens):
+                raise ValueError(f"Vocabulary size {vocab_size} is larger than "
+                                 f"the {len(tokens)} tokens of the corpus")
+            tokens = np.sort(tokens[np.argsort(-counts, kind="stable")[:vocab_size]])
+
+        state_of = {token: state for state, token in enumerate(tokens.tolist())}
+        start_counts = np.zeros(len(tokens))
+        transitions = np.zeros((len(tokens), len(tokens)))
+        for sequence in sequences:
+            states = np.array([state_of.get(token, -1)
+                               for token in sequence.tolist()])
+            states = states[states >= 0]  # out-of-vocabulary tokens dropped
+            if len(states) == 0:
+                continue
+            start_counts[states[0]] += 1
+            np.add.at(transitions, (states[:-1], states[1:]), 1)
+
+        # States without successors continue with the unigram distribution
+        unigram = transitions.sum(axis=0) + start_counts
+        transitions[transitions.sum(axis=1) == 0] = unigram
+        return cls(tokens, start_counts / start_counts.sum(), transitions,
+                   [len(sequence) for sequence in sequences])
+
+    def sample_lengths(self, n_tracks: int, rng):
+        return rng.choice(self.lengths, size=n_tracks)
+
+    def sample_chains(self, n_chains: int, length: int, rng):
+        """
+        Sample `n_chains` independent sequences of states of the given length,
+        as a (n_chains, length) array; chains are sampled in parallel.
+        """
+        states = np.empty((n_chains, length), dtype=np.int64)
+        states[:, 0] = rng.choice(len(self.tokens), size=n_chains,
+                                  p=self.start_probs)
+        num_states = len(self.tokens)
+        for t in range(1, length):
+            previous = states[:, t - 1]
+            found = np.searchsorted(self._flat_cumulative,
+                previous + rng.random(n_chains), side="right")
+            states[:, t] = np.minimum(found - previous * num_states,
+                                      num_states - 1)
+        return states
+
+
+def _add_repetitions(fresh, length: int, repetition: float,
+                     segment_length: tuple, rng):
+    """
+    Assemble a sequence of the given length from segments, each of which is
+    either a copy of an earlier segment (with probability `repetition`) or
+    the next portion of the fresh chain.
+    """
+    sequence = np.empty(length, dtype=np.int64)
+    pos, fresh_pos, segments = 0, 0, []
+    while pos < length:
+        size = min(int(rng.integers(segment_length[0], segment_length[1] + 1)),
+                   length - pos)
+        if segments and rng.random() < repetition:
+            start, prev_size = segments[int(rng.integers(len(segments)))]
+            size = min(size, prev_size)
+            sequence[pos:pos + size] = sequence[start:start + size]
+        else:  # new material from the Markov chain
+            sequence[pos:pos + size] = fresh[fresh_pos:fresh_pos + size]
+            fresh_pos += size
+        segments.append((pos, size))
+        pos += size
+    return sequence
+
+
+def plan_corpus(model: MarkovChordModel, n_tracks: int, cover_rate=0.05,
+                rng=None):
+    """
+    Decide the length of each track, and which tracks are covers of earlier
+    (original) tracks, before any sequence is generated.
+
+    Returns: the length of each track, and the index of the track each one is
+        a cover of (-1 for original tracks).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    lengths = model.sample_lengths(n_tracks, rng)
+    is_cover = rng.random(n_tracks) < cover_rate
+    is_cover[0] = False  # the first track cannot be a cover
+    originals = np.flatnonzero(~is_cover)
+    # Each cover is drawn uniformly from the originals preceding it
+    num_before = np.cumsum(~is_cover) - (~is_cover)
+    choice = (rng.random(n_tracks) * num_before).astype(np.int64)
+    cover_of = np.where(is_cover, originals[np.minimum(choice,
+                        len(originals) - 1)], -1)
+    lengths[is_cover] = lengths[cover_of[is_cover]]
+    return lengths, cover_of
+
+
+def generate_corpus(model: MarkovChordModel, n_tracks: int, repetition=0.5,
+                    cover_rate=0.05, cover_noise=0.1, segment_length=(3, 8),
+                    batch_size=4096, seed=0, out=None):
+    """
+    Generate a synthetic corpus of encoded chord sequences from the model.
+
+    Args:
+        model (MarkovChordModel): the fitted Markov model.
+        n_tracks (int): number of tracks to generate.
+        repetition (float): probability of repeating an earlier segment of the
+            track, which controls the amount of recurring patterns.
+        cover_rate (float): fraction of tracks that are covers of others.
+        cover_noise (float): fraction of the tokens that differ in a cover.
+        segment_length (tuple): range of the length of segments.
+        batch_size (int): number of Markov chains sampled at once.
+        seed (int): seed of the random generator.
+        out (function): an optional allocator of the array of tokens, called
+            with the total number of tokens (e.g. to use a memory map).
+
+    Returns: the tokens of all the tracks in a single array, the offsets of
+        each track in it, and the index of the original of each cover.
+    """
+    rng = np.random.default_rng(seed)
+    lengths, cover_of = plan_corpus(model, n_tracks, cover_rate, rng)
+    offsets = _offsets_from_lengths(lengths)
+    tokens = np.empty(offsets[-1], dtype=np.int32) if out is None \
+        else out(int(offsets[-1]))
+
+    for batch_start in range(0, n_tracks, batch_size):
+        batch = np.arange(batch_start, min(batch_start + batch_size, n_tracks))
+        originals = batch[cover_of[batch] < 0]
+        if len(originals) > 0:
+            chains = model.sample_chains(len(originals),
+                                         int(lengths[originals].max()), rng)
+        for i, track in enumerate(originals):
+            states = _add_repetitions(chains[i], int(lengths[track]),
+                                      repetition, segment_length, rng)
+            tokens[offsets[track]:offsets[track + 1]] = model.tokens[states]
+        for track in batch[cover_of[batch] >= 0]:  # originals come first
+            source = cover_of[track]
+            cover = tokens[offsets[source]:offsets[source + 1]].copy()
+            noisy = rng.random(len(cover)) < cover_noise
+            cover[noisy] = model.tokens[rng.choice(len(model.tokens),
+                size=int(noisy.sum()), p=model.unigram_probs)]
+            tokens[offsets[track]:offsets[track + 1]] = cover
+
+    return tokens, offsets, cover_of
+
+
+def track_names(n_tracks: int):
+    width = len(str(max(n_tracks - 1, 0)))
+    return [f"synth_{i:0{width}d}" for i in range(n_tracks)]
+
+
+def save_corpus(out_path: str, out_format: str, n_tracks: int, encdec,
+                model: MarkovChordModel, **generation_args):
+    """
+    Generate a synthetic corpus and save it in the given format: an encoding
+    bundle, either pickled ("joblib") or columnar ("columnar", where tokens
+    are written in place through a memory map), or chord annotations in JSON
+    Lines ("jsonl", gzipped if the path ends with .gz), with the chord labels
+    decoded by the encoder-decoder. The original of each cover is also saved.
+    """
+    names = track_names(n_tracks)
+    if out_format == "columnar":
+        writer = BundleWriter(out_path, "encoding_bundle", synthetic=True)
+        allocator = lambda size: np.lib.format.open_memmap(os.path.join(
+            out_path, "encoded.values.npy"), mode="w+", dtype=np.int32,
+            shape=(size,))
+        tokens, offsets, cover_of = generate_corpus(
+            model, n_tracks, out=allocator, **generation_args)
+        tokens.flush()
+        writer.strings("track_ids", names)
+        writer.array("encoded.offsets", offsets)
+        writer.array("cover_of", cover_of)
+        if hasattr(encdec, "save_vocabulary"):
+            encdec.save_vocabulary(os.path.join(out_path, "vocabulary.json"))
+            writer.manifest["vocabulary"] = "vocabulary.json"
+        writer.close()
+        return
+
+    tokens, offsets, cover_of = generate_corpus(model, n_tracks,
+                                                **generation_args)
+    covers = {names[i]: names[j] for i, j in enumerate(cover_of) if j >= 0}
+    if out_format == "joblib":
+        joblib.dump({"encoded": {name: tokens[offsets[i]:offsets[i + 1]]
+                                 .tolist() for i, name in enumerate(names)},
+                     "encoder_decoder": encdec, "covers": covers}, out_path)
+        return
+
+    labels = {token: encdec.decode_event(token)
+              for token in model.tokens.tolist()}
+    opener = gzip.open if out_path.endswith(".gz") else open
+    with opener(out_path, "wt", encoding="utf-8") as out_file:
+        for i, name in enumerate(names):
+            record = {"id": name, "chord": [[labels[token], float(t)]
+                for t, token in enumerate(tokens[offsets[i]:offsets[i + 1]]
+                                          .tolist())],
+                      "key": [[DEFAULT_KEY, 0.0]]}
+            if name in covers:
+                record["cover_of"] = covers[name]
+            out_file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def main():
+    """
+    Main function to parse the arguments and call the main process.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generation of synthetic chord corpora for scale testing.')
+
+    parser.add_argument('out_path', action='store', type=str,
+                        help='Path of the synthetic corpus to generate.')
+    parser.add_argument('n_tracks', action='store', type=int,
+                        help='Number of tracks to generate.')
+    parser.add_argument('--encoding_bundle', default=ENCODING_BUNDLE_PATH,
+                        type=lambda x: is_file(parser, x),
+                        help='Encoding bundle on which the model is fitted.')
+    parser.add_argument('--format', choices=FORMATS, default=FORMATS[0],
+                        help='Format of the corpus to generate.')
+    parser.add_argument('--vocab_size', action='store', type=int,
+                        help='Number of tokens (the most frequent) to keep.')
+    parser.add_argument('--repetition', action='store', type=float, default=0.5,
+                        help='Probability of repeating a segment of a track.')
+    parser.add_argument('--cover_rate', action='store', type=float, default=0.05,
+                        help='Fraction of tracks that are covers of others.')
+    parser.add_argument('--cover_noise', action='store', type=float, default=0.1,
+                        help='Fraction of tokens that are changed in covers.')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='Seed of the random generator.')
+
+    args = parser.parse_args()
+
+    encoding_bundle = joblib.load(args.encoding_bundle)
+    model = MarkovChordModel.fit(encoding_bundle["encoded"], args.vocab_size)
+    save_corpus(args.out_path, args.format, args.n_tracks,
+                encoding_bundle["encoder_decoder"], model,
+                repetition=args.repetition, cover_rate=args.cover_rate,
+                cover_noise=args.cover_noise, seed=args.seed)
+    print(f"Generated {args.n_tracks} tracks in {args.out_path}")
+
+
+if __name__ == "__main__":
+    main()
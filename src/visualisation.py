@@ -51,6 +51,7 @@ def compute_similarity_graph(hsim_map:dict, encdec=None):
     Two additional labels describe the connection: the value of the similarity,
     and the longest recurrent pattern on which the similarity is based. If a
     decoder is provided as optional argument, the longest pattern is decoded.
+    For large maps, see `harmonic_network` to build a sparsified graph.
 
     Args:
         hsim_map (dict): a symmetric dictionary where hsim_map["a"]["b"] gives
@@ -0,0 +1,20 @@
+"""
+Test configuration: the modules in src/ are imported as top-level modules,
+as done when running the scripts from that directory.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SETUP_DIR = os.path.join(ROOT_DIR, "setup")
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+
+@pytest.fixture(scope="session")
+def databundle():
+    """The chord and key annotations of the SONAR data bundle."""
+    import joblib
+    return joblib.load(os.path.join(SETUP_DIR, "sonar_databundle.joblib"))
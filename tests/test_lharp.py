@@ -0,0 +1,97 @@
+"""
+Checks of the pipelined runner of lharp: the backpressure of its queues, and
+the equivalence of its outputs with those of `lharp_api.iter_chord_pipeline`.
+"""
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from chord_encodings import DecompositionOneHotEncoding
+from lharp import _TrackEncoder, _drain, run_tracks
+from lharp_api import iter_chord_pipeline
+
+NUM_TRACKS = 40  # tracks of the data bundle run through the pipeline
+
+
+class _PendingFuture(Future):
+    """A future whose result is only set when it is waited for."""
+
+    def __init__(self, value, waited):
+        super().__init__()
+        self.value = value
+        self.waited = waited
+
+    def result(self, timeout=None):
+        if not self.done():
+            self.waited.append(self.value)
+            self.set_result((self.value,))
+        return super().result(timeout)
+
+
+def _done_future(value):
+    future = Future()
+    future.set_result((value,))
+    return future
+
+
+def test_drain_waits_for_the_oldest():
+    waited, collected = [], []
+    queue = deque(_PendingFuture(i, waited) for i in range(5))
+    _drain(queue, collected.append, 3)
+    # Only the oldest tasks are waited for, until the queue has room
+    assert waited == [0, 1] and collected == [0, 1]
+    assert [future.value for future in queue] == [2, 3, 4]
+    _drain(queue, collected.append, 0)
+    assert collected == [0, 1, 2, 3, 4] and len(queue) == 0
+
+
+def test_drain_collects_completed_in_order():
+    waited, collected = [], []
+    queue = deque([_done_future(0), _done_future(1),
+                   _PendingFuture(2, waited), _done_future(3)])
+    _drain(queue, collected.append, 3)
+    # Completed tasks at the head are collected without waiting, but those
+    # completed after a pending one are kept, so that the order is preserved
+    assert waited == [] and collected == [0, 1]
+    assert len(queue) == 2
+
+
+@pytest.fixture(scope="module")
+def records(databundle):
+    track_names = sorted(databundle["preproc"])[:NUM_TRACKS]
+    return [(name, databundle["preproc"][name],
+             databundle["keys"].get(name, [])) for name in track_names]
+
+
+def _run(records, queue_size):
+    encoder = _TrackEncoder(DecompositionOneHotEncoding([]), fail_soft=True)
+    sources = [("record", name, (chords, key))
+               for name, chords, key in records]
+    encoded, bags = run_tracks(sources, encoder, queue_size=queue_size)
+    return encoder, encoded, bags
+
+
+@pytest.mark.parametrize("queue_size", [1, 2])
+def test_run_tracks_backpressure(records, queue_size):
+    _, encoded, bags = _run(records, 64)
+    _, encoded_bp, bags_bp = _run(records, queue_size)
+    assert list(encoded_bp) == list(encoded)  # in the order of the sources
+    for track_name in encoded:
+        assert np.array_equal(encoded_bp[track_name], encoded[track_name])
+    assert bags_bp == bags
+
+
+def test_run_tracks_matches_iter_chord_pipeline(records):
+    encoder, encoded, bags = _run(records, 4)
+    report = {}
+    outputs = list(iter_chord_pipeline(records, encoder.encdec,
+                                       fail_soft=True, report=report))
+    # Tracks without a known key (isophonics_109 here) are skipped by both
+    assert len(encoded) < len(records)
+    assert [track_name for track_name, _, _ in outputs] == list(encoded)
+    for track_name, tokens, bag in outputs:
+        assert np.array_equal(tokens, encoded[track_name])
+        assert bag == bags[track_name]
+    assert report == encoder.report
@@ -0,0 +1,102 @@
+"""
+Checks of the alignment of the harmonic similarity map with the raw chords,
+against the search of each pattern done by `ngrams_lib`.
+"""
+import itertools
+import os
+
+import pytest
+
+from conftest import SETUP_DIR
+from ngrams_lib import open_chord, open_meta, single_ngram_position
+from ngrams_processing import AlignmentIndex, iter_aligned_pairs
+from ngrams_processing import open_encoded, open_hsim_map
+from utils import convert_time
+
+NUM_TRACKS = 10  # tracks of the similarity map whose pairs are aligned
+
+
+@pytest.fixture(scope="module")
+def raw_chords():
+    return open_chord(os.path.join(SETUP_DIR, "sonar_databundle.joblib"))
+
+
+@pytest.fixture(scope="module")
+def encoded():
+    return open_encoded(
+        os.path.join(SETUP_DIR, "sonar_encoding_bundle.joblib"))
+
+
+@pytest.fixture(scope="module")
+def hsim_map():
+    hsim_map = open_hsim_map(
+        os.path.join(SETUP_DIR, "sonar_hsim_map_global.joblib"))
+    track_names = itertools.islice(hsim_map["hsim_map"], NUM_TRACKS)
+    return {"hsim_map": {track_name: hsim_map["hsim_map"][track_name]
+                         for track_name in track_names}}
+
+
+@pytest.fixture
+def index(raw_chords, encoded):
+    track_ids = open_meta(os.path.join(SETUP_DIR, "sonar_datasets_meta.csv"))[0]
+    return AlignmentIndex(track_ids, raw_chords, encoded)
+
+
+def _baseline_record(raw_chords, encoded, tr_name, m, sim_val, patterns):
+    """The harSimPairs record of a pair, as aligned before the index."""
+    chords_a = [c for c, t in raw_chords[tr_name]]
+    chords_b = [c for c, t in raw_chords[m]]
+    timestamps_a = [t for c, t in raw_chords[tr_name]]
+    timestamps_b = [t for c, t in raw_chords[m]]
+    patterns_index_a = [single_ngram_position(encoded[tr_name], pattern)
+                        for pattern in patterns]
+    patterns_index_b = [single_ngram_position(encoded[m], pattern)
+                        for pattern in patterns]
+    pattern_time_a = [(convert_time(timestamps_a[i]),
+                       convert_time(timestamps_a[i + l]))
+                      for i, l in patterns_index_a]
+    pattern_time_b = [(convert_time(timestamps_b[i]),
+                       convert_time(timestamps_b[i + l]))
+                      for i, l in patterns_index_b]
+    cp_matches = []
+    for num, ((i, l), (j, k)) in enumerate(
+            zip(patterns_index_a, patterns_index_b)):
+        cp_matches.append({"cpMatchId": f"{num + 1:05d}",
+                           "humanSimScore": None,
+                           "cpaA": {
+                               "id": "_".join([tr_name] + chords_a[i:i + l]),
+                               "start": pattern_time_a[0][0],
+                               "end": pattern_time_a[0][1],
+                           },
+                           "cpaB": {
+                               "id": "_".join([m] + chords_b[j:j + k]),
+                               "start": pattern_time_b[0][0],
+                               "end": pattern_time_b[0][1],
+                           }})
+    return {"recordingA": tr_name, "recordingB": m,
+            "compSimScore": sim_val, "cpMatches": cp_matches}
+
+
+def test_ngram_offset(index, encoded, hsim_map):
+    for tr_name, maps in hsim_map["hsim_map"].items():
+        for m, (_, patterns) in maps.items():
+            for pattern in patterns:
+                assert index.ngram_offset(tr_name, pattern) == \
+                    single_ngram_position(encoded[tr_name], pattern)
+                assert index.ngram_offset(m, pattern) == \
+                    single_ngram_position(encoded[m], pattern)
+
+
+def test_ngram_offset_missing(index, encoded):
+    tr_name = next(iter(encoded))
+    with pytest.raises(ValueError):
+        index.ngram_offset(tr_name, [-1, -1, -1])
+
+
+def test_aligned_records(index, raw_chords, encoded, hsim_map):
+    records = list(iter_aligned_pairs(hsim_map, index))
+    expected = [_baseline_record(raw_chords, encoded, tr_name, m, *maps[m])
+                for tr_name, maps in hsim_map["hsim_map"].items()
+                for m in maps]
+    assert len(records) > 0
+    assert records == expected
@@ -0,0 +1,100 @@
+"""
+Round-trip checks of the MIDI files written by `ChordMidiBuilder`, which
+encodes note events directly rather than through note_seq and pretty_midi.
+"""
+import io
+import random
+
+import numpy as np
+import pretty_midi
+import pytest
+
+from chord_encodings import DecompositionOneHotEncoding
+from sonification import ChordMidiBuilder, _encode_vlq, decode_pseudo_hash
+from sonification import get_chord_pitches, get_chord_times
+
+NUM_TRACKS = 20  # tracks of the data bundle written as MIDI
+NUM_LABELS = 200  # chord labels sampled from the data bundle
+
+
+@pytest.fixture(scope="module")
+def annotations(databundle):
+    track_names = sorted(databundle["preproc"])[:NUM_TRACKS]
+    return {name: databundle["preproc"][name] for name in track_names}
+
+
+@pytest.fixture(scope="module")
+def builder(annotations):
+    return ChordMidiBuilder.from_annotations(annotations, prog=24)
+
+
+def _vlq_bytes(value):
+    groups, mask = _encode_vlq(np.array([value]))
+    return bytes(groups[mask].astype(np.uint8).tolist())
+
+
+@pytest.mark.parametrize("value, expected", [
+    (0, b"\x00"), (0x40, b"\x40"), (0x7F, b"\x7f"), (0x80, b"\x81\x00"),
+    (0x2000, b"\xc0\x00"), (0x3FFF, b"\xff\x7f"), (0x4000, b"\x81\x80\x00"),
+    (0x1FFFFF, b"\xff\xff\x7f"), (0x200000, b"\x81\x80\x80\x00"),
+    (0xFFFFFFF, b"\xff\xff\xff\x7f"),
+])
+def test_encode_vlq(value, expected):
+    # Examples of variable-length quantities from the MIDI specification
+    assert _vlq_bytes(value) == expected
+
+
+def test_midi_bytes_parse(builder, annotations):
+    ticks_per_second = builder.TICKS_PER_QUARTER * builder.TEMPO_QPM / 60
+    for chord_annotations in annotations.values():
+        tokens, times = builder.tokenise(chord_annotations)
+        midi = pretty_midi.PrettyMIDI(
+            io.BytesIO(builder.to_midi_bytes(tokens, times)))
+        assert midi.resolution == builder.TICKS_PER_QUARTER
+        assert len(midi.instruments) == 1
+        assert midi.instruments[0].program == 24
+
+        # Notes are compared at the resolution of the MIDI ticks
+        pitches, starts, ends = builder.note_arrays(tokens, times)
+        start_ticks = np.round(starts * ticks_per_second)
+        end_ticks = np.round(ends * ticks_per_second)
+        audible = end_ticks > start_ticks
+        expected = sorted(zip(pitches[audible].tolist(),
+                              start_ticks[audible].tolist(),
+                              end_ticks[audible].tolist()))
+        parsed = sorted((note.pitch, round(note.start * ticks_per_second),
+                         round(note.end * ticks_per_second))
+                        for note in midi.instruments[0].notes)
+        assert parsed == expected
+        assert all(note.velocity == builder.velocity
+                   for note in midi.instruments[0].notes)
+
+
+def test_midi_bytes_chord_pitches(builder, annotations):
+    # Without merging, each chord has the pitches of `get_chord_pitches`
+    ticks_per_second = builder.TICKS_PER_QUARTER * builder.TEMPO_QPM / 60
+    for chord_annotations in annotations.values():
+        chords, times = get_chord_times(chord_annotations)
+        midi = pretty_midi.PrettyMIDI(io.BytesIO(builder.to_midi_bytes(
+            *builder.tokenise(chord_annotations), merge=False)))
+        onsets = {}
+        for note in midi.instruments[0].notes:
+            onsets.setdefault(round(note.start * ticks_per_second),
+                              set()).add(note.pitch)
+        ticks = np.round(np.asarray(times) * ticks_per_second).astype(int)
+        for chord_fig, start_tick, end_tick in zip(chords, ticks, ticks[1:]):
+            if end_tick > start_tick:  # shorter chords are dropped
+                assert onsets[start_tick] == set(get_chord_pitches(chord_fig))
+
+
+def test_decode_pseudo_hash(databundle):
+    labels = sorted({chord_fig for chord_annotations
+                     in databundle["preproc"].values() for chord_fig
+                     in get_chord_times(chord_annotations, True)[0]})
+    labels = random.Random(0).sample(labels, NUM_LABELS)
+    encdec = DecompositionOneHotEncoding(labels)
+    for label in labels:
+        pitch_classes = np.flatnonzero(
+            decode_pseudo_hash(encdec.chord_to_hash[label]))
+        assert set(pitch_classes) == \
+            {pitch % 12 for pitch in get_chord_pitches(label)}, label